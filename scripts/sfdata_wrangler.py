@@ -27,6 +27,7 @@ import datetime
 
 sys.path.append('D:/WORKSPACE/sfdata_wrangler/sfdata_wrangler')
 
+from Manifest import Manifest
 from SFMuniDataHelper import SFMuniDataHelper
 from GTFSHelper import GTFSHelper
 from SFMuniDataExpander import SFMuniDataExpander
@@ -247,6 +248,9 @@ FIPS = [('06001' , 'Alameda County', 'AC'),
         ('06081' , 'San Mateo County', 'SMC')]
 
 # OUTPUT FILES--change as needed
+#   files ending in .h5 are written as HDF5, and files ending in .parquet
+#   are written as directories of parquet files, partitioned by the same
+#   year/month/dow keys.  The parquet backend requires pyarrow. 
 CLEANED_OUTFILES_STEP1  = ["D:/RUNS/sfdata_wrangler2/out/sfmuni_cleaned_part1.h5", 
                            "D:/RUNS/sfdata_wrangler2/out/sfmuni_cleaned_part2.h5", 
                            "D:/RUNS/sfdata_wrangler2/out/sfmuni_cleaned_part3.h5", 
@@ -255,6 +259,14 @@ CLEANED_OUTFILES_STEP1  = ["D:/RUNS/sfdata_wrangler2/out/sfmuni_cleaned_part1.h5
 
 CLEANED_OUTFILES_STEP2 = "D:/RUNS/sfdata_wrangler2/out/sfmuni_cleaned_YYYY.h5"    
 
+# records what the clean steps have already processed, so reruns only
+# process new or changed inputs.  Delete it to start from scratch.
+CLEAN_MANIFEST_FILE = "D:/RUNS/sfdata_wrangler2/out/sfmuni_cleaned_manifest.json"
+
+# write the repeated string columns in the cleaned stores as integer codes
+# with a dictionary table, to reduce file size and I/O.  
+ENCODE_STRINGS = False
+
 NOMATCH_OUTFILE = "D:/RUNS/sfdata_wrangler2/out/cleaned_nomatch_"   
 
 EXPANDED_TRIP_OUTFILE = "D:/RUNS/sfdata_wrangler2/out/sfmuni_expanded_trip_YYYY.h5"    
@@ -300,6 +312,12 @@ MUNI_ESTIMATION_FILE = "D:/RUNS/sfdata_wrangler2/out/MuniEstFile.csv"
 BART_ESTIMATION_FILE = "D:/RUNS/sfdata_wrangler2/out/BARTEstFile.csv"
 
 
+# number of processes to use for steps that can run in parallel
+# 1 runs serially, None uses all available cores.  Each expansion 
+# worker holds a month of AVL data, so memory grows with the workers. 
+NUM_WORKERS = 1
+
+
 # main function call
 
 if __name__ == "__main__":
@@ -321,17 +339,19 @@ if __name__ == "__main__":
         startTime = datetime.datetime.now()  
         sfmuniHelper = SFMuniDataHelper()
         sfmuniHelper.readRouteEquiv(ROUTE_EQUIV) 
-        for infile in RAW_STP_FILES: 
-            sfmuniHelper.processRawData(infile, CLEANED_OUTFILES_STEP1[0])
+        manifest = Manifest(CLEAN_MANIFEST_FILE)
+        sfmuniHelper.processRawFiles(RAW_STP_FILES, CLEANED_OUTFILES_STEP1[0], 
+                                     numWorkers=NUM_WORKERS, manifest=manifest)
         print ('Finished cleaning step 1 SFMuni data in ', (datetime.datetime.now() - startTime))
 
     # update RouteEquiv and write to separate files by year
     if 'clean2' in STEPS_TO_RUN: 
         startTime = datetime.datetime.now()  
-        sfmuniHelper = SFMuniDataHelper()
+        sfmuniHelper = SFMuniDataHelper(encodeStrings=ENCODE_STRINGS)
         sfmuniHelper.readRouteEquiv(ROUTE_EQUIV) 
-        for infile in CLEANED_OUTFILES_STEP1: 
-            sfmuniHelper.cleanPart2(infile, CLEANED_OUTFILES_STEP2)
+        manifest = Manifest(CLEAN_MANIFEST_FILE)
+        sfmuniHelper.cleanPart2Files(CLEANED_OUTFILES_STEP1, CLEANED_OUTFILES_STEP2, 
+                                     manifest=manifest)
         print ('Finished cleaning step 2 SFMuni data in ', (datetime.datetime.now() - startTime))
         
     # process GTFS schedule data.  
@@ -361,7 +381,8 @@ if __name__ == "__main__":
                                 startDate='1900-01-01', 
                                 endDate='2100-12-31')
         for gtfs_infile in RAW_GTFS_FILES: 
-            sfmuniExpander.expandAndWeight(gtfs_infile, write_intermediate_files=False)
+            sfmuniExpander.expandAndWeight(gtfs_infile, write_intermediate_files=False, 
+                                           numWorkers=NUM_WORKERS)
         sfmuniExpander.closeStores()
         print ('Finished expanding to GTFS in ', (datetime.datetime.now() - startTime))
 
@@ -374,8 +395,8 @@ if __name__ == "__main__":
             aggregator.aggregateTripStopsToMonths(daily_file, MONTHLY_TS_OUTFILE)
         aggregator.imputeMissingTripStops(MONTHLY_TS_OUTFILE)
             
-        aggregator.aggregateMonthlyTripStops(MONTHLY_TS_OUTFILE)
-        aggregator.aggregateMonthlyTrips(MONTHLY_TS_OUTFILE, MONTHLY_TRIP_OUTFILE)
+        aggregator.aggregateMonthlyTripStops(MONTHLY_TS_OUTFILE, MONTHLY_TRIP_OUTFILE, 
+                                             numWorkers=NUM_WORKERS)
         
         print ('Finished aggregations in ', (datetime.datetime.now() - startTime)) 
 
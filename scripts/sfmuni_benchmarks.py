@@ -0,0 +1,582 @@
+# allows python3 style print function
+from __future__ import print_function
+
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import sys
+import os
+import datetime
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sfdata_wrangler'))
+
+from SFMuniDataHelper import SFMuniDataHelper
+from Utils import getSpeeds
+from KeyJoin import KeyEncoder, leftJoinOnKeys
+from SFMuniDataExpander import SFMuniDataExpander, calculateRuntime
+from SFMuniDataAggregator import SFMuniDataAggregator
+
+
+USAGE = r"""
+
+ python sfmuni_benchmarks.py [benchmarksToRun]
+
+ e.g.
+
+ python sfmuni_benchmarks.py stpReader speeds
+
+ Notes: - benchmarks should choose from list of valid benchmarks
+        - each benchmark runs on synthetic data, so no input files are needed
+
+"""
+
+
+# VALID BENCHMARKS-- list of allowable benchmarks to run
+VALID_BENCHMARKS = [ 'stpReader', 
+                     'speeds', 
+                     'join', 
+                     'runtime', 
+                     'perBoarding', 
+                     'impute'
+                   ]
+
+
+# size of the synthetic data
+STP_ROWS = 200000
+SPEED_ROWS = 10000000
+
+# size of a full weekday of GTFS trip-stops, and the share observed
+JOIN_ROUTES = 80
+JOIN_TRIPS_PER_DIR = 150
+JOIN_STOPS_PER_TRIP = 50
+JOIN_OBSERVED_SHARE = 0.25
+JOIN_FIELDS = ['AGENCY_ID', 'ROUTE_SHORT_NAME', 'DIR', 'TRIP', 'SEQ']
+
+RUNTIME_TRIPS = 2000
+RUNTIME_STOPS_PER_TRIP = 30
+RUNTIME_TRIP_FIELDS = ['AGENCY_ID', 'ROUTE_SHORT_NAME', 'DIR', 'TRIP']
+
+# totals of boardings times a schedule attribute, checked against the sum 
+# of the trip-stop products
+PER_BOARDING_METRICS = ['WAITHOURS', 'FULLFARE_REV']
+
+# columns that imputeMissingTripStops() takes from the previous month
+IMPUTE_COLS = ['TIMEPOINT', 'ARRIVAL_TIME_DEV', 'DEPARTURE_TIME_DEV', 'DWELL', 
+               'RUNTIME', 'TOTTIME', 'SERVMILES', 'RUNSPEED', 'TOTSPEED', 
+               'ONTIME5', 'ON', 'OFF', 'LOAD_ARR', 'LOAD_DEP', 'PASSMILES', 
+               'PASSHOURS', 'WAITHOURS', 'FULLFARE_REV', 'PASSDELAY_DEP', 
+               'PASSDELAY_ARR', 'RDBRDNGS', 'DOORCYCLES', 'WHEELCHAIR', 
+               'BIKERACK', 'CAPACITY', 'VC', 'CROWDED', 'CROWDHOURS']
+
+
+def timeIt(label, func, *args, **kwargs):
+    """
+    Runs the function, prints how long it took, and returns the result.
+    """
+    startTime = datetime.datetime.now()
+    result = func(*args, **kwargs)
+    print ('  %-40s %s' % (label, datetime.datetime.now() - startTime))
+    return result
+
+
+def writeSyntheticSTPFile(filename, numRows, headerEvery=50000, misalignEvery=10000):
+    """
+    Writes a synthetic file in "raw STP" format, with the column layout
+    in SFMuniDataHelper.COLUMNS.  Includes headers in the middle of the
+    file and some rows with 4-digit rear-door boardings, which shift the
+    remaining columns.
+    """
+
+    np.random.seed(0)
+    columns = SFMuniDataHelper.COLUMNS
+    width = max([col[1][1] for col in columns])
+
+    # lay out the rows as a block of bytes, column by column
+    lines = np.full((numRows, width + 1), ord(' '), dtype='uint8')
+    lines[:, -1] = ord('\n')
+    for name, (a, b), dtype, stringLength in columns:
+        w = b - a
+        if w == 0: 
+            continue
+        elif dtype=='object':
+            values = np.array(['X%d' % i for i in range(10)])[np.random.randint(0, 10, numRows)]
+        elif dtype=='float64':
+            values = np.round(np.random.uniform(0, 10 ** (w - 3), numRows), 1).astype(str)
+        else:
+            values = np.random.randint(0, min(10 ** (w - 1), 1000), numRows).astype(str)
+        values = np.char.rjust(np.char.encode(values, 'ascii'), w).astype('S%d' % w)
+        lines[:, a:b] = np.frombuffer(values.tobytes(), dtype='uint8').reshape(numRows, w)
+
+    header = ('ID'.ljust(width) + '\n').encode('ascii')
+
+    f = open(filename, 'wb')
+    f.write(b'HEADER\n' + header)
+    for i in range(numRows):
+        line = lines[i].tobytes()
+        if i % misalignEvery == 0:
+            line = line[:297] + b'1234' + line[297:-5] + b'\n'
+        f.write(line)
+        if i > 0 and i % headerEvery == 0:
+            f.write(header)
+    f.close()
+
+
+def readWithReadFwf(infile):
+    """
+    Reads the file the way processRawData did with pd.read_fwf, including
+    the clean-up of headers and mis-aligned rows.
+    """
+    helper = SFMuniDataHelper()
+    colnames = [col[0] for col in helper.COLUMNS]
+    colspecs = [col[1] for col in helper.COLUMNS]
+
+    reader = pd.read_fwf(infile,
+                         names    = colnames,
+                         colspecs = colspecs,
+                         skiprows = helper.HEADERROWS,
+                         usecols  = helper.COLUMNS_TO_READ,
+                         iterator = True,
+                         skip_blank_lines = True,
+                         chunksize= helper.CHUNKSIZE,
+                         na_values=['ID'])
+
+    rows = 0
+    for chunk in reader:
+        chunk = chunk.dropna(axis=0, subset=['SEQ'])
+        chunk['RDBRDNGS'] = chunk['RDBRDNGS'].astype('int64')
+        chunk = chunk[chunk['RDBRDNGS']<1000]
+        rows += len(chunk)
+    return rows
+
+
+def readWithSTPReader(infile):
+    """
+    Reads the file with the byte-offset STP reader.
+    """
+    helper = SFMuniDataHelper()
+    rows = 0
+    for chunk in helper.getSTPReader(infile):
+        rows += len(chunk)
+    return rows
+
+
+def benchmarkSTPReader():
+    """
+    Compares pd.read_fwf to the STPReader on a synthetic STP file.
+    """
+    print ('Benchmarking STP reader on %i rows' % STP_ROWS)
+
+    infile = os.path.join(tempfile.mkdtemp(), 'synthetic.stp')
+    writeSyntheticSTPFile(infile, STP_ROWS)
+
+    fwfRows = timeIt('pd.read_fwf', readWithReadFwf, infile)
+    stpRows = timeIt('STPReader', readWithSTPReader, infile)
+    print ('  rows kept: read_fwf=%i, STPReader=%i' % (fwfRows, stpRows))
+
+    os.remove(infile)
+
+
+def updateSpeeds(speedInputs):
+    """
+    The speed calculation as it was done with a tuple-apply, for comparison.
+    """
+    (servmiles, runtime) = speedInputs
+    
+    if runtime>0: 
+        return round(servmiles / (runtime / 60.0), 2)
+    elif runtime == 0: 
+        return 0.0
+    else: 
+        return np.nan
+        
+
+def benchmarkSpeeds():
+    """
+    Compares the tuple-apply speed calculation to the vectorized one, 
+    with some zero, negative and missing runtimes. 
+    """
+    print ('Benchmarking speed calculation on %i rows' % SPEED_ROWS)
+
+    np.random.seed(0)
+    servmiles = pd.Series(np.round(np.random.uniform(0, 2, SPEED_ROWS), 3))
+    runtime = pd.Series(np.round(np.random.uniform(-0.5, 5, SPEED_ROWS), 2))
+    runtime[np.random.randint(0, SPEED_ROWS, SPEED_ROWS // 100)] = 0
+    runtime[np.random.randint(0, SPEED_ROWS, SPEED_ROWS // 100)] = np.nan
+
+    speedInput = pd.Series(zip(servmiles, runtime), index=servmiles.index)
+    applied = timeIt('tuple apply', speedInput.apply, updateSpeeds)
+    vectorized = timeIt('getSpeeds', getSpeeds, servmiles, runtime)
+
+    applied = applied.values.astype('float64')
+    same = (applied == vectorized) | (np.isnan(applied) & np.isnan(vectorized))
+    print ('  rows that differ: %i' % (~same).sum())
+
+
+def makeSyntheticWeekday():
+    """
+    Makes a synthetic weekday of GTFS trip-stops and a sample of observed
+    AVL trip-stops, with the join fields as they are in the expander. 
+    """
+    np.random.seed(0)
+    date = pd.Timestamp('2015-01-06')
+    
+    routes = np.array(['%i' % (r + 1) for r in range(JOIN_ROUTES)], dtype='object')
+    (route, direction, trip, seq) = [a.ravel() for a in np.meshgrid(
+        np.arange(JOIN_ROUTES), np.arange(2), np.arange(JOIN_TRIPS_PER_DIR), 
+        np.arange(1, JOIN_STOPS_PER_TRIP + 1), indexing='ij')]
+    departure = 500 + (trip * 1100) // JOIN_TRIPS_PER_DIR
+    
+    gtfs = pd.DataFrame({
+        'AGENCY_ID'        : 'SFMTA', 
+        'ROUTE_SHORT_NAME' : routes[route], 
+        'DIR'              : direction, 
+        'TRIP'             : departure.astype('int64') * 1000000 + 1, 
+        'SEQ'              : seq, 
+        'DATE'             : date, 
+        'ARRIVAL_TIME_S'   : date + pd.to_timedelta(departure * 60 + seq * 90, unit='s'), 
+        'SERVMILES_S'      : np.random.uniform(0, 0.5, len(seq))
+        })
+    
+    sfmuni = gtfs.loc[np.random.uniform(0, 1, len(gtfs)) < JOIN_OBSERVED_SHARE, JOIN_FIELDS].copy()
+    sfmuni['AGENCY_ID'] = sfmuni['AGENCY_ID'].astype('category')
+    sfmuni['ROUTE_SHORT_NAME'] = sfmuni['ROUTE_SHORT_NAME'].astype('category')
+    sfmuni['DATE'] = date
+    sfmuni['ARRIVAL_TIME'] = date + pd.to_timedelta(np.random.randint(0, 86400, len(sfmuni)), unit='s')
+    sfmuni['ON'] = np.random.randint(0, 10, len(sfmuni))
+    sfmuni['OFF'] = np.random.randint(0, 10, len(sfmuni))
+    sfmuni['LOAD_ARR'] = np.random.randint(0, 60, len(sfmuni))
+    sfmuni['OBSERVED'] = 1
+    
+    return gtfs, sfmuni
+    
+    
+def joinWithMerge(gtfs, sfmuni):
+    """
+    The join as it was done with a sorted merge on the join fields. 
+    """
+    joined = pd.merge(gtfs, sfmuni, how='left', on=JOIN_FIELDS, 
+                      suffixes=('', '_AVL'), sort=True)
+    joined.sort_values(['DATE'] + JOIN_FIELDS, inplace=True)
+    return joined
+    
+    
+def joinWithKeys(gtfs, sfmuni, encoder):
+    """
+    The join on int64 keys, with the GTFS keys already encoded. 
+    """
+    joined = leftJoinOnKeys(gtfs, sfmuni, encoder.keys, encoder.encode(sfmuni), 
+                            on=JOIN_FIELDS, suffix='_AVL')
+    joined.sort_values(['DATE'] + JOIN_FIELDS, inplace=True)
+    return joined
+    
+    
+def benchmarkJoin():
+    """
+    Compares the merge on the join fields to the join on encoded keys, 
+    for a full weekday.  The GTFS keys are encoded once per service 
+    period, so that is timed separately. 
+    """
+    gtfs, sfmuni = makeSyntheticWeekday()
+    print ('Benchmarking join of %i GTFS to %i AVL trip-stops' % (len(gtfs), len(sfmuni)))
+
+    merged = timeIt('pd.merge', joinWithMerge, gtfs, sfmuni)
+    encoder = timeIt('KeyEncoder (once per service period)', KeyEncoder, gtfs, JOIN_FIELDS)
+    joined = timeIt('leftJoinOnKeys', joinWithKeys, gtfs, sfmuni, encoder)
+
+    merged = merged.reset_index(drop=True)
+    joined = joined.reset_index(drop=True)
+    differ = 0
+    for col in merged.columns: 
+        a = merged[col].astype('object')
+        b = joined[col].astype('object')
+        differ += (~((a == b) | (a.isnull() & b.isnull()))).sum()
+    print ('  values that differ: %i' % differ)
+
+
+def calculateRuntimeByTrip(df):
+    """
+    The runtime calculation as it was done for each trip with iterrows, 
+    for comparison.  Assumes data are grouped by: 
+    ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','TRIP']
+    """        
+    df.sort_values(['SEQ'], inplace=True)
+
+    firstStop = True
+    lastDepartureTime = None
+    for i, row in df.iterrows():    
+        if firstStop: 
+            df.at[i,'RUNTIME'] = 0        # no runtime for first trip
+            firstStop = False
+        else:
+            diff = row['ARRIVAL_TIME'] - lastDepartureTime
+            df.at[i,'RUNTIME'] = max(0, round(diff.total_seconds() / 60.0, 2))
+        lastDepartureTime = row['DEPARTURE_TIME']
+    
+    return df
+    
+    
+def calculateRuntimeWithIterrows(df):
+    """
+    Applies the per-trip runtime calculation to each trip. 
+    """
+    trips = [calculateRuntimeByTrip(group.copy()) 
+             for key, group in df.groupby(RUNTIME_TRIP_FIELDS, observed=True)]
+    return pd.concat(trips)
+    
+    
+def makeSyntheticTrips():
+    """
+    Makes synthetic AVL trip-stops, shuffled so the stops are out of 
+    order, with some missing SEQ and times, and some arrivals before
+    the departure from the previous stop. 
+    """
+    np.random.seed(0)
+    date = pd.Timestamp('2015-01-06')
+    
+    (trip, seq) = [a.ravel() for a in np.meshgrid(np.arange(RUNTIME_TRIPS), 
+        np.arange(1, RUNTIME_STOPS_PER_TRIP + 1), indexing='ij')]
+    departure = (date + pd.to_timedelta(18000 + trip * 20 + seq * 90 
+                 + np.random.randint(-30, 30, len(seq)), unit='s'))
+    arrival = departure - pd.to_timedelta(np.random.randint(0, 120, len(seq)), unit='s')
+    
+    df = pd.DataFrame({
+        'AGENCY_ID'        : 'SFMTA', 
+        'ROUTE_SHORT_NAME' : (trip % 20).astype(str), 
+        'DIR'              : trip % 2, 
+        'TRIP'             : trip, 
+        'SEQ'              : seq.astype('float64'), 
+        'ARRIVAL_TIME'     : arrival, 
+        'DEPARTURE_TIME'   : departure
+        })
+    
+    n = len(df)
+    df.loc[np.random.uniform(0, 1, n) < 0.01, 'SEQ'] = np.nan
+    df.loc[np.random.uniform(0, 1, n) < 0.02, 'ARRIVAL_TIME'] = pd.NaT
+    df.loc[np.random.uniform(0, 1, n) < 0.02, 'DEPARTURE_TIME'] = pd.NaT
+    
+    return df.iloc[np.random.permutation(n)]
+    
+    
+def benchmarkRuntime():
+    """
+    Compares the per-trip iterrows runtime calculation to the vectorized
+    one, and checks that they give the same RUNTIME for every record, 
+    including the zeros at the first stop and where the runtime is 
+    negative or missing. 
+    """
+    df = makeSyntheticTrips()
+    print ('Benchmarking runtime calculation on %i trip-stops' % len(df))
+    
+    iterated = timeIt('iterrows by trip', calculateRuntimeWithIterrows, df.copy())
+    vectorized = timeIt('calculateRuntime', calculateRuntime, df.copy())
+    
+    iterated = iterated['RUNTIME'].sort_index()
+    vectorized = vectorized['RUNTIME'].sort_index()
+    assert (iterated.index == vectorized.index).all()
+    differ = (iterated.values.astype('float64') != vectorized.values).sum()
+    print ('  rows that differ: %i, first stops: %i, zero runtimes: %i' 
+           % (differ, df['TRIP'].nunique(), (vectorized == 0).sum()))
+    assert differ == 0
+
+
+def makeSyntheticBoardings():
+    """
+    Makes synthetic trip-stops with boardings, where the headway varies
+    by trip and stop and the fare varies by trip, so a total calculated
+    from the aggregated boardings would differ from the sum of the 
+    trip-stop values. 
+    """
+    np.random.seed(0)
+    (trip, seq) = [a.ravel() for a in np.meshgrid(np.arange(RUNTIME_TRIPS), 
+        np.arange(1, RUNTIME_STOPS_PER_TRIP + 1), indexing='ij')]
+    n = len(trip)
+    
+    df = pd.DataFrame({
+        'DATE'             : pd.Timestamp('2015-01-06'), 
+        'DOW'              : 1, 
+        'TOD'              : (trip % 5).astype(str), 
+        'AGENCY_ID'        : 'SFMTA', 
+        'ROUTE_SHORT_NAME' : (trip % 20).astype(str), 
+        'DIR'              : trip % 2, 
+        'TRIP'             : trip, 
+        'SEQ'              : seq, 
+        'ON'               : np.random.poisson(2, n).astype('float64'), 
+        'HEADWAY_S'        : np.random.uniform(3, 30, n), 
+        'FARE'             : np.where(trip % 3 == 0, 2.0, 2.25), 
+        'TRIP_STOPS'       : 1, 
+        'TOD_WEIGHT'       : np.random.uniform(1, 4, RUNTIME_TRIPS)[trip]
+        })
+    return df
+    
+    
+def benchmarkPerBoarding():
+    """
+    Checks that the WAITHOURS and FULLFARE_REV totals for trips and 
+    route-stops equal the sums of boardings times headway and fare for 
+    each trip-stop, weighted for the route-stops. 
+    """
+    df = makeSyntheticBoardings()
+    print ('Checking per-boarding totals on %i trip-stops' % len(df))
+    
+    for (name, inputs, derive) in SFMuniDataExpander.DERIVED_METRICS: 
+        if name in PER_BOARDING_METRICS: 
+            df[name] = derive(df)
+    
+    baseline = pd.DataFrame({
+        'WAITHOURS'    : df['ON'] * 0.5 * df['HEADWAY_S'] / 60.0, 
+        'FULLFARE_REV' : df['ON'] * df['FARE']
+        })
+    weighted = baseline.multiply(df['TOD_WEIGHT'], axis=0)
+    for col in SFMuniDataAggregator.TRIP_GROUPBY + SFMuniDataAggregator.DAILY_STOP_GROUPBY: 
+        baseline[col] = df[col]
+        weighted[col] = df[col]
+    
+    aggregator = SFMuniDataAggregator()
+    checks = [[SFMuniDataAggregator.TRIP_GROUPBY, aggregator.getTripRules(), 
+               'trip', None, baseline], 
+              [SFMuniDataAggregator.DAILY_STOP_GROUPBY, aggregator.getDailyStopRules(), 
+               'route_stop', 'TOD_WEIGHT', weighted]]
+    for (groupby, rules, level, weight, expected) in checks: 
+        rules = [rule for rule in rules 
+                 if rule[0] in PER_BOARDING_METRICS + ['ON', 'HEADWAY_S', 'FARE']]
+        aggdf, stringLengths = aggregator.aggregateTransitRecords(df, 
+                groupby=groupby, columnSpecs=rules, level=level, weight=weight)
+        expected = expected.groupby(groupby).sum().reset_index()
+        for name in PER_BOARDING_METRICS: 
+            maxDiff = np.abs(aggdf[name].values - expected[name].values).max()
+            print ('  %s %s max difference: %g' % (level, name, maxDiff))
+            assert np.allclose(aggdf[name].values, expected[name].values)
+
+
+def makeSyntheticMonths():
+    """
+    Makes two months of route-stop totals.  In the second month, SEQ 2
+    is unobserved, so it is imputed from the first month, and SEQ 4 is 
+    unobserved and not in the first month, so it stays missing. 
+    
+    returns the records, and the expected imputed values and 
+            IMP_TRIP_STOPS, indexed by MONTH and SEQ
+    """
+    #           month,        seq, observed, value
+    records = [['2015-01-01', 1,   5,        10.0], 
+               ['2015-01-01', 2,   3,         6.0], 
+               ['2015-01-01', 3,   4,         8.0], 
+               ['2015-02-01', 1,   6,        12.0], 
+               ['2015-02-01', 2,   0,       np.nan], 
+               ['2015-02-01', 3,   2,         4.0], 
+               ['2015-02-01', 4,   0,       np.nan]]
+    
+    rows = []
+    for (month, seq, observed, value) in records: 
+        row = {'MONTH'            : pd.Timestamp(month), 
+               'DOW'              : 1, 
+               'TOD'              : '0600-0859', 
+               'AGENCY_ID'        : 'SFMTA', 
+               'ROUTE_SHORT_NAME' : '1', 
+               'DIR'              : 0, 
+               'SEQ'              : seq, 
+               'ROUTE_LONG_NAME'  : 'CALIFORNIA', 
+               'TRIP_HEADSIGN'    : 'Downtown', 
+               'STOPNAME'         : 'Stop %i' % seq, 
+               'STOPNAME_AVL'     : 'STOP %i' % seq, 
+               'TRIP_STOPS'       : 6, 
+               'OBS_TRIP_STOPS'   : observed}
+        for i, col in enumerate(IMPUTE_COLS): 
+            row[col] = value * (i + 1)
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    
+    expected = df.set_index(['MONTH', 'SEQ'])[IMPUTE_COLS].copy()
+    expected['IMP_TRIP_STOPS'] = 0.0
+    source = (pd.Timestamp('2015-01-01'), 2)
+    expected.loc[(pd.Timestamp('2015-02-01'), 2), IMPUTE_COLS] = expected.loc[source, IMPUTE_COLS]
+    expected.loc[(pd.Timestamp('2015-02-01'), 2), 'IMP_TRIP_STOPS'] = 3.0
+    expected.loc[(pd.Timestamp('2015-02-01'), 4), 'IMP_TRIP_STOPS'] = np.nan
+    
+    return df, expected
+    
+    
+def benchmarkImpute():
+    """
+    Runs the imputation of missing trip-stops across two months, and 
+    checks that the unobserved route-stop takes the previous month's 
+    values and observed trip-stops. 
+    """
+    df, expected = makeSyntheticMonths()
+    print ('Checking imputation of %i route-stops over 2 months' % len(df))
+    
+    monthly_file = os.path.join(tempfile.mkdtemp(), 'sfmuni_monthly.h5')
+    store = pd.HDFStore(monthly_file)
+    store.append('rs_tod_observed_only', df, data_columns=True, 
+                 min_itemsize={'TOD' : 10, 'AGENCY_ID' : 10, 'ROUTE_SHORT_NAME' : 32, 
+                               'ROUTE_LONG_NAME' : 32, 'TRIP_HEADSIGN' : 64, 
+                               'STOPNAME' : 64, 'STOPNAME_AVL' : 32})
+    store.close()
+    
+    SFMuniDataAggregator().imputeMissingTripStops(monthly_file)
+    
+    store = pd.HDFStore(monthly_file, mode='r')
+    imputed = store.select('rs_tod')
+    store.close()
+    os.remove(monthly_file)
+    
+    imputed = imputed.set_index(['MONTH', 'SEQ']).sort_index()
+    imputed = imputed[expected.columns].astype('float64')
+    pd.testing.assert_frame_equal(imputed, expected.sort_index())
+    print ('  imputed route-stops: %i' % (imputed['IMP_TRIP_STOPS'] > 0).sum())
+
+
+# main function call
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print (USAGE)
+        print ('Valid benchmarks include: ', VALID_BENCHMARKS)
+        sys.exit(2)
+
+    BENCHMARKS_TO_RUN = sys.argv[1:]
+    for benchmark in BENCHMARKS_TO_RUN:
+        if not (benchmark in VALID_BENCHMARKS):
+            print (benchmark, ' is not a valid benchmark to run')
+            print ('Valid benchmarks include: ', VALID_BENCHMARKS)
+            sys.exit(2)
+
+    if 'stpReader' in BENCHMARKS_TO_RUN:
+        benchmarkSTPReader()
+
+    if 'speeds' in BENCHMARKS_TO_RUN:
+        benchmarkSpeeds()
+
+    if 'join' in BENCHMARKS_TO_RUN:
+        benchmarkJoin()
+
+    if 'runtime' in BENCHMARKS_TO_RUN:
+        benchmarkRuntime()
+
+    if 'perBoarding' in BENCHMARKS_TO_RUN:
+        benchmarkPerBoarding()
+
+    if 'impute' in BENCHMARKS_TO_RUN:
+        benchmarkImpute()
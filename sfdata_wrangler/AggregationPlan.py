@@ -0,0 +1,385 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+
+from StringDictionary import toStrings
+from Utils import getSpeeds
+
+
+def includeAtLevel(maxlevel, level):
+    """
+    True if a field with this maxlevel is included when aggregating
+    to this level. 
+    """
+    if level=='system':
+        return not (maxlevel=='route' or maxlevel=='stop' or maxlevel=='route_stop')
+    elif level=='stop':
+        return not (maxlevel=='route' or maxlevel=='route_stop')
+    elif level=='route':
+        return not (maxlevel=='stop' or maxlevel=='route_stop')
+    return True
+    
+    
+class AggregationPlan():
+    """
+    The column specifications for SFMuniDataAggregator.aggregateTransitRecords(), 
+    compiled for one set of rules, level and weight.  The rules are parsed 
+    once, and each call to aggregate() groups the records and applies
+    all the aggregations in a single pass. 
+    
+    Weighted sums and averages are calculated by summing the product of
+    each field and the weight, and counts of non-zero values by summing 
+    an indicator.  These are calculated in a new frame along with the 
+    input columns, so the caller's frame is not changed. 
+    
+    Aggregating is done in two steps:  partial() groups the records and 
+    keeps the sums and other states, and finish() calculates the output
+    from them.  The states of a finer grouping can be rolled up to a 
+    coarser one with rollUp(), so several grouping sets can be calculated
+    from one pass over the records, as in aggregateGroupingSets(). 
+    """
+    
+    # names of the partial states kept for each outfield, other than 
+    # the outfield itself, and for the number of records in the group
+    SUM      = '__sum__'
+    COUNT    = '__count__'
+    POSITION = '__position__'
+    SIZE     = '__size__'
+    
+    # aggregations that can be rolled up from finer groups, and how 
+    # their states are combined.  Weighted sums and averages are sums
+    # of the weighted products. 
+    ROLLUPS = {'sum'   : 'sum', 
+               'max'   : 'max', 
+               'min'   : 'min', 
+               'mean'  : 'sum', 
+               'first' : 'first', 
+               'last'  : 'last'}
+    
+    # speeds updated after aggregating, if included
+    #    outfield,     distance,      time
+    SPEEDS = [
+        ['RUNSPEED_S', 'SERVMILES_S', 'RUNTIME_S'],     # scheduled speed
+        ['RUNSPEED',   'SERVMILES',   'RUNTIME'],       # actual speed--based on scheduled service miles for consistency
+        ['TOTSPEED_S', 'SERVMILES_S', 'TOTTIME_S'], 
+        ['TOTSPEED',   'SERVMILES',   'TOTTIME']
+        ]
+    
+    def __init__(self, groupby, columnSpecs, level='system', weight=None):
+        """
+        Constructor.  Compiles the column specifications, in the format
+        described in SFMuniDataAggregator.aggregateTransitRecords(). 
+        """
+        self.groupby = list(groupby)
+        self.weight = weight
+        
+        # output columns, in order, with their types
+        self.colorder = list(groupby)
+        self.coltypes = OrderedDict()
+        self.stringLengths = {}
+        
+        # input columns, those multiplied by the weight, and those 
+        # where non-zero values are counted
+        self.inputs = list(groupby)
+        self.weighted = []
+        self.nonzero = []
+        
+        # outfield: (column, method) for the named aggregation
+        self.aggregations = OrderedDict()
+        
+        # outfields divided by the sum of the weights, and those that 
+        # get the number of records
+        self.averages = []
+        self.counts = []
+        
+        for col in columnSpecs:
+            (outfield, infield, aggregation, maxlevel, dtype, stringLength) = col[0:6]
+            
+            # only include those fields with the appropriate maxlevel
+            if not includeAtLevel(maxlevel, level):
+                continue
+            
+            self.colorder.append(outfield)
+            self.coltypes[outfield] = dtype
+            if (dtype=='object'): 
+                self.stringLengths[outfield] = stringLength
+            
+            # these fields get the count of the number of records
+            if aggregation == 'count': 
+                self.counts.append(outfield)
+                continue
+            
+            # skip aggregation if none, or no input field
+            if aggregation == 'none' or infield == 'none': 
+                continue
+            
+            self.addInput(infield)
+            if aggregation == 'wgtSum' or aggregation == 'wgtAvg': 
+                if not infield in self.weighted: 
+                    self.weighted.append(infield)
+                if aggregation == 'wgtAvg': 
+                    self.averages.append(outfield)
+                self.aggregations[outfield] = ('w' + infield, 'sum')
+            elif aggregation == 'count_nonzero': 
+                if not infield in self.nonzero: 
+                    self.nonzero.append(infield)
+                self.aggregations[outfield] = ('nz' + infield, 'sum')
+            else: 
+                self.aggregations[outfield] = (infield, aggregation)
+        
+        # since groupby isn't listed above
+        if 'ROUTE_SHORT_NAME' in groupby:
+            self.stringLengths['ROUTE_SHORT_NAME'] = 32
+        
+        # include the weight when aggregating
+        if weight != None: 
+            self.addInput(weight)
+            self.aggregations[weight] = (weight, 'sum')
+        
+        self.speeds = [speed for speed in self.SPEEDS if speed[0] in self.colorder]
+        
+        
+    def addInput(self, col): 
+        if not col in self.inputs: 
+            self.inputs.append(col)
+            
+            
+    def aggregate(self, df): 
+        """
+        Aggregates the records in df. 
+        
+        returns - an aggregated dataframe, also the stringLengths to facilitate writing
+        """
+        return self.finish(self.partial(df))
+        
+        
+    def partial(self, df, positions=False): 
+        """
+        Groups the records in df, and calculates the sums and other 
+        states that finish() turns into the output.  Means are kept as 
+        a sum and a count, and weighted averages as a weighted sum, so 
+        the states of finer groups can be rolled up to coarser ones. 
+        
+        df        - dataframe to aggregate
+        positions - if True, also keeps the position of the first or last 
+                    value in df for each 'first' or 'last' field, which is
+                    needed to roll them up
+        
+        returns a dataframe of states, indexed by the groupby columns
+        """
+        
+        # the input columns and weighted products, without changing df
+        columns = OrderedDict()
+        for col in self.inputs: 
+            columns[col] = df[col].values
+        for col in self.weighted: 
+            columns['w' + col] = df[self.weight].values * df[col].values
+        for col in self.nonzero: 
+            columns['nz' + col] = (df[col].values != 0).astype('int64')
+            
+        states = OrderedDict()
+        for outfield, (infield, aggregation) in self.aggregations.items(): 
+            if aggregation == 'mean': 
+                states[self.SUM + outfield] = (infield, 'sum')
+                states[self.COUNT + outfield] = (infield, 'count')
+            else: 
+                states[outfield] = (infield, aggregation)
+                
+            if positions and (aggregation == 'first' or aggregation == 'last'): 
+                position = np.where(pd.notnull(df[infield]).values, 
+                                    np.arange(len(df), dtype='float64'), np.nan)
+                columns[self.POSITION + outfield] = position
+                states[self.POSITION + outfield] = (self.POSITION + outfield, 
+                        'min' if aggregation == 'first' else 'max')
+        
+        work = pd.DataFrame(columns, index=df.index)
+        
+        # group, keeping only the combinations of categorical 
+        # columns that are observed
+        grouped = work.groupby(self.groupby, observed=True)
+        if len(states) > 0: 
+            partial = grouped.agg(**states)
+        else: 
+            partial = pd.DataFrame(index=grouped.size().index)
+        partial[self.SIZE] = grouped.size()
+        
+        return partial
+        
+        
+    def canRollUpFrom(self, fine): 
+        """
+        True if this plan can be calculated from the partial states of 
+        the fine plan, which must group by all the same columns, use the
+        same weight, and include each of the same aggregations.  Only 
+        sums, counts, means, minimums, maximums, and first and last values
+        can be rolled up. 
+        """
+        if not set(self.groupby) <= set(fine.groupby) or self.weight != fine.weight: 
+            return False
+        for outfield, (infield, aggregation) in self.aggregations.items(): 
+            if not aggregation in self.ROLLUPS: 
+                return False
+            if fine.aggregations.get(outfield) != (infield, aggregation): 
+                return False
+        return True
+        
+        
+    def rollUp(self, partial): 
+        """
+        Rolls up the partial states of a finer grouping, as returned by 
+        partial(df, positions=True) of a plan that canRollUpFrom() 
+        accepts, to the groupby of this plan.  Gives the same states as 
+        calculating them from the records, except for rounding in the sums. 
+        
+        returns a dataframe of states, indexed by the groupby columns
+        """
+        states = OrderedDict()
+        ordered = []
+        for outfield, (infield, aggregation) in self.aggregations.items(): 
+            if aggregation == 'mean': 
+                states[self.SUM + outfield] = (self.SUM + outfield, 'sum')
+                states[self.COUNT + outfield] = (self.COUNT + outfield, 'sum')
+            elif aggregation == 'first' or aggregation == 'last': 
+                ordered.append((outfield, aggregation))
+            else: 
+                states[outfield] = (outfield, self.ROLLUPS[aggregation])
+        states[self.SIZE] = (self.SIZE, 'sum')
+        
+        grouped = partial.groupby(level=self.groupby, observed=True)
+        rolled = grouped.agg(**states)
+        
+        # the first or last value is the one from the earliest or latest
+        # position in the records
+        for outfield, aggregation in ordered: 
+            position = self.POSITION + outfield
+            sortedStates = partial[[outfield, position]].sort_values(position, kind='mergesort')
+            grouped = sortedStates.groupby(level=self.groupby, observed=True)
+            if aggregation == 'first': 
+                firstOrLast = grouped.first()
+            else: 
+                firstOrLast = grouped.last()
+            rolled[outfield] = firstOrLast[outfield]
+            rolled[position] = firstOrLast[position]
+        
+        return rolled
+        
+        
+    def finish(self, partial): 
+        """
+        Calculates the output from the partial states. 
+        
+        returns - an aggregated dataframe, also the stringLengths to facilitate writing
+        """
+        aggregated = pd.DataFrame(index=partial.index)
+        for outfield, (infield, aggregation) in self.aggregations.items(): 
+            if aggregation == 'mean': 
+                with np.errstate(divide='ignore', invalid='ignore'): 
+                    aggregated[outfield] = (partial[self.SUM + outfield].values 
+                                          / partial[self.COUNT + outfield].values)
+            else: 
+                aggregated[outfield] = partial[outfield]
+        
+        # for any average fields, divide by the sum of the weights
+        for col in self.averages:
+            aggregated[col] = (aggregated[col]).values / (aggregated[self.weight]).values
+        
+        # add count fields
+        for field in self.counts: 
+            aggregated[field] = partial[self.SIZE]
+        
+        for (speed, distance, time) in self.speeds: 
+            aggregated[speed] = getSpeeds(aggregated[distance], aggregated[time])
+            
+        # force the data types
+        # this doesn't work if there are missing values, hence the pass
+        for col in self.coltypes: 
+            try: 
+                aggregated[col] = aggregated[col].astype(self.coltypes[col])
+            except TypeError:
+                pass
+            except ValueError: 
+                pass
+                                                                                        
+        # clean up structure of dataframe
+        aggregated = aggregated.sort_index()
+        aggregated = aggregated.reset_index()     
+        aggregated = aggregated[self.colorder]       
+        
+        # write categoricals as plain strings
+        aggregated = toStrings(aggregated)
+
+        return aggregated, dict(self.stringLengths)
+        
+        
+def aggregateGroupingSets(df, plans): 
+    """
+    Aggregates the records in df to several grouping sets at once, such 
+    as route-stops and stops by time-of-day and by day.  Each set is 
+    rolled up from the smallest set already calculated that includes 
+    its groupby columns, if its plan allows, rather than from the records. 
+    
+    A set is only rolled up if the columns it drops have no missing 
+    values, since those records are not in the finer groups. 
+    
+    df    - dataframe to aggregate
+    plans - list of AggregationPlan, one for each grouping set.  Finer
+            sets should come before the coarser sets they can be rolled 
+            up to. 
+    
+    returns a list of (aggregated dataframe, stringLengths) for each plan
+    """
+    complete = {}
+    calculated = []
+    results = []
+    for plan in plans: 
+        
+        # the smallest set already calculated that this one can use
+        source = None
+        for finePlan, finePartial in calculated: 
+            if not plan.canRollUpFrom(finePlan): 
+                continue
+            dropped = [col for col in finePlan.groupby if not col in plan.groupby]
+            for col in dropped: 
+                if not col in complete: 
+                    complete[col] = pd.notnull(df[col]).all()
+            if not all([complete[col] for col in dropped]): 
+                continue
+            if source is None or len(finePartial) < len(source): 
+                source = finePartial
+        
+        if source is None: 
+            partial = plan.partial(df, positions=True)
+        else: 
+            partial = plan.rollUp(source)
+        
+        calculated.append((plan, partial))
+        results.append(plan.finish(partial))
+        
+    return results
+        
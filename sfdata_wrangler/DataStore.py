@@ -0,0 +1,461 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import sys
+import shutil
+import datetime
+import operator
+
+import pandas as pd
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# file extension that selects the parquet backend
+PARQUET_EXTENSION = '.parquet'
+
+
+def isParquet(filename):
+    """
+    True if the file name is for a parquet store, rather than HDF5
+    """
+    return filename.endswith(PARQUET_EXTENSION)
+
+
+def openStore(filename, mode='a'):
+    """
+    Opens a data store, choosing the backend from the file name.  Files
+    ending in .parquet are written as a directory of parquet datasets,
+    and everything else is an HDF5 file.  Both have the same interface,
+    so the rest of the pipeline does not need to know which is used.
+
+    filename - name of the store
+    mode     - 'a' to read and write, or 'r' to read only
+    """
+    if isParquet(filename):
+        return ParquetStore(filename, mode=mode)
+    else:
+        return pd.HDFStore(filename, mode=mode)
+
+
+def storeExists(filename):
+    """
+    True if the store has been written
+    """
+    if isParquet(filename):
+        return os.path.isdir(filename)
+    else:
+        return os.path.isfile(filename)
+
+
+def removeStore(filename):
+    """
+    Deletes the store, if it exists
+    """
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    elif os.path.isfile(filename):
+        os.remove(filename)
+
+
+# number of rows to sample when estimating the size of each column
+PROJECTION_SAMPLE_ROWS = 1000
+
+
+def getProjection(store, key, needed, stage=''):
+    """
+    Gets the list of columns to read from a table, keeping only those
+    that are needed and actually stored, in the order they are stored.
+    Prints an estimate of the bytes saved by not reading the others,
+    based on a sample of rows.
+
+    store  - open store, as returned by openStore()
+    key    - name of the table
+    needed - list of columns used by the caller.  Those that are not in
+             the table, such as fields calculated after reading, are skipped.
+    stage  - name of the processing stage, for the report
+
+    returns a list of column names, to pass as columns= to select()
+    """
+    sample = store.select(key, stop=PROJECTION_SAMPLE_ROWS)
+    projection = [col for col in sample.columns if col in set(needed)]
+
+    if len(sample) > 0:
+        nrows = store.get_storer(key).nrows
+        colBytes = sample.memory_usage(index=False, deep=True) / float(len(sample))
+        fullBytes = colBytes.sum() * nrows
+        savedBytes = fullBytes - colBytes[projection].sum() * nrows
+        print('  %s: reading %i of %i columns of %s saves %.1f of %.1f MB'
+              % (stage, len(projection), len(sample.columns), key,
+                 savedBytes / 1e6, fullBytes / 1e6))
+
+    return projection
+
+
+# comparisons allowed in where clauses, and their names in pyarrow filters
+OPERATORS = {'==' : (operator.eq, '=='),
+             '='  : (operator.eq, '=='),
+             '!=' : (operator.ne, '!='),
+             '>=' : (operator.ge, '>='),
+             '<=' : (operator.le, '<='),
+             '>'  : (operator.gt, '>'),
+             '<'  : (operator.lt, '<')}
+
+TERM_PATTERN = re.compile(r'^\s*(\w+)\s*(==|!=|>=|<=|=|>|<)\s*(.+?)\s*$')
+
+
+class ParquetStore():
+    """
+    A data store that keeps each table as a set of parquet files, with
+    the same interface as the parts of pd.HDFStore used in the pipeline.
+
+    The store is a directory, and each key is a sub-directory with one
+    parquet file for each call to append.  With the year in the file
+    name and the month and day of week in the key, this gives a
+    dataset partitioned by year/month/dow.
+
+    The where clauses used with HDFStore are supported for simple
+    comparisons joined by &, such as 'DATE==Timestamp(date)'.  As with
+    HDFStore, names in the clause are looked up in the local variables
+    of the function that calls select() or remove(), unless a scope is
+    given.  A helper that passes along a where clause built by its own
+    caller must pass that scope too.  The comparisons are passed to the
+    parquet reader as filters, so row groups that can't match are skipped.
+    """
+
+    # name of the column used to keep the index
+    INDEX_COLUMN = '__index__'
+
+    def __init__(self, filename, mode='a'):
+        """
+        Constructor.
+
+        filename - directory for the store
+        mode     - 'a' to read and write, or 'r' to read only
+        """
+        if pq is None:
+            raise ImportError('pyarrow is needed to read and write '
+                              + PARQUET_EXTENSION + ' stores')
+
+        self.filename = filename
+        self.mode = mode
+
+        if mode=='r':
+            if not os.path.isdir(filename):
+                raise IOError('Store does not exist: ' + filename)
+        elif not os.path.isdir(filename):
+            os.makedirs(filename)
+
+
+    def close(self):
+        """
+        Nothing to close, since each file is written as it is appended.
+        """
+        pass
+
+
+    def keys(self):
+        """
+        Returns the keys in the store, with a leading / as in HDFStore.
+        """
+        keys = []
+        for name in sorted(os.listdir(self.filename)):
+            if os.path.isdir(os.path.join(self.filename, name)):
+                keys.append('/' + name)
+        return keys
+
+
+    def __contains__(self, key):
+        return '/' + key.lstrip('/') in self.keys()
+
+
+    def __getitem__(self, key):
+        return self.select(key)
+
+
+    def get(self, key):
+        return self.select(key)
+
+
+    def append(self, key, df, data_columns=None, min_itemsize=None, **kwargs):
+        """
+        Appends the dataframe to the table as a new parquet file.
+        data_columns and min_itemsize are accepted for consistency with
+        HDFStore, but not needed since every column can be filtered and
+        strings have no fixed width.
+        """
+        if self.mode=='r':
+            raise IOError('Store is read only: ' + self.filename)
+
+        keydir = self.getKeyDir(key)
+        if not os.path.isdir(keydir):
+            os.makedirs(keydir)
+
+        parts = self.getParts(key)
+        partfile = os.path.join(keydir, 'part-%05i.parquet' % len(parts))
+
+        table = pa.Table.from_pandas(self.indexToColumn(df), preserve_index=False)
+        pq.write_table(table, partfile)
+
+
+    def remove(self, key, where=None, scope=None):
+        """
+        Removes the table, or if a where clause is given, only the rows
+        that match it.
+
+        key   - name of the table
+        where - where clause, as used in HDFStore
+        scope - dictionary of the names used in the where clause.  If
+                None, the local variables of the caller are used.
+        """
+        keydir = self.getKeyDir(key)
+        if not os.path.isdir(keydir):
+            return
+
+        if where is None:
+            shutil.rmtree(keydir)
+            return
+
+        if scope is None:
+            scope = sys._getframe(1).f_locals
+        terms = self.parseWhere(where, scope)
+        for partfile in self.getParts(key):
+            df = self.columnToIndex(pq.read_table(partfile).to_pandas())
+            keep = ~self.getMask(df, terms)
+            if keep.all():
+                continue
+            table = pa.Table.from_pandas(self.indexToColumn(df[keep]), preserve_index=False)
+            pq.write_table(table, partfile)
+
+
+    def create_table_index(self, key, **kwargs):
+        """
+        Nothing to index, since the parquet files keep statistics for
+        each row group.  Accepted for consistency with HDFStore.
+        """
+        pass
+
+
+    def get_storer(self, key):
+        """
+        Returns an object with the number of rows in the table, as nrows.
+        """
+        return ParquetStorer(self.getParts(key))
+
+
+    def select(self, key, where=None, columns=None, start=None, stop=None,
+               chunksize=None, scope=None):
+        """
+        Reads the table.
+
+        key       - name of the table
+        where     - where clause, as used in HDFStore
+        columns   - list of columns to read, or None for all
+        start     - first row to read, by position
+        stop      - row to stop before, by position
+        chunksize - if given, returns an iterator of dataframes of up to
+                    this many rows
+        scope     - dictionary of the names used in the where clause.  If
+                    None, the local variables of the caller are used.
+
+        returns a dataframe, or an iterator of dataframes
+        """
+        terms = []
+        if where is not None:
+            if scope is None:
+                scope = sys._getframe(1).f_locals
+            terms = self.parseWhere(where, scope)
+
+        chunks = self.readParts(key, terms, columns, start, stop, chunksize)
+        if chunksize is not None:
+            return chunks
+
+        dfs = list(chunks)
+        if len(dfs)==0:
+            raise KeyError('No object named ' + key + ' in ' + self.filename)
+        return pd.concat(dfs)
+
+
+    def select_column(self, key, column, start=None, stop=None):
+        """
+        Reads a single column as a series.
+        """
+        df = self.select(key, columns=[column], start=start, stop=stop)
+        return df[column]
+
+
+    def readParts(self, key, terms, columns, start, stop, chunksize):
+        """
+        Generator that reads the parquet files for the key, in order,
+        pushing down the where clause as filters.
+        """
+        filters = None
+        if len(terms) > 0:
+            filters = [(self.getColumnName(col), OPERATORS[op][1], value)
+                       for col, op, value in terms]
+
+        readColumns = None
+        if columns is not None:
+            readColumns = [self.INDEX_COLUMN] + [c for c in columns if c!=self.INDEX_COLUMN]
+
+        position = 0
+        found = False
+        for partfile in self.getParts(key):
+            found = True
+            nrows = pq.ParquetFile(partfile).metadata.num_rows
+            partStart = position
+            position += nrows
+
+            # skip files outside the positions requested
+            if start is not None and position <= start:
+                continue
+            if stop is not None and partStart >= stop:
+                break
+
+            table = pq.read_table(partfile, columns=readColumns,
+                                  filters=(filters if start is None and stop is None else None))
+            df = self.columnToIndex(table.to_pandas())
+
+            if start is not None or stop is not None:
+                a = 0 if start is None else max(start - partStart, 0)
+                b = nrows if stop is None else min(stop - partStart, nrows)
+                df = df.iloc[a:b]
+                if len(terms) > 0:
+                    df = df[self.getMask(df, terms)]
+
+            if chunksize is None:
+                yield df
+            else:
+                for i in range(0, len(df), chunksize):
+                    yield df.iloc[i:i+chunksize]
+
+        if not found:
+            raise KeyError('No object named ' + key + ' in ' + self.filename)
+
+
+    def parseWhere(self, where, scope):
+        """
+        Parses a where clause into a list of (column, operator, value)
+        terms.  Values are evaluated in the given scope, with Timestamp
+        available as in HDFStore.  Raises a ValueError if a value names
+        a variable that isn't in the scope.
+        """
+        if isinstance(where, (list, tuple)):
+            where = ' & '.join(where)
+
+        terms = []
+        for term in where.split('&'):
+            match = TERM_PATTERN.match(term)
+            if match is None:
+                raise ValueError('Cannot parse where clause: ' + where)
+            col, op, valueString = match.groups()
+
+            try:
+                value = eval(valueString,
+                             {'Timestamp' : pd.Timestamp, 'datetime' : datetime},
+                             scope)
+            except NameError as e:
+                raise ValueError('Cannot evaluate where clause term '
+                                 + term.strip() + ': ' + str(e))
+            if isinstance(value, (np.datetime64, datetime.datetime, datetime.date)):
+                value = pd.Timestamp(value)
+
+            terms.append((col, op, value))
+        return terms
+
+
+    def getMask(self, df, terms):
+        """
+        Gets a boolean mask of the rows in df that match all the terms.
+        """
+        mask = np.ones(len(df), dtype='bool')
+        for col, op, value in terms:
+            if col=='index':
+                values = df.index
+            else:
+                values = df[col]
+            mask &= np.asarray(OPERATORS[op][0](values, value))
+        return mask
+
+
+    def getColumnName(self, col):
+        """
+        Gets the name of the column in the parquet file, where the index
+        is kept in a column.
+        """
+        if col=='index':
+            return self.INDEX_COLUMN
+        return col
+
+
+    def indexToColumn(self, df):
+        """
+        Copies the index into a column, so it is kept in the parquet file.
+        """
+        df = df.copy()
+        df[self.INDEX_COLUMN] = df.index.values
+        return df
+
+
+    def columnToIndex(self, df):
+        """
+        Restores the index from the column where it was kept.
+        """
+        df = df.set_index(self.INDEX_COLUMN)
+        df.index.name = None
+        return df
+
+
+    def getKeyDir(self, key):
+        return os.path.join(self.filename, key.lstrip('/'))
+
+
+    def getParts(self, key):
+        """
+        Gets the list of parquet files written for this key, in order.
+        """
+        keydir = self.getKeyDir(key)
+        if not os.path.isdir(keydir):
+            return []
+        return [os.path.join(keydir, name) for name in sorted(os.listdir(keydir))
+                if name.endswith(PARQUET_EXTENSION)]
+
+
+class ParquetStorer():
+    """
+    Stands in for the storer returned by HDFStore.get_storer, which is
+    used to get the number of rows without reading the table.
+    """
+
+    def __init__(self, parts):
+        self.nrows = sum([pq.ParquetFile(part).metadata.num_rows for part in parts])
@@ -27,12 +27,15 @@ import pandas as pd
 import numpy as np
 import datetime
 
+import os
 import sys
 import transitfeed  
 from pyproj import Proj
 from shapely.geometry import Point, LineString  
             
 from SFMuniDataAggregator import SFMuniDataAggregator
+from Utils import getWrapAroundTimes
+from DataStore import openStore
 
                                     
 def convertLongitudeLatitudeToXY(lon_lat):        
@@ -62,28 +65,6 @@ def convertLongitudeLatitudeToXY(lon_lat):
         
     
                     
-def getWrapAroundTime(dateString, timeString):
-    """
-    Converts a string in the format '%H:%M:%S' to a datetime object.
-    Accounts for the convention where service after midnight is counted
-    with the previous day, so input times can be >24 hours. 
-    """        
-    nextDay = False
-    hr, min, sec = timeString.split(':')
-    if int(hr)>= 24:
-        hr = str(int(hr) - 24)
-        timeString = hr + ':' + min + ':' + sec
-        nextDay = True
-        
-    datetimeString = dateString + ' ' + timeString    
-    time = pd.to_datetime(datetimeString, format='%Y-%m-%d %H:%M:%S')
-        
-    if nextDay: 
-       time = time + pd.DateOffset(days=1)
-    
-    return time
-        
-
 def calculateHeadways(df):
     """
     Calculates the headways for a group. Assumes data are grouped by: 
@@ -144,6 +125,14 @@ class GTFSHelper():
         'STOP_ID'         : 10,  
         'SERVICE_ID'      : 10,  
         }
+    
+    # table in the GTFS store with the service periods active on each date
+    CALENDAR_KEY = 'calendar'
+    CALENDAR_STRING_LENGTHS = {
+        'GTFS_FILE'       : 64, 
+        'SCHED_DATES'     : 20, 
+        'SERVICE_ID'      : 10
+        }
 
     def __init__(self):
         """
@@ -166,9 +155,11 @@ class GTFSHelper():
         them in an HDF format.   
         """
         
-        outstore = pd.HDFStore(outfile) 
+        outstore = openStore(outfile) 
         if '/' + outkey in outstore.keys(): 
             outstore.remove(outkey)
+        if '/' + self.CALENDAR_KEY in outstore.keys(): 
+            outstore.remove(self.CALENDAR_KEY)
            
         startIndex = 0
         
@@ -176,6 +167,11 @@ class GTFSHelper():
             print ('\n\nReading ', infile)
             
             self.establishTransitFeed(infile)
+            
+            # save the calendar, so it can be used without loading the feed
+            outstore.append(self.CALENDAR_KEY, self.getServiceCalendar(infile), 
+                data_columns=True, min_itemsize=self.CALENDAR_STRING_LENGTHS)
+            
             servicePeriods = self.schedule.GetServicePeriodList()        
             for period in servicePeriods:   
                 
@@ -189,6 +185,62 @@ class GTFSHelper():
         outstore.close()
 
     
+    def getServiceCalendar(self, gtfs_file):
+        """
+        Gets the service periods active on each date of the feed that
+        is loaded.  
+        
+        gtfs_file - the file the feed was loaded from, to identify it
+        
+        returns a dataframe with one row for each date and service period, 
+                and the columns GTFS_FILE, SCHED_DATES, DATE and SERVICE_ID
+        """
+        gtfsDateRange = self.schedule.GetDateRange()        
+        gtfsStartDate = pd.to_datetime(gtfsDateRange[0], format='%Y%m%d')
+        gtfsEndDate   = pd.to_datetime(gtfsDateRange[1], format='%Y%m%d')
+        dateRangeString = str(gtfsDateRange[0]) + '-' + str(gtfsDateRange[1])
+        
+        # note that the last date is not included, hence the +1 increment
+        servicePeriodsEachDate = self.schedule.GetServicePeriodsActiveEachDate(gtfsStartDate, gtfsEndDate + pd.DateOffset(days=1)) 
+        
+        records = []
+        for date, servicePeriodsForDate in servicePeriodsEachDate: 
+            for period in servicePeriodsForDate: 
+                records.append([os.path.basename(gtfs_file), dateRangeString, 
+                                pd.Timestamp(date), 
+                                str(period.service_id).strip().upper()])
+        
+        calendar = pd.DataFrame(records, columns=['GTFS_FILE', 'SCHED_DATES', 'DATE', 'SERVICE_ID'])
+        calendar['DATE'] = pd.to_datetime(calendar['DATE'])
+        return calendar
+        
+        
+    def readServiceCalendar(self, store, gtfs_file): 
+        """
+        Reads the service periods active on each date for the GTFS file
+        from the calendar table in the store.  If the calendar for this 
+        file has not been saved, loads the feed to get it, and adds 
+        it to the store. 
+        
+        store     - open GTFS store, as written by processFiles()
+        gtfs_file - GTFS file to get the calendar for
+        
+        returns a dataframe as in getServiceCalendar()
+        """
+        name = os.path.basename(gtfs_file)
+        if '/' + self.CALENDAR_KEY in store.keys(): 
+            calendar = store.select(self.CALENDAR_KEY)
+            calendar = calendar[calendar['GTFS_FILE']==name]
+            if len(calendar) > 0: 
+                return calendar
+        
+        self.establishTransitFeed(gtfs_file)
+        calendar = self.getServiceCalendar(gtfs_file)
+        store.append(self.CALENDAR_KEY, calendar, data_columns=True, 
+                     min_itemsize=self.CALENDAR_STRING_LENGTHS)
+        return calendar
+        
+    
     def createDailySystemTotals(self, infiles, outfile, inkey, outkey):
         """
         Converts from the detailed schedule information to the 
@@ -196,7 +248,7 @@ class GTFSHelper():
         
         """
         
-        outstore = pd.HDFStore(outfile) 
+        outstore = openStore(outfile) 
         if '/' + outkey in outstore.keys(): 
             outstore.remove(outkey)
 
@@ -263,8 +315,8 @@ class GTFSHelper():
         detailed_df = instore.get(inkey)
         aggregator = SFMuniDataAggregator()        
         AGGREGATION_RULES = [            
-           	['TRIPS'        ,'TRIP_ID'     ,aggregator.countUnique, 'system', 'int64', 0],
-           	['STOPS'        ,'STOP_ID'     ,aggregator.countUnique, 'system', 'int64', 0],
+           	['TRIPS'        ,'TRIP_ID'     ,'nunique',  'system', 'int64', 0],
+           	['STOPS'        ,'STOP_ID'     ,'nunique',  'system', 'int64', 0],
            	['TRIP_STOPS'   ,'TRIP_STOPS'  ,'sum',  'system', 'int64', 0],
            	['FARE'         ,'FARE'        ,'mean', 'system', 'float64', 0],
            	['HEADWAY_S'    ,'HEADWAY_S'   ,'mean', 'system', 'float64', 0],
@@ -291,7 +343,7 @@ class GTFSHelper():
         
         print ('Calculating monthly totals')
         
-        outstore = pd.HDFStore(outfile) 
+        outstore = openStore(outfile) 
         if '/' + outkey in outstore.keys(): 
             outstore.remove(outkey)
 
@@ -368,6 +420,13 @@ class GTFSHelper():
                     if (use_shape_dist): 
                         shapeLine = self.getShapeLine(trip.shape_id, stopTimeList)
                                                 
+                    # deal with wrap-around aspect of time (past midnight >2400)
+                    # converting all the stops on the trip at once
+                    arrivalTimes = pd.to_datetime(getWrapAroundTimes(startDate, 
+                                    [stopTime.arrival_secs for stopTime in stopTimeList]))
+                    departureTimes = pd.to_datetime(getWrapAroundTimes(startDate, 
+                                    [stopTime.departure_secs for stopTime in stopTimeList]))
+                    
                     # initialize for looping
                     i = 0        
                     lastDepartureTime = startDate
@@ -445,9 +504,8 @@ class GTFSHelper():
                         record['EOL']              = endOfLine
                             
                         # stop times        
-                        # deal with wrap-around aspect of time (past midnight >2400)
-                        arrivalTime = getWrapAroundTime(str(startDate.date()), stopTime.arrival_time)
-                        departureTime = getWrapAroundTime(str(startDate.date()), stopTime.departure_time)
+                        arrivalTime = arrivalTimes[i]
+                        departureTime = departureTimes[i]
                         if startOfLine or endOfLine: 
                             dwellTime = 0.0
                         else: 
@@ -0,0 +1,144 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+
+"""
+Methods for joining tables on several key columns by encoding the keys 
+as a single int64, which can be sorted and searched much faster than 
+the separate columns, especially when some are strings. 
+"""
+
+
+class KeyEncoder():
+    """
+    Encodes the combination of several key columns as a single int64.  
+    The codes for each column come from the values in the table the 
+    encoder is built from, so the keys for that table are calculated 
+    once and other tables are encoded to match.  Rows with values that
+    are not in the original table get a key of -1, so they never match. 
+    """
+    
+    def __init__(self, df, columns):
+        """
+        Constructor.  Encodes the keys for df. 
+        
+        df      - dataframe to build the encoder from
+        columns - list of key columns
+        """
+        self.columns = list(columns)
+        self.values = []
+        
+        combinations = 1
+        for col in self.columns: 
+            uniques = pd.unique(df[col].dropna())
+            self.values.append(pd.Index(uniques))
+            combinations *= max(len(uniques), 1)
+            
+        if combinations >= 2**62: 
+            raise ValueError('Too many combinations of ' + str(self.columns) 
+                             + ' to encode as int64')
+        
+        self.keys = self.encode(df)
+        self.nbytes = self.keys.nbytes
+        
+        
+    def encode(self, df): 
+        """
+        Encodes the key columns of df.  
+        
+        returns an int64 array of keys, with -1 where any of the values
+                is missing or not in the original table
+        """
+        keys = np.zeros(len(df), dtype='int64')
+        missing = np.zeros(len(df), dtype='bool')
+        for col, values in zip(self.columns, self.values): 
+            codes = values.get_indexer(df[col])
+            missing |= (codes < 0)
+            keys = keys * max(len(values), 1) + codes
+        
+        keys[missing] = -1
+        return keys
+        
+        
+def leftJoinOnKeys(left, right, leftKeys, rightKeys, on, suffix='_AVL'): 
+    """
+    Left join of right to left, matching rows where the keys are equal.  
+    Keys of -1 never match.  As with pd.merge(how='left'), rows of left
+    with several matches are repeated, and those with none get missing 
+    values.  The key columns are taken from left, and the other columns
+    of right that are also in left get the suffix. 
+    
+    The right keys are sorted and searched, and the result is in the
+    order of left, so neither table needs to be sorted by the key columns. 
+    
+    left      - dataframe to keep all the rows of
+    right     - dataframe to join to it
+    leftKeys  - int64 array of keys for left, as from KeyEncoder
+    rightKeys - int64 array of keys for right, encoded the same way
+    on        - list of key columns, which are not copied from right
+    suffix    - added to right columns that are also in left
+    
+    returns the joined dataframe, with a new index
+    """
+    leftKeys = np.asarray(leftKeys, dtype='int64')
+    rightKeys = np.asarray(rightKeys, dtype='int64')
+    
+    # the range of matching rows in right, for each row in left
+    order = np.argsort(rightKeys, kind='mergesort')
+    sortedKeys = rightKeys[order]
+    start = np.searchsorted(sortedKeys, leftKeys, side='left')
+    stop = np.searchsorted(sortedKeys, leftKeys, side='right')
+    counts = np.where(leftKeys < 0, 0, stop - start)
+    
+    # one output row for each match, or for each left row with none
+    repeats = np.maximum(counts, 1)
+    leftPositions = np.repeat(np.arange(len(left)), repeats)
+    firstRow = np.cumsum(repeats) - repeats
+    offset = np.arange(len(leftPositions)) - np.repeat(firstRow, repeats)
+    matched = np.repeat(counts, repeats) > 0
+    sortedPositions = np.minimum(np.repeat(start, repeats) + offset, 
+                                 max(len(order) - 1, 0))
+    if len(order) > 0: 
+        rightPositions = np.where(matched, order[sortedPositions], -1)
+    else: 
+        rightPositions = np.full(len(leftPositions), -1, dtype='int64')
+    
+    joined = left.iloc[leftPositions].reset_index(drop=True)
+    
+    columns = OrderedDict()
+    for col in right.columns: 
+        if col in on: 
+            continue
+        name = col + suffix if col in left.columns else col
+        columns[name] = pd.api.extensions.take(right[col].values, rightPositions, 
+                                               allow_fill=True)
+    rightColumns = pd.DataFrame(columns, index=joined.index)
+    
+    return pd.concat([joined, rightColumns], axis=1)
+    
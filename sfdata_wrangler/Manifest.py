@@ -0,0 +1,166 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import hashlib
+
+
+class Manifest():
+    """
+    Keeps track of what each processing step has already done, so that
+    reruns can process only the inputs that are new or have changed.
+
+    Each step has its own section, with an entry for each input.  An
+    entry records the content hash of the input, along with whatever
+    the step needs to know to replace its outputs, such as the output
+    file, the index range written or the dates covered.
+
+    The manifest is saved as a JSON file.
+    """
+
+    # number of bytes to read at a time when hashing
+    BLOCKSIZE = 16 * 1024 * 1024
+
+    def __init__(self, filename):
+        """
+        Constructor.  Reads the existing manifest, if there is one.
+
+        filename - JSON file to read and write
+        """
+        self.filename = filename
+        self.data = {}
+
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                self.data = json.load(f)
+
+
+    def save(self):
+        """
+        Writes the manifest, replacing the file in one step so an
+        interrupted run doesn't leave a partial manifest.
+        """
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+        os.rename(tmpfile, self.filename)
+
+
+    def getFileHash(self, infile):
+        """
+        Returns the content hash of a file.  If the size and modification
+        time match what is already recorded for this file, the recorded
+        hash is re-used rather than reading the whole file again.
+
+        For a directory, such as a parquet store, returns a hash of
+        the names and hashes of all the files in it.
+        """
+        if os.path.isdir(infile):
+            md5 = hashlib.md5()
+            for root, dirs, files in sorted(os.walk(infile)):
+                for name in sorted(files):
+                    filename = os.path.join(root, name)
+                    md5.update(os.path.relpath(filename, infile).encode('utf-8'))
+                    md5.update(self.getFileHash(filename).encode('utf-8'))
+            return md5.hexdigest()
+
+        stat = os.stat(infile)
+        known = self.data.get('files', {}).get(infile)
+        if (known != None and known['size']==stat.st_size
+            and known['mtime']==stat.st_mtime):
+            return known['hash']
+
+        md5 = hashlib.md5()
+        with open(infile, 'rb') as f:
+            block = f.read(self.BLOCKSIZE)
+            while block:
+                md5.update(block)
+                block = f.read(self.BLOCKSIZE)
+        fileHash = md5.hexdigest()
+
+        files = self.data.setdefault('files', {})
+        files[infile] = {'size'  : stat.st_size,
+                         'mtime' : stat.st_mtime,
+                         'hash'  : fileHash}
+        return fileHash
+
+
+    def getEntry(self, step, key):
+        """
+        Returns the entry recorded for this key in this step, or None.
+        """
+        return self.data.get(step, {}).get(key)
+
+
+    def getEntries(self, step):
+        """
+        Returns a dictionary of all entries recorded in this step.
+        """
+        return self.data.get(step, {})
+
+
+    def setEntry(self, step, key, entry):
+        """
+        Records the entry for this key in this step.
+
+        entry - dictionary that can be written as JSON.  Should include
+                a 'hash' with the content hash of the input.
+        """
+        self.data.setdefault(step, {})[key] = entry
+
+
+    def removeEntry(self, step, key):
+        """
+        Removes the entry for this key in this step, if there is one.
+        """
+        if key in self.data.get(step, {}):
+            del self.data[step][key]
+
+
+    def isCurrent(self, step, key, inputHash):
+        """
+        True if this key has already been processed in this step, with
+        an input that has the same hash.
+        """
+        entry = self.getEntry(step, key)
+        return entry != None and entry.get('hash')==inputHash
+
+
+    def getValue(self, name, default=None):
+        """
+        Gets a value that applies across the whole manifest.
+        """
+        return self.data.get('values', {}).get(name, default)
+
+
+    def setValue(self, name, value):
+        """
+        Sets a value that applies across the whole manifest.
+        """
+        self.data.setdefault('values', {})[name] = value
+
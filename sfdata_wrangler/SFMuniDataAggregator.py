@@ -27,6 +27,42 @@ import pandas as pd
 import numpy as np
 import datetime
 import os
+import multiprocessing
+from collections import OrderedDict
+
+from DataStore import openStore, getProjection, removeStore
+from SFMuniDataHelper import getShardfile
+from AggregationPlan import AggregationPlan, includeAtLevel, aggregateGroupingSets
+
+
+def aggregateMonthShard(args): 
+    """
+    Worker for aggregating one month into its own shard.  At module
+    level so it can be passed to a process pool. 
+    
+    args - tuple of (method, month, methodArgs, shardfile), where method
+           is the name of the SFMuniDataAggregator method that aggregates
+           one month, called as method(month, *methodArgs)
+    
+    returns an OrderedDict of table name: stringLengths for the tables
+            written
+    """
+    (method, month, methodArgs, shardfile) = args
+    
+    aggregator = SFMuniDataAggregator()
+    tables = getattr(aggregator, method)(month, *methodArgs)
+    
+    # the shard is only read back in full, so it doesn't need an index
+    stringLengths = OrderedDict()
+    store = openStore(shardfile)
+    for table, (aggdf, lengths) in tables.items(): 
+        store.append(table, aggdf, data_columns=True, min_itemsize=lengths, 
+                     index=False)
+        stringLengths[table] = lengths
+    store.close()
+    
+    return stringLengths
+    
 
 #TODO - re-calculate LOAD_ARR and LOAD_DEP after aggregating
                                     
@@ -35,10 +71,33 @@ class SFMuniDataAggregator():
     Deals with aggregating MUNI data to daily and monthly totals.   
     """
 
+    # groupings for the trips and the daily route-stop totals
+    TRIP_GROUPBY = ['DATE','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'TRIP']
+    DAILY_STOP_GROUPBY = ['DATE','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ']
+
+    # monthly tables calculated from rs_tod
+    MONTHLY_STOP_TABLES = ['rs_day', 'stop_tod', 'stop_day']
+    MONTHLY_ROUTE_TABLES = ['route_dir_tod', 'route_dir_day', 'route_tod', 
+                            'route_day', 'system_tod', 'system_day']
+    
+    # The 9X changes to the 8X in Dec 2009 and we're missing the data, 
+    # so the master route is filled in from the next month: 
+    #    (MASTER_ROUTE_NAME, month to fill, month to fill from)
+    MASTER_ROUTE_FILL = ('8', '2009-12-01', '2010-01-01')
 
-    def __init__(self, daily_trip_outfile=None, daily_ts_outfile=None):
+    def __init__(self, daily_trip_outfile=None, daily_ts_outfile=None, 
+                 bufferRows=100000):
         """
         Constructor.                 
+        
+        daily_trip_outfile - store for the daily trip totals, or None
+        daily_ts_outfile   - store for the daily trip-stop totals, or None
+        bufferRows         - number of rows to keep in memory before writing
+                             them in one batch, for rs_tod and for each 
+                             monthly table.  A row of rs_tod takes about 
+                             0.6 KB, so the default of 100000 rows is about
+                             60 MB per table buffered.  The rs_tod table is 
+                             indexed when the aggregator is closed. 
         """        
         
         # count the number of rows in each table so our 
@@ -56,6 +115,18 @@ class SFMuniDataAggregator():
         self.stop_day_count   = 0
         self.system_tod_count_s = 0
         self.system_day_count_s = 0
+        
+        # compiled aggregation plans, by (groupby, columnSpecs, level, weight)
+        self.plans = {}
+        
+        # string lengths of the rs_tod records written
+        self.rs_tod_stringLengths = {}
+        
+        # rs_tod records not yet written
+        self.bufferRows = bufferRows
+        self.rs_tod_buffer = []
+        self.rs_tod_bufferCount = 0
+        self.rs_tod_needsIndex = False
             
         
         self.daily_trip_outfile = daily_trip_outfile
@@ -63,69 +134,119 @@ class SFMuniDataAggregator():
     
         # open the output stores if specified
         if not daily_trip_outfile==None:                     
-            self.trip_outstore = pd.HDFStore(daily_trip_outfile)
+            self.trip_outstore = openStore(daily_trip_outfile)
             
             keys = self.trip_outstore.keys()
             
-            if 'pattern_tod' in keys:
+            if '/pattern_tod' in keys:
                 self.pattern_tod_count = len(self.trip_outstore.select('pattern_tod'))
-            if 'pattern_day' in keys:
+            if '/pattern_day' in keys:
                 self.pattern_day_count = len(self.trip_outstore.select('pattern_day'))
-            if 'route_tod' in keys:
+            if '/route_tod' in keys:
                 self.route_tod_count = len(self.trip_outstore.select('route_tod'))
-            if 'route_tod_tot' in keys:
+            if '/route_tod_tot' in keys:
                 self.route_tod_count = len(self.trip_outstore.select('route_tod_tot'))
-            if 'route_day' in keys:
+            if '/route_day' in keys:
                 self.route_day_count = len(self.trip_outstore.select('route_day'))
-            if 'route_day_tot' in keys:
+            if '/route_day_tot' in keys:
                 self.route_day_count = len(self.trip_outstore.select('route_day_tot'))
-            if 'system_tod' in keys:
+            if '/system_tod' in keys:
                 self.system_tod_count = len(self.trip_outstore.select('system_tod'))
-            if 'system_day' in keys:
+            if '/system_day' in keys:
                 self.system_day_count = len(self.trip_outstore.select('system_day'))            
 
         # open the output stores if specified
         if not daily_ts_outfile==None:                     
-            self.ts_outstore = pd.HDFStore(daily_ts_outfile) 
+            self.ts_outstore = openStore(daily_ts_outfile) 
+            
+            keys = self.ts_outstore.keys()
             
-            if 'rs_tod' in keys:
-                self.rs_tod_count = len(self.trip_outstore.select('rs_tod'))
-            if 'rs_day' in keys:
-                self.rs_day_count = len(self.trip_outstore.select('rs_day'))
-            if 'stop_tod' in keys:
-                self.stop_tod_count = len(self.trip_outstore.select('stop_tod'))
-            if 'stop_day' in keys:
-                self.stop_day_count = len(self.trip_outstore.select('stop_day'))
-            if 'system_tod_s' in keys:
-                self.system_tod_count_s = len(self.trip_outstore.select('system_tod_s'))
-            if 'system_day_s' in keys:
-                self.system_day_count_s = len(self.trip_outstore.select('system_day_s'))      
+            if '/rs_tod' in keys:
+                self.rs_tod_count = len(self.ts_outstore.select('rs_tod'))
+            if '/rs_day' in keys:
+                self.rs_day_count = len(self.ts_outstore.select('rs_day'))
+            if '/stop_tod' in keys:
+                self.stop_tod_count = len(self.ts_outstore.select('stop_tod'))
+            if '/stop_day' in keys:
+                self.stop_day_count = len(self.ts_outstore.select('stop_day'))
+            if '/system_tod_s' in keys:
+                self.system_tod_count_s = len(self.ts_outstore.select('system_tod_s'))
+            if '/system_day_s' in keys:
+                self.system_day_count_s = len(self.ts_outstore.select('system_day_s'))      
                    
     def close(self):
-        self.trip_outstore.close()
-        self.ts_outstore.close()
-
+        """
+        Writes any buffered records, indexes the tables written in 
+        batches, and closes the stores. 
+        """
+        if not self.daily_trip_outfile==None: 
+            self.trip_outstore.close()
+        if not self.daily_ts_outfile==None: 
+            self.flushRouteStopTotals()
+            if self.rs_tod_needsIndex: 
+                self.ts_outstore.create_table_index('rs_tod', optlevel=9, kind='full')
+                self.rs_tod_needsIndex = False
+            self.ts_outstore.close()
 
 
-    def aggregateToTrips(self, df):
+    def appendRouteStopTotals(self, df, stringLengths): 
         """
-        Aggregates the dataframe from trip_stops to trip totals. 
+        Adds route-stop totals to the rs_tod table, assigning unique 
+        indices.  They are kept in memory and written in batches, so 
+        each date doesn't need its own append and index update. 
         
+        df            - rs_tod records to add
+        stringLengths - string lengths of the columns in df
         """
-                    
+        df.index = self.rs_tod_count + pd.Series(range(0,len(df)))
+        self.rs_tod_count += len(df)
+        
+        self.rs_tod_buffer.append(df)
+        self.rs_tod_bufferCount += len(df)
+        for col in stringLengths: 
+            self.rs_tod_stringLengths[col] = max(stringLengths[col], 
+                    self.rs_tod_stringLengths.get(col, 0))
+        
+        if self.rs_tod_bufferCount >= self.bufferRows: 
+            self.flushRouteStopTotals()
+            
+            
+    def flushRouteStopTotals(self): 
+        """
+        Writes the buffered rs_tod records in one append, leaving the 
+        index to be built when the aggregator is closed. 
+        """
+        if len(self.rs_tod_buffer)==0: 
+            return
+        
+        df = pd.concat(self.rs_tod_buffer)
+        self.ts_outstore.append('rs_tod', df, data_columns=True, 
+                min_itemsize=self.rs_tod_stringLengths, index=False)
+        self.rs_tod_needsIndex = True
+        
+        self.rs_tod_buffer = []
+        self.rs_tod_bufferCount = 0
+
+
+
+    def getTripRules(self):
+        """
+        Gets the rules for aggregating trip-stops to trips. 
+        """
+        
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
         #        outfield,            infield,  aggregationMethod,   maxlevel, type, stringLength                
         AGGREGATION_RULES = [              
                 ['MONTH'             ,'MONTH'             ,'first'   ,'trip' ,'datetime64', 0],          
                 ['SCHED_DATES'       ,'SCHED_DATES'       ,'first'   ,'trip' ,'object'    ,20],      
-                ['NUMDAYS'           ,'DATE'        ,self.countUnique,'trip' ,'int64'     , 0],         # stats for observations
+                ['NUMDAYS'           ,'DATE'              ,'nunique' ,'trip' ,'int64'     , 0],         # stats for observations
                 ['TRIPS'             ,'TRIPS'             ,'max'     ,'trip' ,'int64'     , 0], 
                 ['TRIP_STOPS'        ,'TRIP_STOPS'        ,'sum'     ,'trip' ,'int64'     , 0], 
                 ['OBSERVED'          ,'OBSERVED'          ,'max'     ,'trip' ,'int64'     , 0], 
                 ['FIRST_SEQ'         ,'SEQ'               ,'min'     ,'trip' ,'int64'     , 0],         # for determining PATTERN
                 ['LAST_SEQ'          ,'SEQ'               ,'max'     ,'trip' ,'int64'     , 0], 
-                ['NUMSTOPS'          ,'SEQ'         ,self.countUnique,'trip' ,'int64'     , 0],                 
+                ['NUMSTOPS'          ,'SEQ'               ,'nunique' ,'trip' ,'int64'     , 0],                 
                 ['TRIP_ID'           ,'TRIP_ID'           ,'first'   ,'trip' ,'int64'     , 0],         # trip attributes  
                 ['PATTCODE'          ,'PATTCODE'          ,'first'   ,'trip' ,'int64'     , 0],  
                 ['ROUTE_LONG_NAME'   ,'ROUTE_LONG_NAME'   ,'first'   ,'trip' ,'object'    ,32],         # route attributes    
@@ -164,13 +285,22 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'max'     ,'trip' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'sum'     ,'trip' ,'float64'   , 0]  
                 ]
+        return AGGREGATION_RULES
+        
+
+    def aggregateToTrips(self, df):
+        """
+        Aggregates the dataframe from trip_stops to trip totals. 
+        
+        """
+        AGGREGATION_RULES = self.getTripRules()
                             
         # initialize new terms
         df['TRIPS'] = 1                
                             
         # trips
         aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                groupby=['DATE','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'TRIP'], 
+                groupby=self.TRIP_GROUPBY, 
                 columnSpecs=AGGREGATION_RULES, 
                 level='trip', 
                 weight=None)
@@ -191,14 +321,31 @@ class SFMuniDataAggregator():
             rs_tod, rs_day, stop_tod, stop_day, system_tod, system_day
         
         """
-                    
+        STOP_RULES = self.getDailyStopRules()
+
+
+        # route_stops    
+        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
+                groupby=self.DAILY_STOP_GROUPBY, 
+                columnSpecs=STOP_RULES, 
+                level='route_stop', 
+                weight='TOD_WEIGHT')      
+        self.appendRouteStopTotals(aggdf, stringLengths)
+    
+    
+    def getDailyStopRules(self):
+        """
+        Gets the rules for aggregating weighted trip-stops to daily 
+        route-stop totals. 
+        """
+        
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
         #        outfield,            infield,  aggregationMethod,   maxlevel, type, stringLength                
         STOP_RULES = [              
                 ['MONTH'             ,'MONTH'             ,'first'   ,'system' ,'datetime64', 0],          
                 ['SCHED_DATES'       ,'SCHED_DATES'       ,'first'   ,'system' ,'object'    ,20],       
-                ['NUMDAYS'           ,'DATE'        ,self.countUnique,'system' ,'int64'     , 0],         # stats for observations
+                ['NUMDAYS'           ,'DATE'              ,'nunique' ,'system' ,'int64'     , 0],         # stats for observations
                 ['TRIP_STOPS'        ,'TRIP_STOPS'        ,'sum'     ,'system' ,'int64'     , 0],         #  note: attributes from schedule/gtfs should be unweighted             
                 ['OBS_TRIP_STOPS'    ,'OBSERVED'          ,'sum'     ,'system' ,'int64'     , 0],
                 ['WGT_TRIP_STOPS'    ,'TRIP_STOPS'        ,'wgtSum'  ,'system' ,'float64'   , 0], 
@@ -249,18 +396,22 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'wgtAvg'  ,'system' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'wgtSum'  ,'system' ,'float64'   , 0]  
                 ]
-
-
-        # route_stops    
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                groupby=['DATE','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ'], 
-                columnSpecs=STOP_RULES, 
-                level='route_stop', 
-                weight='TOD_WEIGHT')      
-        aggdf.index = self.rs_tod_count + pd.Series(range(0,len(aggdf)))
-        self.ts_outstore.append('rs_tod', aggdf, data_columns=True, 
-                min_itemsize=stringLengths)          
-        self.rs_tod_count += len(aggdf)
+        return STOP_RULES
+        
+        
+    def getTripStopColumns(self):
+        """
+        Gets the trip-stop columns used by aggregateToTrips() and 
+        aggregateTripStopsByTimeOfDay(), so the expander only derives
+        the metrics that are aggregated. 
+        
+        returns a list of column names
+        """
+        columns = (self.getRequiredColumns(self.TRIP_GROUPBY, self.getTripRules(), 
+                                           level='trip')
+                 + self.getRequiredColumns(self.DAILY_STOP_GROUPBY, self.getDailyStopRules(), 
+                                           level='route_stop', weight='TOD_WEIGHT'))
+        return [col for i, col in enumerate(columns) if not col in columns[:i]]
     
     
     def aggregateTripStopsToMonths(self, daily_file, monthly_file):
@@ -276,8 +427,8 @@ class SFMuniDataAggregator():
         #   output field, but it is calculated separately
         #        outfield,            infield,  aggregationMethod,   maxlevel, type, stringLength                
         STOP_RULES = [              
-                ['NUMDAYS'           ,'DATE'        ,self.countUnique,'system' ,'int64'     , 0],         # stats for observations
-                ['OBSDAYS'           ,'OBS_TRIP_STOPS',np.count_nonzero,'system' ,'int64'     , 0],        
+                ['NUMDAYS'           ,'DATE'              ,'nunique' ,'system' ,'int64'     , 0],         # stats for observations
+                ['OBSDAYS'           ,'OBS_TRIP_STOPS'    ,'count_nonzero','system','int64' , 0],        
                 ['TRIP_STOPS'        ,'TRIP_STOPS'        ,'mean'    ,'system' ,'int64'     , 0],                    
                 ['OBS_TRIP_STOPS'    ,'OBS_TRIP_STOPS'    ,'mean'    ,'system' ,'int64'     , 0],
                 ['WGT_TRIP_STOPS'    ,'WGT_TRIP_STOPS'    ,'mean'    ,'system' ,'float64'   , 0], 
@@ -332,7 +483,7 @@ class SFMuniDataAggregator():
         print('Aggregating trip-stops to month') 
 
         # establish the output file      
-        outstore = pd.HDFStore(monthly_file)
+        outstore = openStore(monthly_file)
         
         # count the number of rows in each table so our 
         # indices are unique
@@ -340,21 +491,28 @@ class SFMuniDataAggregator():
 
                 
         # open the output file
-        instore = pd.HDFStore(daily_file)
+        instore = openStore(daily_file)
         
         # do this month-by-month to save memory
         months = instore.select_column('rs_tod', 'MONTH').unique()
         print('Retrieved a total of %i months to process' % len(months))
+        
+        # read only the columns needed for the aggregation
+        groupby = ['MONTH','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ']
+        columns = getProjection(instore, 'rs_tod', 
+                    self.getRequiredColumns(groupby, STOP_RULES, level='route_stop'), 
+                    stage='trip-stops to months')
+        
         for month in months: 
             print('Processing month ', month)
         
             # route_stops
                   
-            df = instore.select('rs_tod', where='MONTH=Timestamp(month)')                        
+            df = instore.select('rs_tod', where='MONTH=Timestamp(month)', columns=columns)                        
             df.index = pd.Series(range(0,len(df)))                   
                     
             aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ'], 
+                    groupby=groupby, 
                     columnSpecs=STOP_RULES, 
                     level='route_stop', 
                     weight=None)      
@@ -373,6 +531,9 @@ class SFMuniDataAggregator():
         Sometimes, there are no observed trips in a time period for 
         the whole month.  When that happens, impute the values by taking
         the matching value from the previous month. 
+        
+        All months are done in one pass, so values imputed for one month
+        carry forward to the following months without observations. 
         """
         
         stringLengths =  {'AGENCY_ID'       : 10,  
@@ -415,64 +576,230 @@ class SFMuniDataAggregator():
                        ]
         
         # open the output file
-        store = pd.HDFStore(monthly_file)
+        store = openStore(monthly_file)
         
         keys = store.keys()
         if '/rs_tod' in keys: 
             store.remove('rs_tod')
-            
-        # do this month-by-month to match properly
-        months = sorted(store.select_column('rs_tod_observed_only', 'MONTH').unique())
-        print('Imputing missing data for %i months' % len(months))
         
-        prev_month = pd.to_datetime('1900-01-01')
-        for month in months: 
-            print('Processing month ', month)
+        # get all the months at once, so each route-stop can be 
+        # matched to the previous month in one pass
+        df = store.select('rs_tod_observed_only')
+        months = np.sort(df['MONTH'].unique())
+        print('Imputing missing data for %i months' % len(months))
         
-            # get current data
-            df = store.select('rs_tod_observed_only', where='MONTH=Timestamp(month)')  
-            
-            # set imputed trip stops and colums to keep
-            df['IMP_TRIP_STOPS'] = 0.
-            cols = df.columns
-            
-            # so we can skip first month and missing months
-            if prev_month in months: 
-                df_prev = store.select('rs_tod', where='MONTH=Timestamp(prev_month)')  
-                
-                # match
-                df = pd.merge(df, df_prev, 
-                              how='left', 
-                              on=['DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ'], 
-                              suffixes=['', '_PREV'], 
-                              sort=True) 
-                
-                # fill missing values
-                for col in impute_cols: 
-                    df[col] = np.where(df['OBS_TRIP_STOPS']==0, df[col+'_PREV'], df[col])
-                
-                # make sure we know what is imputed
-                df['IMP_TRIP_STOPS'] = np.where(df['OBS_TRIP_STOPS']==0, df['OBS_TRIP_STOPS_PREV'] + df['IMP_TRIP_STOPS_PREV'], 0)
-                                
-            # write the processed data and increment
-            df = df[cols]
-            store.append('rs_tod', df, data_columns=True, 
-                    min_itemsize=stringLengths)
-            
-            prev_month = month
+        # source of the values for each record, as imputed from the 
+        # previous month
+        mergeFields = ['DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ']
+        imputed, source = self.getImputationSource(df, mergeFields, months)
+        
+        # fill missing values
+        for col in impute_cols: 
+            prev = pd.api.extensions.take(df[col].values, source, allow_fill=True)
+            df[col] = np.where(imputed, prev, df[col])
+        
+        # make sure we know what is imputed
+        prev = pd.api.extensions.take(df['OBS_TRIP_STOPS'].values.astype('float64'), 
+                                      source, allow_fill=True)
+        df['IMP_TRIP_STOPS'] = np.where(imputed, prev, 0.)
+        
+        # write the processed data, in batches to limit the extra memory
+        for start in range(0, len(df), self.bufferRows): 
+            store.append('rs_tod', df.iloc[start:start+self.bufferRows], 
+                    data_columns=True, min_itemsize=stringLengths)
     
         store.close()
     
+    
+    def getImputationSource(self, df, mergeFields, months): 
+        """
+        Finds the records to impute, and the record each one takes its 
+        values from.  A record is imputed if it has no observed trip-stops
+        and is not in the first month.  It takes the values of the same
+        route-stop in the previous month, which may themselves have been
+        imputed from the month before.  If the route-stop isn't in the 
+        previous month, the imputed values are missing. 
+        
+        df          - records for all months
+        mergeFields - columns identifying the route-stop in each month
+        months      - sorted array of the months in df
+        
+        returns (imputed, source), where imputed is a boolean array of 
+                the records to impute, and source is an array of the 
+                position of the record to take the values from, or -1 
+                if there is none. 
+        """
+        n = len(df)
+        monthNum = np.searchsorted(months, df['MONTH'].values)
+        routeStop = df.groupby(mergeFields, sort=False).ngroup().values
+        imputed = (df['OBS_TRIP_STOPS'].values==0) & (monthNum > 0)
+        
+        # order by route-stop, then month
+        order = np.lexsort((monthNum, routeStop))
+        sortedRouteStop = routeStop[order]
+        sortedMonth = monthNum[order]
+        sortedImputed = imputed[order]
+        
+        # the previous record is for the same route-stop in the previous month
+        hasPrev = np.zeros(n, dtype='bool')
+        hasPrev[1:] = ((sortedRouteStop[1:]==sortedRouteStop[:-1]) & 
+                       (sortedMonth[1:]==sortedMonth[:-1] + 1))
+        
+        # a record that isn't imputed is its own source.  An imputed record
+        # without a previous record has none, and the others take the source 
+        # of the previous record.  That chain always stops at one of the 
+        # first two within the route-stop, so a forward-fill over the 
+        # sorted records doesn't cross route-stops. 
+        sortedSource = np.where(~sortedImputed, np.arange(n, dtype='float64'), 
+                                np.where(hasPrev, np.nan, -1.))
+        sortedSource = pd.Series(sortedSource).ffill().values.astype('int64')
+        
+        # back to positions in df
+        sortedSource = np.where(sortedSource >= 0, order[np.maximum(sortedSource, 0)], -1)
+        source = np.empty(n, dtype='int64')
+        source[order] = sortedSource
+        
+        return imputed, source
+    
         
-    def aggregateMonthlyTripStops(self, monthly_file):
+    def aggregateMonthlyTripStops(self, monthly_ts_file, monthly_trip_file=None, 
+                                  numWorkers=1):
         """
-        Aggregates daily data to monthly totals for an average weekday/
-        saturday/sunday.  Does this at different levels of aggregation for:
-            rs_tod, rs_day, stop_tod, stop_day, system_tod, system_day
+        Aggregates the monthly route-stops by time-of-day to route-stops 
+        by day, and to stops by time-of-day and by day. 
         
         These are unweighted, because we've already applied weights when
         calculating the daily totals. 
+        
+        If the monthly_trip_file is given, also aggregates the route-stops
+        to routes and totals, as in aggregateMonthlyTrips(), so rs_tod is 
+        read once for all the monthly tables. 
+        
+        This is done one month at a time, so only one month of rs_tod is
+        in memory.  
+        
+        numWorkers - number of processes to use, each aggregating different
+                     months.  None to use all cores. 
+        """
+        print('Aggregating route stops by TOD to daily and stop totals') 
+        
+        routes = (monthly_trip_file != None)
+        
+        outfiles = OrderedDict()
+        for table in self.MONTHLY_STOP_TABLES: 
+            outfiles[table] = monthly_ts_file
+        if routes: 
+            for table in self.MONTHLY_ROUTE_TABLES: 
+                outfiles[table] = monthly_trip_file
+        
+        # read only the columns needed for the aggregations
+        groupingSets = self.getTripStopGroupingSets(stops=True, routes=routes)
+        store = openStore(monthly_ts_file, mode='r')
+        columns = getProjection(store, 'rs_tod', 
+                    self.getGroupingSetColumns(groupingSets), 
+                    stage='monthly trip-stops')
+        store.close()
+        
+        months = self.getMonths(monthly_ts_file, 'rs_tod')
+        self.aggregateMonths('aggregateTripStopMonth', months, 
+                    (monthly_ts_file, columns, True, routes), 
+                    outfiles, numWorkers=numWorkers)
+    
+    
+    def aggregateMonthlyTrips(self, monthly_ts_file, monthly_trip_file, numWorkers=1):
+        """
+        Aggregates the monthly route-stops to routes by direction and 
+        time-of-day, and those to routes by day and to system totals. 
+        
+        This is done one month at a time, so only one month of rs_tod is
+        in memory.  
+        
+        numWorkers - number of processes to use, each aggregating different
+                     months.  None to use all cores. 
+        """
+        print('Aggregating route stops to routes') 
+        
+        outfiles = OrderedDict()
+        for table in self.MONTHLY_ROUTE_TABLES: 
+            outfiles[table] = monthly_trip_file
+        
+        # read only the columns needed for the aggregations
+        groupingSets = self.getTripStopGroupingSets(stops=False, routes=True)
+        store = openStore(monthly_ts_file, mode='r')
+        columns = getProjection(store, 'rs_tod', 
+                    self.getGroupingSetColumns(groupingSets), 
+                    stage='route-stops to routes')
+        store.close()
+        
+        months = self.getMonths(monthly_ts_file, 'rs_tod')
+        self.aggregateMonths('aggregateTripStopMonth', months, 
+                    (monthly_ts_file, columns, False, True), 
+                    outfiles, numWorkers=numWorkers)
+        
+        
+    def aggregateTripStopMonth(self, month, monthly_ts_file, columns, 
+                               stops=True, routes=False): 
+        """
+        Aggregates one month of the route-stops by time-of-day. 
+        
+        month           - month to aggregate
+        monthly_ts_file - file with the rs_tod table
+        columns         - columns to read from rs_tod
+        stops           - calculate the route-stops by day and the stops
+        routes          - calculate the routes and the totals
+        
+        returns an OrderedDict of table name: (aggregated dataframe, stringLengths)
+        """
+        df = self.readMonth(monthly_ts_file, 'rs_tod', month, columns)
+        
+        groupingSets = self.getTripStopGroupingSets(stops=stops, routes=routes)
+        results = self.aggregateGroupingSets(df, groupingSets)
+        
+        tables = OrderedDict()
+        for groupingSet, result in zip(groupingSets, results): 
+            tables[groupingSet[0]] = result
+        
+        # routes by day and totals, from the routes by direction and TOD
+        if routes: 
+            tables.update(self.aggregateRouteTotals(tables['route_dir_tod'][0]))
+        
+        return tables
+    
+    
+    def getTripStopGroupingSets(self, stops=True, routes=False): 
+        """
+        Gets the grouping sets calculated from the monthly route-stops by 
+        time-of-day, in the format used by aggregateGroupingSets(). 
+        The daily stops are rolled up from the stops by time-of-day. 
+        
+        stops  - include the route-stops by day and the stops
+        routes - include the routes by direction and time-of-day
+        """
+        groupingSets = []
+        if stops: 
+            STOP_RULES = self.getMonthlyStopRules()
+            #    table,        groupby,     columnSpecs,  level,    weight
+            groupingSets += [
+                ['rs_day',   ['MONTH','DOW','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ'], 
+                              STOP_RULES, 'route_stop', 'TRIP_STOPS'], 
+                ['stop_tod', ['MONTH','DOW','TOD','AGENCY_ID','STOP_ID'], 
+                              STOP_RULES, 'stop', 'TRIP_STOPS'], 
+                ['stop_day', ['MONTH','DOW','AGENCY_ID','STOP_ID'], 
+                              STOP_RULES, 'stop', 'TRIP_STOPS']
+                ]
+        if routes: 
+            groupingSets.append(
+                ['route_dir_tod', ['MONTH','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR'], 
+                                   self.getMonthlyRouteRules(), 'route', 'TRIP_STOPS'])
+        return groupingSets
+    
+    
+    def getMonthlyStopRules(self):
         """
+        Gets the rules for aggregating the monthly route-stops by 
+        time-of-day to route-stops by day and to stops. 
+        """
+        
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
         #        outfield,            infield,  aggregationMethod,   maxlevel, type, stringLength                
@@ -530,65 +857,13 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'wgtAvg'  ,'system' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'sum'     ,'system' ,'float64'   , 0]  
                 ]
-
-        print('Aggregating route stops by TOD to daily and stop totals') 
-
-        # establish the output file      
-        store = pd.HDFStore(monthly_file)
-        
-        # remove the tables to be replaced
-        keys = store.keys()
-        if '/rs_day' in keys: 
-            store.remove('rs_day')
-        if '/stop_tod' in keys: 
-            store.remove('stop_tod')
-        if '/stop_day' in keys: 
-            store.remove('stop_day')
-        
-        # get the data--route stop by TOD
-        df = store.select('rs_tod')                        
-        df.index = pd.Series(range(0,len(df)))      
-        
-        # daily route stops
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'SEQ'], 
-                    columnSpecs=STOP_RULES, 
-                    level='route_stop', 
-                    weight='TRIP_STOPS')
-    
-        store.append('rs_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
+        return STOP_RULES
         
-        # stops by time-of-day
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW','TOD','AGENCY_ID','STOP_ID'], 
-                    columnSpecs=STOP_RULES, 
-                    level='stop', 
-                    weight='TRIP_STOPS') 
-    
-        store.append('stop_tod', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)          
         
-        # daily stops
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW','AGENCY_ID','STOP_ID'], 
-                    columnSpecs=STOP_RULES, 
-                    level='stop', 
-                    weight='TRIP_STOPS')
-    
-        store.append('stop_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)          
-    
-        store.close()
-    
-    
-    def aggregateMonthlyTrips(self, monthly_ts_file, monthly_trip_file):
-        
-        self.aggregateMonthlyRouteStopsToRoutes(monthly_ts_file, monthly_trip_file)
-        self.aggregateMonthlyRoutesToTotals(monthly_trip_file)
-        
-    
-    def aggregateMonthlyRouteStopsToRoutes(self, monthly_ts_file, monthly_trip_file):
+    def getMonthlyRouteRules(self): 
+        """
+        Gets the rules for aggregating the monthly route-stops to routes. 
+        """
         
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
@@ -642,39 +917,51 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'max'     ,'system' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'sum'     ,'system' ,'float64'   , 0]  
                 ]
-
-        print('Aggregating route stops to routes') 
-
-        # establish the output file      
-        instore = pd.HDFStore(monthly_ts_file)
-        outstore = pd.HDFStore(monthly_trip_file)
-        
-        # remove the tables to be replaced
-        keys = outstore.keys()
-        if '/route_dir_tod' in keys: 
-            outstore.remove('route_dir_tod')
-        
-        # get the data--route stop by TOD
-        df = instore.select('rs_tod')                        
-        df.index = pd.Series(range(0,len(df)))      
-        
-        # patterns by time-of-day
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR'], 
-                    columnSpecs=TRIP_RULES, 
-                    level='route', 
-                    weight='TRIP_STOPS')
-    
-        outstore.append('route_dir_tod', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
-        
-    
-        instore.close()
-        outstore.close()
-    
+        return TRIP_RULES
     
     
-    def aggregateMonthlyRoutesToTotals(self, monthly_trip_file):
+    def aggregateRouteTotals(self, routes):
+        """
+        Aggregates the monthly routes by direction and time-of-day to 
+        routes by day and to system totals.  The coarser totals are 
+        rolled up from the finer ones, in one pass over the routes. 
+        
+        routes - the route_dir_tod dataframe
+        
+        returns an OrderedDict of table name: (aggregated dataframe, stringLengths)
+        """
+        TRIP_RULES = self.getMonthlyTotalRules()
+        
+        # routes by day and direction, routes by time-of-day and by day,
+        # and system totals by time-of-day and by day.  The system levels 
+        # use a subset of the route-level columns. 
+        #    table,             groupby,     columnSpecs,  level,    weight
+        groupingSets = [
+            ['route_dir_day', ['MONTH','DOW', 'AGENCY_ID','ROUTE_SHORT_NAME', 'DIR'], 
+                               TRIP_RULES, 'route', 'TRIPS'], 
+            ['route_tod',     ['MONTH','DOW', 'TOD','AGENCY_ID','ROUTE_SHORT_NAME'], 
+                               TRIP_RULES, 'route', 'TRIPS'], 
+            ['route_day',     ['MONTH','DOW', 'AGENCY_ID','ROUTE_SHORT_NAME'], 
+                               TRIP_RULES, 'route', 'TRIPS'], 
+            ['system_tod',    ['MONTH','DOW', 'TOD','AGENCY_ID'], 
+                               TRIP_RULES, 'system', 'TRIPS'], 
+            ['system_day',    ['MONTH','DOW', 'AGENCY_ID'], 
+                               TRIP_RULES, 'system', 'TRIPS']
+            ]
+        
+        results = self.aggregateGroupingSets(routes, groupingSets)
+        
+        tables = OrderedDict()
+        for groupingSet, result in zip(groupingSets, results): 
+            tables[groupingSet[0]] = result
+        return tables
+        
+        
+    def getMonthlyTotalRules(self): 
+        """
+        Gets the rules for aggregating the monthly routes to routes by 
+        day and to system totals. 
+        """
         
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
@@ -728,110 +1015,149 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'wgtAvg'  ,'system' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'sum'     ,'system' ,'float64'   , 0]  
                 ]
-
-        print('Aggregating routes to days') 
-
-        # establish the output file      
-        store = pd.HDFStore(monthly_trip_file)
-        
-        # remove the tables to be replaced
-        keys = store.keys()
-        if '/route_dir_day' in keys: 
-            store.remove('route_dir_day')
-        if '/route_tod' in keys: 
-            store.remove('route_tod')
-        if '/route_day' in keys: 
-            store.remove('route_day')
-        if '/system_tod' in keys: 
-            store.remove('system_tod')
-        if '/system_day' in keys: 
-            store.remove('system_day')
-        
-        # get the data--route stop by TOD
-        df = store.select('route_dir_tod')                        
-        df.index = pd.Series(range(0,len(df)))      
-        
-        # routes by day and direction
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'AGENCY_ID','ROUTE_SHORT_NAME', 'DIR'], 
-                    columnSpecs=TRIP_RULES, 
-                    level='route', 
-                    weight='TRIPS')
+        return TRIP_RULES
     
-        store.append('route_dir_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
-                    
-        # routes by time-of-day 
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'TOD','AGENCY_ID','ROUTE_SHORT_NAME'], 
-                    columnSpecs=TRIP_RULES, 
-                    level='route', 
-                    weight='TRIPS')
     
-        store.append('route_tod', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)                        
+    def aggregateMonthlySystemTotals(self, monthly_trip_file, route_equiv_file, 
+                                     numWorkers=1):
+        """
+        Aggregates the monthly routes to master routes, and those to 
+        system totals. 
         
-        # routes by day 
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'AGENCY_ID','ROUTE_SHORT_NAME'], 
-                    columnSpecs=TRIP_RULES, 
-                    level='route', 
-                    weight='TRIPS')
-    
-        store.append('route_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
-    
-        # system by time-of-day 
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'TOD','AGENCY_ID'], 
-                    columnSpecs=TRIP_RULES, 
-                    level='system', 
-                    weight='TRIPS')
-    
-        store.append('system_tod', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)                        
+        This is done one month at a time, so only one month of routes is
+        in memory.  
         
-        # system by day 
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'AGENCY_ID'], 
-                    columnSpecs=TRIP_RULES, 
+        numWorkers - number of processes to use, each aggregating different
+                     months.  None to use all cores. 
+        """
+        print('Aggregating routes to master routes and system totals') 
+        
+        outfiles = OrderedDict()
+        for table in ['master_route_tod', 'master_route_day', 'system_tod', 'system_day']: 
+            outfiles[table] = monthly_trip_file
+        
+        # keep only the relevant fields in the route equivalency
+        route_equiv = pd.read_csv(route_equiv_file)
+        route_equiv = route_equiv[['AGENCY_ID', 'ROUTE_SHORT_NAME', 'MASTER_ROUTE_NAME']]
+        
+        # the MASTER_ROUTE_NAME comes from the route equivalency
+        needed = (['ROUTE_SHORT_NAME'] + 
+                  self.getRequiredColumns(['MONTH','DOW', 'TOD','AGENCY_ID','MASTER_ROUTE_NAME'], 
+                                          self.getMasterRouteRules(), level='route', weight='NUMDAYS'))
+        store = openStore(monthly_trip_file, mode='r')
+        todColumns = getProjection(store, 'route_tod', needed, stage='master routes by TOD')
+        dayColumns = getProjection(store, 'route_day', needed, stage='master routes by day')
+        store.close()
+        
+        months = self.getMonths(monthly_trip_file, 'route_tod')
+        self.aggregateMonths('aggregateSystemMonth', months, 
+                    (monthly_trip_file, todColumns, dayColumns, route_equiv), 
+                    outfiles, numWorkers=numWorkers)
+        
+        
+    def aggregateSystemMonth(self, month, monthly_trip_file, todColumns, dayColumns, 
+                             route_equiv): 
+        """
+        Aggregates one month of the routes to master routes, and those to
+        system totals. 
+        
+        month             - month to aggregate
+        monthly_trip_file - file with the route_tod and route_day tables
+        todColumns        - columns to read from route_tod
+        dayColumns        - columns to read from route_day
+        route_equiv       - dataframe with the MASTER_ROUTE_NAME of each route
+        
+        returns an OrderedDict of table name: (aggregated dataframe, stringLengths)
+        """
+        SYSTEM_RULES = self.getSystemRules()
+        (fillRoute, fillMonth, sourceMonth) = self.MASTER_ROUTE_FILL
+        
+        tables = OrderedDict()
+        for (intable, master, system, columns, groupby) in [
+                ('route_tod', 'master_route_tod', 'system_tod', todColumns, ['MONTH','DOW', 'TOD','AGENCY_ID']), 
+                ('route_day', 'master_route_day', 'system_day', dayColumns, ['MONTH','DOW', 'AGENCY_ID'])]: 
+            
+            # master-routes 
+            df = self.readMonth(monthly_trip_file, intable, month, columns)
+            aggdf, stringLengths = self.aggregateMasterRoutes(df, route_equiv, 
+                                        groupby + ['MASTER_ROUTE_NAME'])
+            
+            # The 9X changes to the 8X in Dec 2009 and we're missing the data--fill that in 
+            if pd.Timestamp(month)==pd.Timestamp(fillMonth): 
+                df = self.readMonth(monthly_trip_file, intable, sourceMonth, columns)
+                if len(df) > 0: 
+                    source, sourceLengths = self.aggregateMasterRoutes(df, route_equiv, 
+                                                groupby + ['MASTER_ROUTE_NAME'])
+                    self.fillMasterRoute(aggdf, source, fillRoute)
+            
+            tables[master] = (aggdf, stringLengths)
+            
+            # system totals, from the master routes 
+            tables[system] = self.aggregateTransitRecords(aggdf, 
+                    groupby=groupby, 
+                    columnSpecs=SYSTEM_RULES, 
                     level='system', 
                     weight='TRIPS')
-    
-        store.append('system_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
-                    
-        store.close()
+        
+        return tables
     
     
-    def aggregateMonthlySystemTotals(self, monthly_trip_file, route_equiv_file):
+    def aggregateMasterRoutes(self, df, route_equiv, groupby): 
+        """
+        Aggregates the routes to master routes. 
         
-        print('Aggregating routes to master routes and system totals') 
-
-        # establish the output file      
-        store = pd.HDFStore(monthly_trip_file)
+        master-routes deal with a problem where some routes change names mid-month
+        The 5L and the 5R are a good example of this when they switch in April 2015
+        Since we've aggregated routes to monthly totals, we would double-count the riderhip
+        if we neglect to account for this.  
         
-        # remove the tables to be replaced
-        keys = store.keys()
-        if '/master_route_tod' in keys: 
-            store.remove('master_route_tod')
-        if '/master_route_day' in keys: 
-            store.remove('master_route_day')
-        if '/system_tod' in keys: 
-            store.remove('system_tod')
-        if '/system_day' in keys: 
-            store.remove('system_day')
+        returns (aggregated dataframe, stringLengths)
+        """
+        df = df.merge(route_equiv, how='left', on=['AGENCY_ID', 'ROUTE_SHORT_NAME'])
         
-        # keep only the relevant fields in the route equivalency
-        route_equiv = pd.read_csv(route_equiv_file)
-        route_equiv = route_equiv[['AGENCY_ID', 'ROUTE_SHORT_NAME', 'MASTER_ROUTE_NAME']]
+        return self.aggregateTransitRecords(df, 
+                    groupby=groupby, 
+                    columnSpecs=self.getMasterRouteRules(), 
+                    level='route', 
+                    weight='NUMDAYS')
+    
+    
+    def fillMasterRoute(self, aggdf, source, route): 
+        """
+        Fills in the missing values for a master route from another month. 
+        For each time-of-day, the first record for the route is filled 
+        from the first record for the route in the source. 
         
-        # master-routes deal with a problem where some routes change names mid-month
-        # The 5L and the 5R are a good example of this when they switch in April 2015
-        # Since we've aggregated routes to monthly totals, we would double-count the riderhip
-        # if we neglect to account for this.  
+        aggdf  - master routes to fill, modified in place
+        source - master routes for the month to fill from
+        route  - MASTER_ROUTE_NAME to fill
+        """
+        if 'TOD' in aggdf.columns: 
+            tods = aggdf['TOD'].unique()
+        else: 
+            tods = [None]
+        
+        for tod in tods: 
+            isRoute = (aggdf['MASTER_ROUTE_NAME']==route)
+            isSourceRoute = (source['MASTER_ROUTE_NAME']==route)
+            if tod != None: 
+                isRoute = isRoute & (aggdf['TOD']==tod)
+                isSourceRoute = isSourceRoute & (source['TOD']==tod)
+            fill_idx = aggdf.index[isRoute]
+            source_idx = source.index[isSourceRoute]
+            if len(fill_idx)==0 or len(source_idx)==0: 
+                continue
+            
+            for col in aggdf.select_dtypes(include=['number']).columns:
+                if np.isnan(aggdf.loc[fill_idx[0],col]):
+                    aggdf.loc[fill_idx[0],col] = source.loc[source_idx[0],col]  
+    
+    
+    def getMasterRouteRules(self): 
+        """
+        Gets the rules for aggregating the monthly routes to master routes. 
+        """
         
-
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
         #        outfield,            infield,  aggregationMethod,   maxlevel, type, stringLength                
@@ -884,55 +1210,14 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'wgtAvg'  ,'system' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'wgtAvg'  ,'system' ,'float64'   , 0]  
                 ]
-
-        
-        # master-routes by time-of-day 
-        df = store.select('route_tod')                        
-        df.index = pd.Series(range(0,len(df)))    
-        df = df.merge(route_equiv, how='left', on=['AGENCY_ID', 'ROUTE_SHORT_NAME'])
-        
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'TOD','AGENCY_ID','MASTER_ROUTE_NAME'], 
-                    columnSpecs=MASTER_ROUTE_RULES, 
-                    level='route', 
-                    weight='NUMDAYS')
-    
-        # The 9X changes to the 8X in Dec 2009 and we're missing the data--fill that in        
-        tods = aggdf['TOD'].unique()
-        for tod in tods: 
-            dec_idx = aggdf.index[(aggdf['MASTER_ROUTE_NAME']=='8') & (aggdf['TOD']==tod) & (aggdf['MONTH']=='2009-12-01')]
-            jan_idx = aggdf.index[(aggdf['MASTER_ROUTE_NAME']=='8') & (aggdf['TOD']==tod) & (aggdf['MONTH']=='2010-01-01')]
-            for col in aggdf.select_dtypes(include=['number']).columns:
-                if np.isnan(aggdf.loc[dec_idx[0],col]):
-                    aggdf.loc[dec_idx[0],col] = aggdf.loc[jan_idx[0],col]                
-                    
-        store.append('master_route_tod', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)                        
-        
-        
-        # master-routes by day 
-        df = store.select('route_day')                        
-        df.index = pd.Series(range(0,len(df)))  
-        df = df.merge(route_equiv, how='left', on=['AGENCY_ID', 'ROUTE_SHORT_NAME'])
-        
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'AGENCY_ID','MASTER_ROUTE_NAME'], 
-                    columnSpecs=MASTER_ROUTE_RULES, 
-                    level='route', 
-                    weight='NUMDAYS')
-    
-        # The 9X changes to the 8X in Dec 2009 and we're missing the data--fill that in
-        dec_idx = aggdf.index[(aggdf['MASTER_ROUTE_NAME']=='8') & (aggdf['MONTH']=='2009-12-01')]
-        jan_idx = aggdf.index[(aggdf['MASTER_ROUTE_NAME']=='8') & (aggdf['MONTH']=='2010-01-01')]
-        for col in aggdf.select_dtypes(include=['number']).columns:
-            if np.isnan(aggdf.loc[dec_idx[0],col]):
-                aggdf.loc[dec_idx[0],col] = aggdf.loc[jan_idx[0],col]
-    
-                
-        store.append('master_route_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
+        return MASTER_ROUTE_RULES
     
     
+    def getSystemRules(self): 
+        """
+        Gets the rules for aggregating the master routes to system totals. 
+        """
+        
         # specify 'none' as aggregation method if we want to include the 
         #   output field, but it is calculated separately
         #        outfield,            infield,  aggregationMethod,   maxlevel, type, stringLength                
@@ -985,36 +1270,149 @@ class SFMuniDataAggregator():
                 ['CROWDED'           ,'CROWDED'           ,'wgtAvg'  ,'system' ,'float64'   , 0],   
                 ['CROWDHOURS'        ,'CROWDHOURS'        ,'sum'     ,'system' ,'float64'   , 0]  
                 ]
-
-        # system by time-of-day 
-        df = store.select('master_route_tod')                        
-        df.index = pd.Series(range(0,len(df)))   
-        
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'TOD','AGENCY_ID'], 
-                    columnSpecs=SYSTEM_RULES, 
-                    level='system', 
-                    weight='TRIPS')
+        return SYSTEM_RULES
+    
     
-        store.append('system_tod', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)                        
+    def getMonths(self, filename, key): 
+        """
+        Gets the months in a table. 
         
-        # system by day 
-        df = store.select('master_route_day')                        
-        df.index = pd.Series(range(0,len(df)))   
+        returns a list of months, in order
+        """
+        store = openStore(filename, mode='r')
+        months = sorted(store.select_column(key, 'MONTH').unique())
+        store.close()
         
-        aggdf, stringLengths  = self.aggregateTransitRecords(df, 
-                    groupby=['MONTH','DOW', 'AGENCY_ID'], 
-                    columnSpecs=SYSTEM_RULES, 
-                    level='system', 
-                    weight='TRIPS')
+        print('Retrieved a total of %i months to process' % len(months))
+        return months
     
-        store.append('system_day', aggdf, data_columns=True, 
-                    min_itemsize=stringLengths)    
-                    
+    
+    def readMonth(self, filename, key, month, columns=None): 
+        """
+        Reads one month of a table, with a new index. 
+        """
+        store = openStore(filename, mode='r')
+        df = store.select(key, where='MONTH=Timestamp(month)', columns=columns)
         store.close()
+        
+        df.index = pd.Series(range(0,len(df)))
+        return df
     
     
+    def aggregateMonths(self, method, months, args, outfiles, numWorkers=1): 
+        """
+        Calls a method that aggregates one month for each month, and 
+        appends the tables it returns to the output files, in order of 
+        month, assigning unique indices.  Replaces the existing tables. 
+        
+        With more than one worker, each month is aggregated by a separate
+        process into its own shard, and the shards are then appended to
+        the output files. 
+        
+        method     - name of the method, called as method(month, *args) and
+                     returning an OrderedDict of table name: 
+                     (aggregated dataframe, stringLengths)
+        months     - list of months to aggregate, in order
+        args       - tuple of the other arguments to the method
+        outfiles   - OrderedDict of table name: file to write it to
+        numWorkers - number of processes to use.  None to use all cores. 
+        """
+        
+        # remove the tables to be replaced
+        for table, outfile in outfiles.items(): 
+            store = openStore(outfile)
+            if '/' + table in store.keys(): 
+                store.remove(table)
+            store.close()
+        
+        # count the number of rows in each table so our 
+        # indices are unique
+        counts = dict([(table, 0) for table in outfiles])
+        buffers = dict([(table, []) for table in outfiles])
+        
+        if numWorkers==1 or len(months)<=1: 
+            for month in months: 
+                print('Processing month ', month)
+                tables = getattr(self, method)(month, *args)
+                self.appendMonthlyTables(tables, outfiles, counts, buffers)
+        else: 
+            if numWorkers==None: 
+                numWorkers = multiprocessing.cpu_count()
+            
+            shardfile = list(outfiles.values())[0]
+            shardfiles = [getShardfile(shardfile, i) for i in range(len(months))]
+            for shardfile in shardfiles: 
+                removeStore(shardfile)
+            tasks = [(method, month, args, shardfile) 
+                     for month, shardfile in zip(months, shardfiles)]
+            
+            print (datetime.datetime.now().ctime(), 'Aggregating %i months with %i workers' 
+                    % (len(months), numWorkers))
+            pool = multiprocessing.Pool(processes=min(numWorkers, len(months)))
+            try: 
+                stringLengths = pool.map(aggregateMonthShard, tasks, chunksize=1)
+            finally: 
+                pool.close()
+                pool.join()
+            
+            for shardfile, lengths in zip(shardfiles, stringLengths): 
+                shardstore = openStore(shardfile, mode='r')
+                tables = OrderedDict()
+                for table in lengths: 
+                    tables[table] = (shardstore.select(table), lengths[table])
+                shardstore.close()
+                removeStore(shardfile)
+                
+                self.appendMonthlyTables(tables, outfiles, counts, buffers)
+        
+        for table in outfiles: 
+            self.flushMonthlyTable(table, outfiles[table], buffers)
+    
+    
+    def appendMonthlyTables(self, tables, outfiles, counts, buffers): 
+        """
+        Adds one month of aggregated tables to the output, with indices 
+        that continue from the months already added.  They are kept in
+        memory and written in batches of up to bufferRows, so each month 
+        doesn't need its own append. 
+        
+        tables   - OrderedDict of table name: (aggregated dataframe, stringLengths)
+        outfiles - dictionary of table name: file to write it to
+        counts   - dictionary of table name: number of rows added so far.
+                   Updated with the rows added. 
+        buffers  - dictionary of table name: list of (dataframe, stringLengths)
+                   not yet written.  Updated with the rows added. 
+        """
+        for table, (aggdf, stringLengths) in tables.items(): 
+            aggdf.index = counts[table] + pd.Series(range(0,len(aggdf)))
+            counts[table] += len(aggdf)
+            
+            buffers[table].append((aggdf, stringLengths))
+            if sum([len(df) for df, lengths in buffers[table]]) >= self.bufferRows: 
+                self.flushMonthlyTable(table, outfiles[table], buffers)
+    
+    
+    def flushMonthlyTable(self, table, outfile, buffers): 
+        """
+        Writes the buffered records for one monthly table in one append. 
+        """
+        if len(buffers[table])==0: 
+            return
+        
+        df = pd.concat([df for df, lengths in buffers[table]])
+        stringLengths = {}
+        for df_, lengths in buffers[table]: 
+            for col in lengths: 
+                stringLengths[col] = max(lengths[col], stringLengths.get(col, 0))
+        
+        store = openStore(outfile)
+        store.append(table, df, data_columns=True, 
+                    min_itemsize=stringLengths)   
+        store.close()
+        
+        buffers[table] = []
+        
+        
     def aggregateTransitRecords(self, df, groupby, columnSpecs, level='system', weight=None):
         """
         Aggregates transit records to the groupings specified.  The counting 
@@ -1048,6 +1446,8 @@ class SFMuniDataAggregator():
                                      or 'std'.  Can also be 'none' if the field
                                      is not to be aggregated. count will
                                      aggregate the number of records. 
+                                     nunique counts the distinct values, and
+                                     count_nonzero the values that are not 0. 
 
                           maxlevel - the maximum level at which to include this
                                      field.  String should be one of: 
@@ -1065,154 +1465,85 @@ class SFMuniDataAggregator():
 
         returns - an aggregated dataframe, also the stringLengths to facilitate writing
         """        
+        return self.getPlan(groupby, columnSpecs, level, weight).aggregate(df)
 
-        # convert to formats used by standard methods.  
-        # Start with the month, which is used for aggregation
-        colorder  = list(groupby)
-        coltypes  = {}
-        stringLengths= {}
-        aggMethod = {}        
-        countOutFields = set()   
-        sumOutFields = set()
-        
-        wgtSumInFields = set()
-        wgtAvgInFields = set()
-        wgtAvgOutFields = set()
-        
-        for col in columnSpecs:
-            
-            # these are the entries required by the input specification
-            outfield    = col[0]
-            infield     = col[1]
-            aggregation = col[2]
-            maxlevel    = col[3]
-            dtype       = col[4]
-            stringLength= col[5] 
-            
-            # only include those fields with the appropriate maxlevel
-            if level=='system':
-                if (maxlevel=='route' or maxlevel=='stop' or maxlevel=='route_stop'):
-                    continue
-            elif level=='stop':
-                if (maxlevel=='route' or maxlevel=='route_stop'):
-                    continue                
-            elif level=='route':
-                if (maxlevel=='stop' or maxlevel=='route_stop'):
-                    continue                                
-            
-            # now populate arrays as needed
-            colorder.append(outfield)
-            coltypes[outfield] = dtype
-            if (dtype=='object'): 
-                stringLengths[outfield] = stringLength
 
-            # skip aggregation if none, or no input field
-            if aggregation != 'none' and infield != 'none': 
-                
-                # for keeping track of daily averages
-                if aggregation == 'sum' or aggregation == 'wgtSum':
-                    sumOutFields.add(outfield)
-                
-                # for weighted averages
-                if aggregation == 'wgtSum':                    
-                    wgtSumInFields.add(infield)
-                    aggregation = 'sum'
-                    infield = 'w' + infield
-                elif aggregation == 'wgtAvg': 
-                    wgtAvgInFields.add(infield)
-                    wgtAvgOutFields.add(outfield)
-                    aggregation = 'sum'
-                    infield = 'w' + infield
-                
-                # the main aggregation methods
-                if infield in aggMethod: 
-                    aggMethod[infield][outfield] = aggregation
-                else:
-                    aggMethod[infield] = {outfield : aggregation}
-                                        
-            # these fields get the count of the number of records
-            if aggregation == 'count': 
-                countOutFields.add(outfield)
+    def aggregateGroupingSets(self, df, groupingSets):
+        """
+        Aggregates the records in df to several grouping sets in one pass,
+        rolling up the coarser sets from the finer ones where the rules 
+        allow.  See AggregationPlan.aggregateGroupingSets(). 
+        
+        df           - dataframe to aggregate
+        groupingSets - list of [name, groupby, columnSpecs, level, weight]
+                       for each set, with the arguments as in 
+                       aggregateTransitRecords()
+        
+        returns a list of (aggregated dataframe, stringLengths) for each set
+        """
+        plans = [self.getPlan(groupby, columnSpecs, level, weight) 
+                 for (name, groupby, columnSpecs, level, weight) in groupingSets]
+        return aggregateGroupingSets(df, plans)
 
-        # since groupby isn't listed above
-        if 'ROUTE_SHORT_NAME' in groupby:
-            stringLengths['ROUTE_SHORT_NAME'] = 32
 
-        # include the weight when aggregating
-        # scale up any weighted columns  
-        if weight != None: 
-            if weight in aggMethod: 
-                aggMethod[weight][weight] = 'sum'
-            else:
-                aggMethod[weight] = {weight : 'sum'}
-            
-            for col in wgtSumInFields.union(wgtAvgInFields):
-                df['w'+col] = df[weight] * df[col]
-        
+    def getGroupingSetColumns(self, groupingSets):
+        """
+        Gets the input columns needed for all the grouping sets. 
         
-        # group
-        grouped = df.groupby(groupby)
-        aggregated = grouped.aggregate(aggMethod)
-            
-        # drop multi-level columns
-        levels = aggregated.columns.levels
-        labels = aggregated.columns.labels
-        aggregated.columns = levels[1][labels[1]]
+        returns a list of column names
+        """
+        columns = []
+        for (name, groupby, columnSpecs, level, weight) in groupingSets: 
+            for col in self.getRequiredColumns(groupby, columnSpecs, level, weight): 
+                if not col in columns: 
+                    columns.append(col)
+        return columns
 
-        # for any average fields, divide by the sum of the weights
-        if weight != None:
-            for col in wgtAvgOutFields:
-                aggregated[col] = (aggregated[col]).values / (aggregated[weight]).values
 
-        # add count fields
-        for field in countOutFields: 
-            aggregated[field] = grouped.size()
-        
-        # update scheduled speed
-        if 'RUNSPEED_S' in colorder: 
-            speedInput = pd.Series(zip(aggregated['SERVMILES_S'], 
-                                    aggregated['RUNTIME_S']), 
-                                index=aggregated.index)     
-            aggregated['RUNSPEED_S'] = speedInput.apply(self.updateSpeeds)
-        
-        # update actual speed--based on scheduled service miles for consistency
-        if 'RUNSPEED' in colorder: 
-            speedInput = pd.Series(zip(aggregated['SERVMILES'], 
-                                    aggregated['RUNTIME']), 
-                                index=aggregated.index)            
-            aggregated['RUNSPEED'] = speedInput.apply(self.updateSpeeds)
-        
-        # update scheduled speed
-        if 'TOTSPEED_S' in colorder: 
-            speedInput = pd.Series(zip(aggregated['SERVMILES_S'], 
-                                    aggregated['TOTTIME_S']), 
-                                index=aggregated.index)     
-            aggregated['TOTSPEED_S'] = speedInput.apply(self.updateSpeeds)
-        
-        # update actual speed--based on scheduled service miles for consistency
-        if 'TOTSPEED' in colorder: 
-            speedInput = pd.Series(zip(aggregated['SERVMILES'], 
-                                    aggregated['TOTTIME']), 
-                                index=aggregated.index)            
-            aggregated['TOTSPEED'] = speedInput.apply(self.updateSpeeds)
-            
-        # force the data types
-        # this doesn't work if there are missing values, hence the pass
-        for col in coltypes: 
-            try: 
-                aggregated[col] = aggregated[col].astype(coltypes[col])
-            except TypeError:
-                pass
-            except ValueError: 
-                pass
-                                                                                        
-        # clean up structure of dataframe
-        aggregated = aggregated.sort_index()
-        aggregated = aggregated.reset_index()     
-        aggregated = aggregated[colorder]       
+    def getPlan(self, groupby, columnSpecs, level='system', weight=None):
+        """
+        Gets the compiled AggregationPlan for these arguments, compiling 
+        it the first time they are used. 
+        """
+        key = (tuple(groupby), tuple([tuple(col) for col in columnSpecs]), 
+               level, weight)
+        if not key in self.plans: 
+            self.plans[key] = AggregationPlan(groupby, columnSpecs, level, weight)
+        return self.plans[key]
 
-        return aggregated, stringLengths
 
+    def includeAtLevel(self, maxlevel, level):
+        """
+        True if a field with this maxlevel is included when aggregating
+        to this level. 
+        """
+        return includeAtLevel(maxlevel, level)
+
+
+    def getRequiredColumns(self, groupby, columnSpecs, level='system', weight=None):
+        """
+        Gets the input columns that aggregateTransitRecords() needs for 
+        these arguments:  the groupby columns, the infields of the 
+        columnSpecs included at this level, and the weight.  Used to 
+        read only those columns from the store. 
+        
+        returns a list of column names
+        """
+        columns = list(groupby)
+        for col in columnSpecs:
+            (outfield, infield, aggregation, maxlevel) = col[0:4]
+            if (aggregation != 'none' and infield != 'none' 
+                and self.includeAtLevel(maxlevel, level)):
+                columns.append(infield)
+        if weight != None: 
+            columns.append(weight)
+            
+        # keep the first of any duplicates
+        required = []
+        for col in columns:
+            if not col in required: 
+                required.append(col)
+        return required
 
 
     def meanTimes(self, datetimeSeries):
@@ -1253,26 +1584,3 @@ class SFMuniDataAggregator():
     
             return mean
         
-
-    def updateSpeeds(self, speedInputs):
-        """
-        Calculates the speed based on a tuple (servmiles, runtime)
-                                           
-        """
-        
-        (servmiles, runtime) = speedInputs
-        
-        if runtime>0: 
-            return round(servmiles / (runtime / 60.0), 2)
-        elif runtime == 0: 
-            return 0.0
-        else: 
-            return np.nan
-        
-    def countUnique(self, series):
-        """
-        Counts the number of unique dates in the group
-                                           
-        """
-        return len(series.unique())       
-        
\ No newline at end of file
@@ -26,77 +26,193 @@ __license__     = """
 import pandas as pd
 import numpy as np
 import datetime
+import multiprocessing
 
 from SFMuniDataAggregator import SFMuniDataAggregator
 from GTFSHelper import GTFSHelper
+from SFMuniDataHelper import getShardfile
+from StringDictionary import decodeStrings, toStrings
+from DataStore import openStore, getProjection, storeExists, removeStore
+from Utils import getSpeeds, roundDecimals
+from ScheduleCache import ScheduleCache
+from KeyJoin import KeyEncoder, leftJoinOnKeys
             
             
     
 def calculateRuntime(df):
     """
-    Calculates the runtime between trip_stops. Assumes data are grouped by: 
-    ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','TRIP']
+    Calculates the runtime between trip_stops, as the minutes from the 
+    departure at the previous stop to the arrival at this one.  The first
+    stop of each trip has no runtime, and negative or missing runtimes 
+    are set to zero.  
+    
+    Sorts once by trip and SEQ, and takes the difference within each trip, 
+    so all trips are calculated together.  As with a groupby, records 
+    missing any of the trip fields are dropped. 
+    
+    returns df sorted by ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','TRIP','SEQ']
     """        
-    df.sort_values(['SEQ'], inplace=True)
-
-    firstStop = True
-    lastDepartureTime = None
-    for i, row in df.iterrows():    
-        if firstStop: 
-            df.at[i,'RUNTIME'] = 0        # no runtime for first trip
-            firstStop = False
-        else:
-            diff = row['ARRIVAL_TIME'] - lastDepartureTime
-            df.at[i,'RUNTIME'] = max(0, round(diff.total_seconds() / 60.0, 2))
-        lastDepartureTime = row['DEPARTURE_TIME']
+    tripFields = ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','TRIP']
+    df = df.dropna(subset=tripFields)
+    df = df.sort_values(tripFields + ['SEQ'])
+    
+    # no runtime for first stop of each trip
+    firstStop = ~(df.duplicated(subset=tripFields, keep='first').values)
+    
+    diff = df['ARRIVAL_TIME'] - df['DEPARTURE_TIME'].shift(1)
+    runtime = roundDecimals(diff.dt.total_seconds().values / 60.0, 2)
+    
+    # comparisons with NaN are False, so missing values are also zero
+    df['RUNTIME'] = np.where(firstStop | ~(runtime > 0), 0.0, runtime)
     
     return df
     
+# multiplier for the departure time in the integer trip ids, leaving
+# room for the first SEQ in the lower digits
+TRIP_SEQ_SPAN = 1000000
+
+
+def encodeTripId(departure, firstSeq):
+    """
+    Encodes a trip as a single integer, from the HHMM of departure from 
+    the first stop and the first SEQ.  The same trip id is used for the 
+    GTFS and the AVL data, so they can be joined on it.  
+    
+    departure - series or array of HHMM departure times
+    firstSeq  - series or array of the first SEQ of each trip
+    
+    returns an int64 array of trip ids
+    """
+    return (np.asarray(departure).astype('int64') * TRIP_SEQ_SPAN 
+            + np.asarray(firstSeq).astype('int64'))
+    
+    
+def encodeGTFSTripId(trips):
+    """
+    Converts GTFS trip ids, as strings of the form HHMM_SEQ, to the 
+    integer trip ids used for joining.  
+    """
+    parts = trips.astype(str).str.split('_', n=1, expand=True)
+    return encodeTripId(parts[0].astype('int64'), parts[1].astype('int64'))
+    
+    
+# expander used by each worker process, set up by initExpanderWorker
+WORKER_EXPANDER = None
+
+
+def initExpanderWorker(settings): 
+    """
+    Sets up the expander in a worker process, so the GTFS schedules 
+    it reads are cached across the dates it is given.  
+    
+    settings - tuple of (gtfs_outfile, sfmuni_file, dow)
+    """
+    global WORKER_EXPANDER
+    (gtfs_outfile, sfmuni_file, dow) = settings
+    WORKER_EXPANDER = SFMuniDataExpander(gtfs_outfile, sfmuni_file, 
+            trip_outfile=None, ts_outfile=None, 
+            daily_trip_outfile=None, daily_ts_outfile=None, 
+            dow=dow, dates=[], readOnly=True)
+    
+    
+def expandDateShard(args): 
+    """
+    Worker for expanding one date into its own shards.  At module
+    level so it can be passed to a process pool. 
+    
+    args - tuple of (date, periods, route_type, write_intermediate_files, 
+           (tripShard, tsShard, dailyShard))
+    
+    returns the string lengths of the rs_tod records written
+    """
+    (date, periods, route_type, write_intermediate_files, shards) = args
+    (tripShard, tsShard, dailyShard) = shards
+    
+    expander = WORKER_EXPANDER
+    expander.trip_outfile = tripShard
+    expander.ts_outfile = tsShard
+    expander.aggregator = SFMuniDataAggregator(daily_ts_outfile=dailyShard)
+    expander.tripCount = 0
+    expander.tsCount = 0
+    
+    expander.expandDate(date, periods, route_type=route_type, 
+                        write_intermediate_files=write_intermediate_files)
+    expander.aggregator.close()
+    
+    return expander.aggregator.rs_tod_stringLengths
+    
+    
+def prepareSchedule(df):
+    """
+    Prepares the GTFS schedule for a service period for joining to the 
+    AVL data, by converting the trip ids and the DIR and SEQ to int.  
+    Done once when it is read. 
+    """
+    df['TRIP'] = encodeGTFSTripId(df['TRIP'])
+    df['DIR'] = df['DIR'].astype(int)
+    df['SEQ'] = df['SEQ'].astype(int)
+    return df
+    
+    
+def getJoinFields():
+    """
+    Gets the fields used to join the GTFS and AVL data. 
+    """
+    return [col[0] for col in SFMuniDataExpander.COLUMNS if col[3]=='join']
+    
+    
+def encodeScheduleKeys(df):
+    """
+    Encodes the join fields of a prepared GTFS schedule as a single 
+    int64 key, so it is done once for each service period, and the
+    AVL data for each date is encoded to match. 
+    """
+    return KeyEncoder(df, getJoinFields())
+    
+    
 def updateTripId(df):
     """
-    Updates the trip id to include the first SEQ number. 
-    Assumes data are grouped by: 
+    Updates the trip id to include the first SEQ number, by encoding the
+    trip and the first SEQ as an integer.  Trips are identified by:
     ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','PATTCODE','TRIP']
+    
+    As with a groupby, records missing any of these fields are dropped. 
     """        
+    groupby = ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','PATTCODE','TRIP']
+    df = df.dropna(subset=groupby)
     
-    df['TRIP'] = df['TRIP'].astype(str) + '_' + str(min(df['SEQ']))
+    firstSeq = df.groupby(groupby, observed=True)['SEQ'].transform('min')
+    df['TRIP'] = encodeTripId(df['TRIP'], firstSeq)
     return df
                     
 
-def updateSpeeds(speedInputs):
+def getScheduleDeviation(actualTimes, schedTimes):
     """
-    Calculates the speed based on a tuple (servmiles, runtime)
-                                       
+    Calculates the schedule deviation in minutes, rounded to two decimals, 
+    for whole columns at once.  Late is positive and early is negative.  
+    Missing if either time is missing. 
+    
+    actualTimes - array-like of datetime64 actual times
+    schedTimes  - array-like of datetime64 scheduled times
+    
+    returns a float64 array
     """
-        
-    (servmiles, runtime) = speedInputs
+    actualTimes = np.asarray(actualTimes, dtype='datetime64[ns]')
+    schedTimes = np.asarray(schedTimes, dtype='datetime64[ns]')
+    
+    # NaT becomes NaN when converted to seconds
+    seconds = (actualTimes - schedTimes) / np.timedelta64(1, 's')
     
-    if runtime>0: 
-        return round(servmiles / (runtime / 60.0), 2)
-    elif runtime == 0: 
-        return 0.0
-    else: 
-        return np.nan
+    return roundDecimals(seconds / 60.0, 2)
         
 
-def getScheduleDeviation(times):
+def maskUnobserved(df, values):
     """
-    Calculates schedule devation based on a tuple (actualTime, schedTime)
-                                       
+    Returns the values as a series, with NaN for trip-stops that are 
+    not observed. 
     """
-	
-    (actualTime, schedTime) = times
-	
-    if pd.isnull(actualTime): 
-        return np.nan
-    elif (actualTime >= schedTime):
-        diff = actualTime - schedTime
-        return round(diff.seconds / 60.0, 2)
-    else: 
-        diff = schedTime - actualTime
-        return -round(diff.seconds / 60.0, 2)
-        
-
+    return pd.Series(values, index=df.index).mask(df['OBSERVED']==0, other=np.nan)
+    
 
 def getOutfile(filename, date):
     """
@@ -119,51 +235,86 @@ def getInkey(month, prefix):
     return prefix + str(month.date()).replace('-', '')
     
     
-def calcGroupWeights(df, oldWeight):
+def calcWeights(df, groupby, oldWeight):
     """
-    df - dataframe to operate on.  Must contain columns for TRIPS
+    df - dataframe to operate on.  Must contain columns for TRIP_STOPS
          and for the oldWeight.  
+    groupby - list of columns for grouping dataframe
     oldWeight - column name in df containing the previous weight. 
     
-    Intended to operate on a group and weight up to the TRIP_STOPS
-    in the group.  
+    groups the dataframe as specified, and calculates weights to 
+    match the total trip-stops in each group.  Groups with no 
+    observations get a weight of NaN, as do rows missing any of the 
+    groupby columns. 
     
+    returns series with the weights, and same index df    
     """
+    return calcNestedWeights(df, [groupby], oldWeight)[0]
     
-    obs = float((df[oldWeight] * df['TRIP_STOPS']).sum())
-    tot = float(df['TRIP_STOPS'].sum())    
-    if obs>0:
-        factor = tot / obs
-    else: 
-        factor = np.nan
-        
-    out = df[oldWeight] * factor   
     
-    return out
-
-
-def calcWeights(df, groupby, oldWeight):
+def calcNestedWeights(df, levels, oldWeight):
     """
-    df - dataframe to operate on.  Must contain columns for TRIPS
+    Calculates the weights for several nested levels of grouping in one 
+    pass, such as TOD and then day.  Each level scales up the weights of
+    the level before, uniformly within each group, to match the total 
+    trip-stops in the group, as in calcWeights().  
+    
+    Only the first level groups the rows.  Each level after that groups
+    the totals of the level before, so adding a level costs little. 
+    
+    df - dataframe to operate on.  Must contain columns for TRIP_STOPS
          and for the oldWeight.  
-    groupby - list of columns for grouping dataframe
+    levels - list of groupby lists, from the finest to the coarsest.  
+             Each level must include all the columns of the next one. 
     oldWeight - column name in df containing the previous weight. 
     
-    groups the dataframe as specified, and calculates weights to 
-    match the total trips in each group. 
-    
-    returns series with the weights, and same index df    
+    returns a list of series with the weights for each level, with the
+            same index as df
     """
+    weight = df[oldWeight].values.astype('float64')
     
-    grouped = df.groupby(groupby)
+    # the table being grouped, starting with the rows
+    groups = df[levels[0]].copy()
+    groups['OBS'] = weight * df['TRIP_STOPS'].values
+    groups['TOT'] = df['TRIP_STOPS'].values.astype('float64')
+    rowGroup = np.arange(len(df))
     
-    # special case if only one group
-    if (len(grouped)<=1):
-        return calcGroupWeights(df, oldWeight)
-    else: 
-        weights = grouped.apply(calcGroupWeights, oldWeight)   
-        weights = weights.reset_index(level=groupby)
-        return weights[oldWeight]
+    weights = []
+    for i, groupby in enumerate(levels): 
+        
+        # -1 for rows missing any of the groupby columns
+        code = groups.groupby(groupby, observed=True, sort=False).ngroup()
+        code = code.fillna(-1).values.astype('int64')
+        valid = code >= 0
+        
+        # the sum skips missing weights, so groups without observations
+        # have OBS of 0 and get a factor of NaN
+        sums = groups.loc[valid, ['OBS', 'TOT']].groupby(code[valid]).sum()
+        obs = sums['OBS'].values
+        tot = sums['TOT'].values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(obs > 0, tot / obs, np.nan)
+        
+        # scale the weight of each row by the factor for its group
+        rowGroup = np.where(rowGroup >= 0, code[np.maximum(rowGroup, 0)], -1)
+        rowFactor = np.where(rowGroup >= 0, factor[np.maximum(rowGroup, 0)], np.nan)
+        weight = weight * rowFactor
+        weights.append(pd.Series(weight, index=df.index))
+        
+        # each group is a row of the next level, and once weighted, 
+        # its observations add up to its total.  Those without a group
+        # are kept as they are, since they still count in the total. 
+        if i + 1 < len(levels): 
+            firstRows = np.unique(code[valid], return_index=True)[1]
+            weighted = groups.loc[valid, levels[i+1]].iloc[firstRows]
+            weighted['OBS'] = np.where(obs > 0, tot, np.nan)
+            weighted['TOT'] = tot
+            unweighted = groups.loc[~valid, levels[i+1] + ['TOT']]
+            unweighted['OBS'] = np.nan
+            groups = pd.concat([weighted, unweighted[weighted.columns]], 
+                               ignore_index=True)
+        
+    return weights
     
 
             
@@ -246,15 +397,62 @@ class SFMuniDataExpander():
 	['VEHNO'     ,        0, 0, 'avl'], 
     ['SCHED_DATES',      20, 0, 'gtfs']  # range of this GTFS schedule
     ]
+
+    # metrics derived after joining the GTFS and AVL data, in the order they 
+    # are calculated.  Each is only calculated if it is used, either as an 
+    # output column or as an input to another metric that is used. 
+    #    name,              inputs,  function of the joined dataframe
+    DERIVED_METRICS = [
+    ['OBSERVED',          ['OBSERVED_AVL'],                                # observations
+        lambda df: np.where(df['OBSERVED_AVL'] == 1, 1, 0)], 
+    ['SERVMILES',         ['SERVMILES_S'],                                 # normalize to consistent measure of service miles
+        lambda df: df['SERVMILES_S']], 
+    ['ARRIVAL_TIME_DEV',  ['ARRIVAL_TIME', 'ARRIVAL_TIME_S'],              # schedule deviation
+        lambda df: getScheduleDeviation(df['ARRIVAL_TIME'], df['ARRIVAL_TIME_S'])], 
+    ['DEPARTURE_TIME_DEV',['DEPARTURE_TIME', 'DEPARTURE_TIME_S'], 
+        lambda df: getScheduleDeviation(df['DEPARTURE_TIME'], df['DEPARTURE_TIME_S'])], 
+    ['ONTIME5',           ['DEPARTURE_TIME_DEV', 'ARRIVAL_TIME_DEV', 'OBSERVED'],   # ontime defined consistent with TCRP 165
+        lambda df: maskUnobserved(df, np.where((df['DEPARTURE_TIME_DEV']>-1.0) & (df['ARRIVAL_TIME_DEV']<5.0), 1, 0))], 
+    ['PASSMILES',         ['LOAD_ARR', 'SERVMILES'],                       # passenger miles traveled
+        lambda df: df['LOAD_ARR'] * df['SERVMILES']], 
+    ['PASSHOURS',         ['LOAD_ARR', 'RUNTIME', 'LOAD_DEP', 'DWELL'],    # passenger hours -- scheduled time
+        lambda df: (df['LOAD_ARR'] * df['RUNTIME'] + df['LOAD_DEP'] * df['DWELL']).values / 60.0], 
+    ['WAITHOURS',         ['ON', 'HEADWAY_S'],                             # passenger hours of waiting time -- scheduled time
+        lambda df: (df['ON'] * 0.5 * df['HEADWAY_S']).values / 60.0], 
+    ['FULLFARE_REV',      ['ON', 'FARE'],                                  # fair paid, if each boarding pays full fare
+        lambda df: df['ON'] * df['FARE']], 
+    ['PASSDELAY_DEP',     ['DEPARTURE_TIME_DEV', 'ON', 'OBSERVED'],        # passenger hours of delay at departure
+        lambda df: maskUnobserved(df, np.where(df['DEPARTURE_TIME_DEV']>0, 
+                                               df['ON'] * df['DEPARTURE_TIME_DEV'], 0))], 
+    ['PASSDELAY_ARR',     ['ARRIVAL_TIME_DEV', 'ON', 'OBSERVED'],          # passenger hours of delay at arrival
+        lambda df: maskUnobserved(df, np.where(df['ARRIVAL_TIME_DEV']>0, 
+                                               df['ON'] * df['ARRIVAL_TIME_DEV'], 0))], 
+    ['VC',                ['LOAD_ARR', 'CAPACITY'],                        # volume-capacity ratio
+        lambda df: (df['LOAD_ARR']).values / (df['CAPACITY']).values], 
+    # the capacity is the 'crush' load, so we are defining
+    # crowding as 85% of that capacity.  In TCRP 165, this 
+    # corresponds approximately to the range of 125-150% of
+    # the seated load, which is the maximum design load for
+    # peak of the peak conditions. 
+    ['CROWDED',           ['VC', 'OBSERVED'],                              # crowded if VC>0.85
+        lambda df: maskUnobserved(df, np.where(df['VC'] > 0.85, 1.0, 0.0))], 
+    ['CROWDHOURS',        ['CROWDED', 'LOAD_ARR', 'RUNTIME', 'LOAD_DEP', 'DWELL'], 
+        lambda df: (df['CROWDED'] * (df['LOAD_ARR'] * df['RUNTIME'] 
+                                   + df['LOAD_DEP'] * df['DWELL'])).values / 60.0]
+    ]
                 
     
 
     def __init__(self, gtfs_outfile, sfmuni_file, trip_outfile, ts_outfile, 
                  daily_trip_outfile, daily_ts_outfile,
                  dow=[1,2,3], startDate='1900-01-01', endDate='2100-01-01', 
-                 startingTripCount=1, startingTsCount=0):
+                 startingTripCount=1, startingTsCount=0, dates=None, readOnly=False):
         """
         Constructor.                 
+        
+        dates    - list of dates to run.  If None, runs all observed dates
+                   between the startDate and endDate. 
+        readOnly - open the GTFS store read-only, as in worker processes
         """        
                 
         # set the relevant files
@@ -262,7 +460,11 @@ class SFMuniDataExpander():
         self.ts_outfile = ts_outfile
 
         # open the data stores
-        self.gtfs_store = pd.HDFStore(gtfs_outfile)
+        self.gtfs_outfile = gtfs_outfile
+        if readOnly: 
+            self.gtfs_store = openStore(gtfs_outfile, mode='r')
+        else: 
+            self.gtfs_store = openStore(gtfs_outfile)
         
         # set the sfmuni file
         self.sfmuni_file = sfmuni_file
@@ -278,17 +480,34 @@ class SFMuniDataExpander():
         self.tripCount = startingTripCount
         self.tsCount = startingTsCount
         
+        # GTFS schedules for each service period, kept across GTFS files and dates
+        self.scheduleCache = ScheduleCache(self.gtfs_store, key='sfmuni', 
+                                           prepare=prepareSchedule, 
+                                           makeKeys=encodeScheduleKeys)
+        
+        # AVL data for the last month read, sorted by date
+        self.avlMonth = None
+        self.avlMonthData = None
+        self.avlMonthDates = None
+        
         # running a specific range 
         self.startDate = startDate
         self.endDate = endDate
         
+        # the dates may be given, as for the workers
+        if dates != None: 
+            self.dateList = sorted([pd.Timestamp(d) for d in dates])
+            return
+        
         # get the list of observed dates from all relevant files
         months = pd.date_range(startDate, endDate, freq='M') 
         print (months)
         firstMonth = True
         for m in months: 
             month = ((pd.to_datetime(m)).to_period('M')).to_timestamp()    
-            sfmuni_store = pd.HDFStore(getOutfile(self.sfmuni_file, month))
+            if not storeExists(getOutfile(self.sfmuni_file, month)): 
+                continue
+            sfmuni_store = openStore(getOutfile(self.sfmuni_file, month), mode='r')
             sfmuni_key = getInkey(month, 'm')
             
             if '/' + sfmuni_key in sfmuni_store.keys():             
@@ -319,121 +538,205 @@ class SFMuniDataExpander():
         self.aggregator.close()
     
     
-    def expandAndWeight(self, gtfs_file, write_intermediate_files=True, route_type=3):
+    def expandAndWeight(self, gtfs_file, write_intermediate_files=True, route_type=3, 
+                        numWorkers=1):
         """
         Read GTFS, cleans it, processes it, and writes it to an HDF5 file.
         This will be done for every individual day, so you get a list of 
         every bus that runs. 
         
-        infile  - in GTFS format
-        outfile - output file name in h5 format, same as AVL/APC format
+        With more than one worker, each date is expanded by a separate 
+        process into its own shards, and the shards are then merged into
+        the output files in date order, assigning unique indices. 
+        
+        gtfs_file  - in GTFS format
+        write_intermediate_files - write the trips and trip-stops, as well 
+                     as the daily totals
+        route_type - GTFS route type to keep
+        numWorkers - number of processes to use.  None to use all cores. 
         """
         
         print(datetime.datetime.now().ctime(), 'Converting raw data in file: ', gtfs_file)
               
-        # establish the feed, reading only the bus routes
+        # get the service periods active on each date.  These are saved
+        # in the GTFS store, so the feed only needs to be loaded once. 
         gtfsHelper = GTFSHelper()
-        gtfsHelper.establishTransitFeed(gtfs_file)
+        calendar = gtfsHelper.readServiceCalendar(self.gtfs_store, gtfs_file)
         
-        # get the date ranges
-        gtfsDateRange = gtfsHelper.schedule.GetDateRange()        
-        gtfsStartDate = pd.to_datetime(gtfsDateRange[0], format='%Y%m%d')
-        gtfsEndDate   = pd.to_datetime(gtfsDateRange[1], format='%Y%m%d')
-        dateRangeString = str(gtfsDateRange[0]) + '-' + str(gtfsDateRange[1])
-                
-        # create dictionary with one dataframe for each service period
-        # read these from the GTFS file that was previously created
-        dataframes = {}
-        servicePeriods = gtfsHelper.schedule.GetServicePeriodList()        
-        for period in servicePeriods:   
-            service_id = period.service_id
-            if int(service_id) in self.dow:                
-                # only keep the busses here
-                print('Reading service_id ', service_id)
-                dataframes[service_id] = self.gtfs_store.select('sfmuni', 
-                           where="SCHED_DATES=dateRangeString & SERVICE_ID=service_id & ROUTE_TYPE=route_type")
+        # only the observed dates
+        print('Writing data for periods from ', calendar['DATE'].min(), ' to ', calendar['DATE'].max())
+        calendar = calendar[calendar['DATE'].isin(self.dateList)]
+        dates = [date for date, periods in calendar.groupby('DATE')]
+        
+        if numWorkers==1 or len(dates)<=1: 
+            for date, periods in calendar.groupby('DATE'):       
+                self.expandDate(date, periods, route_type=route_type, 
+                                write_intermediate_files=write_intermediate_files)
+        else: 
+            if numWorkers==None: 
+                numWorkers = multiprocessing.cpu_count()
             
-        # note that the last date is not included, hence the +1 increment
-        servicePeriodsEachDate = gtfsHelper.schedule.GetServicePeriodsActiveEachDate(gtfsStartDate, gtfsEndDate + pd.DateOffset(days=1)) 
-                   
-        # loop through each date, and add the appropriate service to the database  
-        print('Writing data for periods from ', gtfsStartDate, ' to ', gtfsEndDate)
-        for date, servicePeriodsForDate in servicePeriodsEachDate:           
-                        
-            if pd.Timestamp(date) in self.dateList:          
+            shardfiles = []
+            tasks = []
+            for i, (date, periods) in enumerate(calendar.groupby('DATE')): 
+                shards = (getShardfile(self.trip_outfile.replace('YYYY', 'expand'), i), 
+                          getShardfile(self.ts_outfile.replace('YYYY', 'expand'), i), 
+                          getShardfile(self.aggregator.daily_ts_outfile, i))
+                for shardfile in shards: 
+                    removeStore(shardfile)
+                shardfiles.append(shards)
+                tasks.append((date, periods, route_type, write_intermediate_files, shards))
             
-                print(datetime.datetime.now().ctime(), ' Processing ', date)         
+            print (datetime.datetime.now().ctime(), 'Expanding %i dates with %i workers' 
+                    % (len(dates), numWorkers))
+            # the workers read the GTFS store, so don't hold it open for writing
+            self.gtfs_store.close()
+            
+            settings = (self.gtfs_outfile, self.sfmuni_file, self.dow)
+            pool = multiprocessing.Pool(processes=min(numWorkers, len(dates)), 
+                                        initializer=initExpanderWorker, initargs=(settings,))
+            try: 
+                stringLengths = pool.map(expandDateShard, tasks, chunksize=1)
+            finally: 
+                pool.close()
+                pool.join()
+                self.gtfs_store = openStore(self.gtfs_outfile)
+                self.scheduleCache.store = self.gtfs_store
+            
+            self.mergeShards(shardfiles, stringLengths)
+    
+    
+    def expandDate(self, date, periods, route_type=3, write_intermediate_files=True): 
+        """
+        Expands and weights the observed data for one date, and writes 
+        the daily totals. 
+        
+        date    - date to expand
+        periods - the rows of the service calendar for this date, with 
+                  the SCHED_DATES and SERVICE_ID of each period
+        route_type - GTFS route type to keep
+        write_intermediate_files - write the trips and trip-stops, as well 
+                     as the daily totals
+        """
+        print(datetime.datetime.now().ctime(), ' Processing ', date)         
+        
+        # use a separate file for each year
+        # and write a separate table for each month and DOW
+        # format of the table name is mYYYYMMDDdX, where X is the day of week
+        month = ((pd.to_datetime(date)).to_period('M')).to_timestamp()    
+        trip_outstore = openStore(getOutfile(self.trip_outfile, month))  
+        ts_outstore = openStore(getOutfile(self.ts_outfile, month))  
+        
+        # only derive the metrics that are aggregated, unless the 
+        # trip-stops are written
+        columns = None
+        if not write_intermediate_files: 
+            columns = self.aggregator.getTripStopColumns()
+        
+        for i, period in periods.iterrows(): 
+            if int(period['SERVICE_ID']) in self.dow:     
                 
-                # use a separate file for each year
-                # and write a separate table for each month and DOW
-                # format of the table name is mYYYYMMDDdX, where X is the day of week
-                month = ((pd.to_datetime(date)).to_period('M')).to_timestamp()    
-                trip_outstore = pd.HDFStore(getOutfile(self.trip_outfile, month))  
-                ts_outstore = pd.HDFStore(getOutfile(self.ts_outfile, month))  
+                outkey = getOutkey(month=month, dow=period['SERVICE_ID'], prefix='m')                                             
+
+                # get the corresponding MUNI data for this date, and only continue if there 
+                # are observed values
+                sfmuni = self.getSFMuniData(date)  
                 
-                for period in servicePeriodsForDate: 
-                    if int(period.service_id) in self.dow:     
-                        
-                        outkey = getOutkey(month=month, dow=period.service_id, prefix='m')                                             
+                # get the corresponding GTFS dataframe, with the times for this date, 
+                # only keeping the busses
+                df = self.scheduleCache.getSchedule(period['SCHED_DATES'], 
+                        period['SERVICE_ID'], route_type, date, month)
+                
+                # join the sfmuni data, using the keys encoded for this period
+                encoder = self.scheduleCache.getKeys(period['SCHED_DATES'], 
+                        period['SERVICE_ID'], route_type)
+                joined = self.joinSFMuniData(df, sfmuni, encoder=encoder, 
+                                             columns=columns)    
+                    
+                # aggregate from trip-stops to trips
+                trips = self.aggregator.aggregateToTrips(joined)
+                    
+                # set a unique trip index
+                trips.index = self.tripCount + pd.Series(range(0,len(trips)))
+                self.tripCount += len(trips)
+                
+                # weight the trips
+                trips = self.weightTrips(trips)
+                    
+                # write the trips   
+                if write_intermediate_files: 
+                    stringLengths = self.getStringLengths(trips.columns)                                                                    
+                    trip_outstore.append(outkey, trips, data_columns=True, 
+                                min_itemsize=stringLengths)
+                    
+                # add weights to trip-stop df                          
+                mergeFields = ['DATE','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'TRIP']
+                weightFields = ['PATTERN', 'TRIP_WEIGHT', 'TOD_WEIGHT'] 
+                tripWeights = trips[mergeFields + weightFields]            
+                ts = pd.merge(joined, tripWeights, how='left', on=mergeFields, sort=True)  
+                    
+                # set a unique trip-stop index
+                ts.index = self.tsCount + pd.Series(range(0,len(ts)))
+                self.tsCount += len(ts)
+                
+                # not sure why it thinks SEQ is an object and not an int, but try converting
+                ts['SEQ'] = ts['SEQ'].astype('int64')
+                
+                # write the trip-stops             
+                if write_intermediate_files: 
+                    stringLengths = self.getStringLengths(ts.columns)   
+                    ts_outstore.append(outkey, toStrings(ts), data_columns=True, 
+                                    min_itemsize=stringLengths)                            
+                
+                # aggregate to TOD and daily totals, and write those
+                self.aggregator.aggregateTripStopsByTimeOfDay(ts)
+
+        trip_outstore.close()
+        ts_outstore.close()
     
-                        # get the corresponding MUNI data for this date, and only continue if there 
-                        # are observed values
-                        sfmuni = self.getSFMuniData(date)  
-                        
-                        # get the corresponding GTFS dataframe
-                        df = dataframes[period.service_id]
-                                
-                        # update the dates
-                        df['ARRIVAL_TIME_S']   = date + (df['ARRIVAL_TIME_S'] - df['DATE'])
-                        df['DEPARTURE_TIME_S'] = date + (df['DEPARTURE_TIME_S'] - df['DATE'])
-                        
-                        df['DATE'] = date
-                        df['MONTH'] = month
-                        
-                        # join the sfmuni data
-                        joined = self.joinSFMuniData(df, sfmuni)    
-                            
-                        # aggregate from trip-stops to trips
-                        trips = self.aggregator.aggregateToTrips(joined)
-                            
-                        # set a unique trip index
-                        trips.index = self.tripCount + pd.Series(range(0,len(trips)))
-                        self.tripCount += len(trips)
-                        
-                        # weight the trips
-                        trips = self.weightTrips(trips)
-                            
-                        # write the trips   
-                        if write_intermediate_files: 
-                            stringLengths = self.getStringLengths(trips.columns)                                                                    
-                            trip_outstore.append(outkey, trips, data_columns=True, 
-                                        min_itemsize=stringLengths)
-                            
-                        # add weights to trip-stop df                          
-                        mergeFields = ['DATE','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR', 'TRIP']
-                        weightFields = ['PATTERN', 'TRIP_WEIGHT', 'TOD_WEIGHT'] 
-                        tripWeights = trips[mergeFields + weightFields]            
-                        ts = pd.merge(joined, tripWeights, how='left', on=mergeFields, sort=True)  
-                            
-                        # set a unique trip-stop index
-                        ts.index = self.tsCount + pd.Series(range(0,len(ts)))
-                        self.tsCount += len(ts)
-                        
-                        # not sure why it thinks SEQ is an object and not an int, but try converting
-                        ts['SEQ'] = ts['SEQ'].astype('int64')
-                        
-                        # write the trip-stops             
-                        if write_intermediate_files: 
-                            stringLengths = self.getStringLengths(ts.columns)   
-                            ts_outstore.append(outkey, ts, data_columns=True, 
-                                            min_itemsize=stringLengths)                            
-                        
-                        # aggregate to TOD and daily totals, and write those
-                        self.aggregator.aggregateTripStopsByTimeOfDay(ts)
-                        
-                                            
-                trip_outstore.close()
-                ts_outstore.close()
+    
+    def mergeShards(self, shardfiles, stringLengths): 
+        """
+        Appends the trips, trip-stops and daily totals written by each 
+        worker to the output files, in order, and assigns unique indices 
+        as the rows are written.  Deletes the shards when done. 
+        
+        shardfiles    - list of (trip, trip-stop, daily) shard files for 
+                        each date
+        stringLengths - list of the rs_tod string lengths for each date
+        """
+        for (tripShard, tsShard, dailyShard), rsTodLengths in zip(shardfiles, stringLengths): 
+            print (datetime.datetime.now().ctime(), 'Merging shard: ', dailyShard)
+            
+            # trips and trip-stops, with a table for each month and DOW
+            for shardfile, outfile in [(tripShard, self.trip_outfile), (tsShard, self.ts_outfile)]: 
+                if not storeExists(shardfile): 
+                    continue
+                shardstore = openStore(shardfile, mode='r')
+                for key in shardstore.keys(): 
+                    month = pd.Timestamp(key.lstrip('/')[1:9])
+                    df = shardstore.select(key)
+                    if shardfile==tripShard: 
+                        df.index = self.tripCount + pd.Series(range(0,len(df)))
+                        self.tripCount += len(df)
+                    else: 
+                        df.index = self.tsCount + pd.Series(range(0,len(df)))
+                        self.tsCount += len(df)
+                    outstore = openStore(getOutfile(outfile, month))
+                    outstore.append(key.lstrip('/'), df, data_columns=True, 
+                                    min_itemsize=self.getStringLengths(df.columns))
+                    outstore.close()
+                shardstore.close()
+                removeStore(shardfile)
+            
+            # daily totals
+            if storeExists(dailyShard): 
+                shardstore = openStore(dailyShard, mode='r')
+                if '/rs_tod' in shardstore.keys(): 
+                    df = shardstore.select('rs_tod')
+                    self.aggregator.appendRouteStopTotals(df, rsTodLengths)
+                shardstore.close()
+                removeStore(dailyShard)
     
     
     def getSFMuniData(self, date):
@@ -446,45 +749,81 @@ class SFMuniDataExpander():
         # and write a separate table for each month and DOW
         # format of the table name is mYYYYMMDDdX, where X is the day of week
         month = ((pd.to_datetime(date)).to_period('M')).to_timestamp()    
-        sfmuni_store = pd.HDFStore(getOutfile(self.sfmuni_file, month))
-        sfmuni_key = getInkey(month, 'm')
-                
-        sfmuni = sfmuni_store.select(sfmuni_key, where='DATE==Timestamp(date)')
-        sfmuni.index = pd.Series(range(0,len(sfmuni)))
+        self.readAVLMonth(month)
+        
+        # the records for this date, which are together after sorting
+        date = np.datetime64(pd.Timestamp(date), 'ns')
+        start = np.searchsorted(self.avlMonthDates, date, side='left')
+        stop = np.searchsorted(self.avlMonthDates, date, side='right')
+        sfmuni = self.avlMonthData.iloc[start:stop].reset_index(drop=True)
         
         # drop duplicates, which would get double-counted
         sfmuni = sfmuni.drop_duplicates(subset=['AGENCY_ID','ROUTE_SHORT_NAME','DIR','PATTCODE','TRIP', 'SEQ'])
                 
         # update the TRIP id in case there are multiple trips with different 
         # patterns leaving a different stop at the same time
-        groupby = ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','PATTCODE','TRIP']
-        sfmuni = sfmuni.groupby(groupby, as_index=False).apply(updateTripId)     
+        sfmuni = updateTripId(sfmuni)
         
         # calculate observed RUNTIME
         # happens here because the values in the AVL data look screwy.
-        groupby = ['AGENCY_ID','ROUTE_SHORT_NAME','DIR','TRIP']
-        sfmuni = sfmuni.groupby(groupby, as_index=False).apply(calculateRuntime)
+        sfmuni = calculateRuntime(sfmuni)
         sfmuni['TOTTIME'] = sfmuni['RUNTIME'] + sfmuni['DWELL']                            
                             
                             
         # speed   
-        speedInput = pd.Series(zip(sfmuni['SERVMILES'],  sfmuni['RUNTIME']), index=sfmuni.index)     
-        sfmuni['RUNSPEED'] = speedInput.apply(updateSpeeds)                    
-        speedInput = pd.Series(zip(sfmuni['SERVMILES'], sfmuni['TOTTIME']), index=sfmuni.index)     
-        sfmuni['TOTSPEED'] = speedInput.apply(updateSpeeds)
-        
-        sfmuni_store.close()
+        sfmuni['RUNSPEED'] = getSpeeds(sfmuni['SERVMILES'], sfmuni['RUNTIME'])
+        sfmuni['TOTSPEED'] = getSpeeds(sfmuni['SERVMILES'], sfmuni['TOTTIME'])
         
         return sfmuni
                     
         
-    def joinSFMuniData(self, gtfs, sfmuni):
+    def readAVLMonth(self, month): 
         """
-        Left join from GTFS to SFMuni sample.        
+        Reads the AVL data for the month in one pass, and sorts it by DATE
+        so that each date can be taken as a slice.  Keeps the last month 
+        read, so running the dates in order reads each month once. 
         
-        gtfs_file - HDF file containing processed GTFS data      
-        sfmuni_file - HDF file containing processed, just for sampled routes
-        joined_outfile - HDF file containing merged GTFS and SFMuni data     
+        month - first day of the month to read
+        """
+        # use a separate file for each year
+        # and a separate table for each month
+        sfmuni_file = getOutfile(self.sfmuni_file, month)
+        sfmuni_key = getInkey(month, 'm')
+        if self.avlMonth == (sfmuni_file, sfmuni_key): 
+            return
+        
+        print(datetime.datetime.now().ctime(), ' Reading AVL data for ', sfmuni_key)
+        sfmuni_store = openStore(sfmuni_file, mode='r')
+        
+        # only read the columns that are used in the join
+        needed = ['DATE'] + [col[0] for col in self.COLUMNS if col[3]=='avl' or col[3]=='join']
+        columns = getProjection(sfmuni_store, sfmuni_key, needed, stage='AVL data')
+        
+        df = sfmuni_store.select(sfmuni_key, columns=columns)
+        df = decodeStrings(sfmuni_store, df)
+        sfmuni_store.close()
+        
+        # a stable sort keeps the records in order within each date
+        df = df.sort_values('DATE', kind='mergesort')
+        
+        self.avlMonth = (sfmuni_file, sfmuni_key)
+        self.avlMonthData = df
+        self.avlMonthDates = df['DATE'].values.astype('datetime64[ns]')
+        
+        
+    def joinSFMuniData(self, gtfs, sfmuni, encoder=None, columns=None):
+        """
+        Left join from GTFS to SFMuni sample.  The join fields are encoded
+        as a single int64 key on both sides, so the join doesn't need to 
+        sort or compare the string fields. 
+        
+        gtfs    - GTFS schedule for one date
+        sfmuni  - SFMuni data for the same date
+        encoder - KeyEncoder built from the join fields of this schedule, 
+                  in the same row order.  If None, one is built here. 
+        columns - list of columns that are used, in addition to the index
+                  columns.  Derived metrics that are not used are not 
+                  calculated.  If None, all columns are kept. 
         """
         
         # convert column specs 
@@ -497,7 +836,8 @@ class SFMuniDataExpander():
             index = col[2]
             source = col[3]
             
-            colnames.append(name)
+            if columns==None or index==1 or name in columns: 
+                colnames.append(name)
             sources[name] = source
             if index==1: 
                 indexColumns.append(name)
@@ -521,10 +861,14 @@ class SFMuniDataExpander():
             sfmuni['DIR'] = sfmuni['DIR'].astype(int)
             sfmuni['SEQ'] = sfmuni['SEQ'].astype(int)
         
-        # join 
+        # join on the encoded keys.  The order doesn't matter, since
+        # the result is sorted by the index columns below. 
         try: 
-            joined = pd.merge(gtfs, sfmuni, how='left', on=joinFields, 
-                                    suffixes=('', '_AVL'), sort=True)
+            if encoder==None: 
+                encoder = KeyEncoder(gtfs, joinFields)
+            joined = leftJoinOnKeys(gtfs, sfmuni, encoder.keys, 
+                                    encoder.encode(sfmuni), 
+                                    on=joinFields, suffix='_AVL')
         except KeyError:
             print(joinFields)
             print(gtfs.info())
@@ -533,61 +877,9 @@ class SFMuniDataExpander():
             print(sfmuni.head())
             raise
 
-        # calculate other derived fields
-        # observations
-        joined['OBSERVED'] = np.where(joined['OBSERVED_AVL'] == 1, 1, 0)
-
-        # normalize to consistent measure of service miles
-        joined['SERVMILES'] = joined['SERVMILES_S']
-        
-        # schedule deviation          
-        arrTime = pd.Series(zip(joined['ARRIVAL_TIME'], joined['ARRIVAL_TIME_S']), index=joined.index)   
-        depTime = pd.Series(zip(joined['DEPARTURE_TIME'], joined['DEPARTURE_TIME_S']), index=joined.index)         
-        joined['ARRIVAL_TIME_DEV']   = arrTime.apply(getScheduleDeviation)
-        joined['DEPARTURE_TIME_DEV'] = depTime.apply(getScheduleDeviation)
-        
-        # ontime defined consistent with TCRP 165
-        joined['ONTIME5'] = np.where((joined['DEPARTURE_TIME_DEV']>-1.0) & (joined['ARRIVAL_TIME_DEV']<5.0), 1, 0)
-        joined['ONTIME5'] = joined['ONTIME5'].mask(joined['OBSERVED']==0, other=np.nan)
-                                       
-        # passenger miles traveled
-        joined['PASSMILES'] = joined['LOAD_ARR'] * joined['SERVMILES']
-                
-        # passenger hours -- scheduled time
-        joined['PASSHOURS'] = (joined['LOAD_ARR'] * joined['RUNTIME']
-                             + joined['LOAD_DEP'] * joined['DWELL']).values / 60.0
-                                                                                        
-        # passenger hours of waiting time -- scheduled time
-        joined['WAITHOURS'] = (joined['ON'] * 0.5 * joined['HEADWAY_S']).values / 60.0                    
-                                   
-        # fair paid, if each boarding pays full fare
-        joined['FULLFARE_REV'] = (joined['ON'] * joined['FARE']) 
-                    
-        # passenger hours of delay at departure
-        joined['PASSDELAY_DEP'] = np.where(joined['DEPARTURE_TIME_DEV']>0, 
-                                     joined['ON'] * joined['DEPARTURE_TIME_DEV'], 0)
-        joined['PASSDELAY_DEP'] = joined['PASSDELAY_DEP'].mask(joined['OBSERVED']==0, other=np.nan)
-        
-        # passenger hours of delay at arrival
-        joined['PASSDELAY_ARR'] = np.where(joined['ARRIVAL_TIME_DEV']>0, 
-                                     joined['ON'] * joined['ARRIVAL_TIME_DEV'], 0)
-        joined['PASSDELAY_ARR'] = joined['PASSDELAY_ARR'].mask(joined['OBSERVED']==0, other=np.nan)
-
-        # volume-capacity ratio
-        joined['VC'] = (joined['LOAD_ARR']).values / (joined['CAPACITY']).values
-                
-        # croweded if VC>0.85
-        # the capacity is the 'crush' load, so we are defining
-        # crowding as 85% of that capacity.  In TCRP 165, this 
-        # corresponds approximately to the range of 125-150% of
-        # the seated load, which is the maximum design load for
-        # peak of the peak conditions. 
-        joined['CROWDED'] = np.where(joined['VC'] > 0.85, 1.0, 0.0)
-        joined['CROWDED'] = joined['CROWDED'].mask(joined['OBSERVED']==0, other=np.nan)
-
-        joined['CROWDHOURS'] = (joined['CROWDED'] * (
-                                joined['LOAD_ARR'] * joined['RUNTIME']
-                                + joined['LOAD_DEP'] * joined['DWELL'])).values / 60.0                       
+        # calculate the derived metrics that are used
+        for name, inputs, derive in self.getDerivedMetrics(colnames): 
+            joined[name] = derive(joined)
                                                 
         # keep only relevant columns, sorted
         joined.sort_values(indexColumns, inplace=True)           
@@ -597,6 +889,26 @@ class SFMuniDataExpander():
         return joined
 
     
+    def getDerivedMetrics(self, needed):
+        """
+        Gets the derived metrics to calculate for these columns, along 
+        with the metrics they depend on. 
+        
+        needed - list of columns that are used
+        
+        returns the list of [name, inputs, function] from DERIVED_METRICS, 
+                in the order they should be calculated
+        """
+        needed = set(needed)
+        metrics = []
+        for metric in reversed(self.DERIVED_METRICS): 
+            (name, inputs, derive) = metric
+            if name in needed: 
+                metrics.insert(0, metric)
+                needed.update(inputs)
+        return metrics
+
+    
     def weightTrips(self, trips):
         """
         Adds a series of weight columns to the trip df based on the ratio
@@ -611,10 +923,15 @@ class SFMuniDataExpander():
         # the weights build upon the lower-level weights, so we scale
         # the low-weights up uniformly within the group.  
                                         
-        # routes
-        trips['TOD_WEIGHT'] = calcWeights(trips, 
-                groupby=['DATE','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR'], 
-                oldWeight='TRIP_WEIGHT')
+        # each level is (weight column, groupby), from the finest to the
+        # coarsest, and all are calculated in one pass
+        levels = [
+            ['TOD_WEIGHT', ['DATE','TOD','AGENCY_ID','ROUTE_SHORT_NAME', 'DIR']]   # routes
+            ]
+        weights = calcNestedWeights(trips, [level[1] for level in levels], 
+                                    oldWeight='TRIP_WEIGHT')
+        for level, weight in zip(levels, weights): 
+            trips[level[0]] = weight
                     
         return trips
                         
@@ -24,6 +24,15 @@ __license__     = """
 import pandas as pd
 import numpy as np
 import datetime
+import os
+import json
+import hashlib
+import multiprocessing
+
+from Utils import getDatesFromInts, getWrapAroundTimesFromInts, getIntervalKeys, findIntervals
+from STPReader import STPReader
+from StringDictionary import encodeStrings
+from DataStore import openStore, storeExists, removeStore
 
 def getOutfile(filename, date):
     """
@@ -37,6 +46,28 @@ def getOutkey(month, prefix):
     gets the key name as a string from the month and the day of week
     """
     return prefix + str(month.date()).replace('-', '')
+
+
+def getShardfile(filename, i):
+    """
+    gets the name of the temporary file written by worker i
+    """
+    base, ext = os.path.splitext(filename)
+    return base + '_shard' + str(i) + ext
+    
+
+def processRawDataShard(args):
+    """
+    Worker for processing one raw file into its own shard.  At module
+    level so it can be passed to a process pool. 
+    
+    args - tuple of (infile, shardfile)
+    
+    returns the number of rows written
+    """
+    (infile, shardfile) = args
+    helper = SFMuniDataHelper()
+    return helper.processRawData(infile, shardfile)
     
                                     
 class SFMuniDataHelper():
@@ -62,6 +93,10 @@ class SFMuniDataHelper():
     #      CHUNKSIZE =  10000: reads 100,000 rows in 10 minutes
     #      CHUNKSIZE =   1000: reads 100,000 rows in 10 minutes
     CHUNKSIZE = 100000
+    
+    # number of rows to read at a time in part 2, which does much less 
+    # work per row
+    PART2_CHUNKSIZE = 1000000
 
     # by default, read the first 62 columns, through PULLOUT_INT
     COLUMNS_TO_READ = [i for i in range(62)]
@@ -357,15 +392,26 @@ class SFMuniDataHelper():
         'ROUTE_SHORT_NAME' : 10, 
         'ROUTE_LONG_NAME'  : 32
         }
+    
+    # string columns that can be written as integer codes in part 2
+    ENCODED_COLUMNS = ['AGENCY_ID', 'ROUTE_SHORT_NAME', 'ROUTE_LONG_NAME', 
+                       'STOPNAME_AVL', 'PATTCODE', 'LOADCODE']
 
-    def __init__(self):
+    def __init__(self, encodeStrings=False):
         """
         Constructor.                 
+        
+        encodeStrings - if True, part 2 writes the ENCODED_COLUMNS as 
+                        integer codes with a dictionary table in each 
+                        store, which readers get back as Categoricals. 
         """        
+        self.encodeStrings = encodeStrings
         self.routeEquiv = {}
+        self.routeEquivFile = None
         
         
     def readRouteEquiv(self, routeEquivFile): 
+        self.routeEquivFile = routeEquivFile
         df = pd.read_csv(routeEquivFile, index_col='ROUTE_AVL')
         
         # normalize the strings
@@ -382,13 +428,24 @@ class SFMuniDataHelper():
     
         self.routeEquiv = df
         
+        # index the date intervals by route, so records can be looked up
+        # for a whole chunk at once
+        equiv = df.reset_index().sort_values(['ROUTE_AVL', 'START_DATE'])
+        self.routeEquivStarts, null = getIntervalKeys(equiv['ROUTE_AVL'], equiv['START_DATE'])
+        self.routeEquivEnds, null   = getIntervalKeys(equiv['ROUTE_AVL'], equiv['END_DATE'])
+        self.routeEquivFields = equiv[['AGENCY_ID', 'ROUTE_SHORT_NAME', 'ROUTE_LONG_NAME']]
+        self.routeEquivFields = self.routeEquivFields.reset_index(drop=True)
+        
     
-    def processRawData(self, infile, outfile):
+    def processRawData(self, infile, outfile, startIndex=0):
         """
         Read SFMuniData, cleans it, processes it, and writes it to an HDF5 file.
         
-        infile  - in "raw STP" format
-        outfile - output file name in h5 format
+        infile     - in "raw STP" format
+        outfile    - output file name in h5 format
+        startIndex - first index value to write, so appended files stay unique
+        
+        returns the number of rows written
         """
         
         print (datetime.datetime.now().ctime(), 'Converting raw data in file: ', infile)
@@ -397,17 +454,11 @@ class SFMuniDataHelper():
         colnames = []       
         colspecs = []
         coltypes = []
-        stringLengths= {}
         for col in self.COLUMNS: 
             colnames.append(col[0])
             colspecs.append(col[1])
             coltypes.append(col[2])
-            if (col[2]=='object' and col[3]>0 and 
-                (col[0] in self.REORDERED_COLUMNS)): 
-                stringLengths[col[0]] = col[3]
-        stringLengths['AGENCY_ID']        = 10
-        stringLengths['ROUTE_SHORT_NAME'] = 10
-        stringLengths['ROUTE_LONG_NAME']  = 32
+        stringLengths = self.getStringLengths()
 
         # set up the reader -- one file is a different format
         reader = None 
@@ -419,18 +470,10 @@ class SFMuniDataHelper():
                              chunksize= self.CHUNKSIZE, 
                              na_values=['NA'])                
         else: 
-            reader = pd.read_fwf(infile,  
-                             names    = colnames, 
-                             colspecs = colspecs,
-                             skiprows = self.HEADERROWS, 
-                             usecols  = self.COLUMNS_TO_READ, 
-                             iterator = True, 
-                             skip_blank_lines = True, 
-                             chunksize= self.CHUNKSIZE, 
-                             na_values=['ID'])             # because of headers in middle of file
+            reader = self.getSTPReader(infile)
 
         # establish the writer
-        store = pd.HDFStore(outfile)
+        store = openStore(outfile)
 
         # iterate through chunk by chunk so we don't run out of memory
         rowsRead    = 0
@@ -525,7 +568,7 @@ class SFMuniDataHelper():
             chunk.sort_values(self.INDEX_COLUMNS, inplace=True)
                         
             # set a unique index
-            chunk.index = rowsWritten + pd.Series(range(0,len(chunk)))
+            chunk.index = startIndex + rowsWritten + pd.Series(range(0,len(chunk)))
                             
             # re-order the columns
             df = chunk[self.REORDERED_COLUMNS]
@@ -550,113 +593,500 @@ class SFMuniDataHelper():
 
         # close the writer
         store.close()
+        
+        return rowsWritten
+
+
+    def getSTPReader(self, infile, byteRange=None): 
+        """
+        Returns an iterator of dataframes read from a file in "raw STP" 
+        format, using the fixed byte offsets of the columns.  Headers
+        in the middle of the file and rows where the rear-door boardings
+        are mis-aligned are skipped as the file is parsed.  
+        
+        infile    - in "raw STP" format
+        byteRange - (start, end) tuple of bytes to read, or None for all
+        """
+        colnames = [self.COLUMNS[i][0] for i in self.COLUMNS_TO_READ]
+        colspecs = [self.COLUMNS[i][1] for i in self.COLUMNS_TO_READ]
+        coltypes = [self.COLUMNS[i][2] for i in self.COLUMNS_TO_READ]
+        
+        stpReader = STPReader(colnames, colspecs, coltypes, 
+                              headerRows=self.HEADERROWS, 
+                              keyColumn='SEQ', 
+                              maxValues={'RDBRDNGS' : 1000})
+        
+        for chunk in stpReader.readChunks(infile, byteRange=byteRange): 
+            yield pd.DataFrame(chunk)
+    
+    
+    def processRawFiles(self, infiles, outfile, numWorkers=1, manifest=None):
+        """
+        Processes a list of raw STP files into a single HDF5 file.  
+        
+        With more than one worker, each file is parsed and cleaned by a 
+        separate process into its own shard, and the shards are then 
+        merged into the outfile in the order of the infiles, assigning
+        a unique index across all files. 
+        
+        With a manifest, only files that are new or have changed since 
+        the last run are processed.  The rows previously written from a 
+        changed file are removed before it is processed again, so reruns 
+        don't duplicate records. 
+        
+        infiles    - list of files in "raw STP" format
+        outfile    - output file name in h5 format
+        numWorkers - number of processes to use.  None to use all cores. 
+        manifest   - Manifest recording what was done in previous runs, 
+                     or None to process all files. 
+        
+        returns the number of rows written
+        """
+        
+        # figure out which files need to be processed
+        hashes = {}
+        if manifest!=None: 
+            todo = []
+            for infile in infiles: 
+                hashes[infile] = manifest.getFileHash(infile)
+                entry = manifest.getEntry('clean1', infile)
+                if (manifest.isCurrent('clean1', infile, hashes[infile]) 
+                    and entry['outfile']==outfile): 
+                    print (datetime.datetime.now().ctime(), 'Skipping unchanged file: ', infile)
+                    continue
+                if entry!=None: 
+                    self.removeRows(entry['outfile'], entry['indexRange'])
+                    manifest.removeEntry('clean1', infile)
+                    manifest.save()
+                todo.append(infile)
+            infiles = todo
+        
+        if len(infiles)==0: 
+            return 0
+        
+        startIndex = self.getNextIndex(outfile)
+        startRow = self.getRowCount(outfile)
+        
+        if numWorkers==1: 
+            rowCounts = []
+            for infile in infiles: 
+                rowCounts.append(self.processRawData(infile, outfile, 
+                                 startIndex=startIndex+sum(rowCounts)))
+        else: 
+            if numWorkers==None: 
+                numWorkers = multiprocessing.cpu_count()
+            
+            shardfiles = [getShardfile(outfile, i) for i in range(len(infiles))]
+            for shardfile in shardfiles: 
+                removeStore(shardfile)
+            
+            print (datetime.datetime.now().ctime(), 'Processing %i files with %i workers' 
+                    % (len(infiles), numWorkers))
+            pool = multiprocessing.Pool(processes=min(numWorkers, len(infiles)))
+            try: 
+                pool.map(processRawDataShard, zip(infiles, shardfiles), chunksize=1)
+            finally: 
+                pool.close()
+                pool.join()
+            
+            rowCounts = self.mergeShards(shardfiles, outfile)
+        
+        # record what each file wrote
+        if manifest!=None: 
+            store = openStore(outfile, mode='r')
+            for infile, rows in zip(infiles, rowCounts): 
+                dates = []
+                if rows > 0: 
+                    dates = store.select_column('sample', 'DATE', 
+                                    start=startRow, stop=startRow+rows).unique()
+                manifest.setEntry('clean1', infile, 
+                    {'hash'       : hashes[infile], 
+                     'outfile'    : outfile, 
+                     'indexRange' : [int(startIndex), int(startIndex+rows)], 
+                     'dates'      : sorted([str(pd.Timestamp(d).date()) for d in dates])})
+                startIndex += rows
+                startRow += rows
+            store.close()
+            manifest.save()
+        
+        return sum(rowCounts)
+        
+        
+    def mergeShards(self, shardfiles, outfile): 
+        """
+        Appends the cleaned shards to the outfile, in order, and assigns a 
+        unique index as the rows are written.  Deletes the shards when done. 
+        
+        shardfiles - list of files written by processRawData
+        outfile    - output file name in h5 format
+        
+        returns a list with the number of rows written from each shard
+        """
+        
+        stringLengths = self.getStringLengths()
+        
+        startIndex = self.getNextIndex(outfile)
+        store = openStore(outfile)
+        rowsWritten = 0
+        rowCounts = []
+        for shardfile in shardfiles: 
+            print (datetime.datetime.now().ctime(), 'Merging shard: ', shardfile)
+            
+            shardRows = 0
+            shardstore = openStore(shardfile)
+            if '/sample' in shardstore.keys(): 
+                for df in shardstore.select('sample', chunksize=self.CHUNKSIZE): 
+                    df.index = startIndex + rowsWritten + pd.Series(range(0,len(df)))
+                    store.append('sample', df, data_columns=True, 
+                        min_itemsize=stringLengths)
+                    rowsWritten += len(df)
+                    shardRows += len(df)
+            shardstore.close()
+            removeStore(shardfile)
+            rowCounts.append(shardRows)
+            
+        store.close()
+        print(datetime.datetime.now().ctime(), ' Merged %i rows.' % rowsWritten)
+        
+        return rowCounts
+        
+        
+    def getRowCount(self, outfile): 
+        """
+        gets the number of rows already written to the sample table
+        """
+        if not storeExists(outfile): 
+            return 0
+        store = openStore(outfile, mode='r')
+        if '/sample' in store.keys(): 
+            count = store.get_storer('sample').nrows
+        else: 
+            count = 0
+        store.close()
+        return count
+        
+        
+    def getNextIndex(self, outfile): 
+        """
+        gets the next index value to write to the sample table, so appended 
+        rows get a unique index.  Rows are always appended in order of 
+        the index, so this is one more than the index of the last row, 
+        even if rows have been removed from the middle of the table. 
+        """
+        count = self.getRowCount(outfile)
+        if count==0: 
+            return 0
+        store = openStore(outfile, mode='r')
+        lastIndex = store.select('sample', start=count-1, stop=count).index[0]
+        store.close()
+        return int(lastIndex) + 1
+        
+        
+    def removeRows(self, outfile, indexRange): 
+        """
+        removes the rows in the range of index values [start, end) from 
+        the sample table, such as those written from a file that has 
+        since changed
+        """
+        if not storeExists(outfile): 
+            return
+        (start, end) = indexRange
+        print (datetime.datetime.now().ctime(), 'Removing rows %i to %i from %s' 
+                % (start, end, outfile))
+        store = openStore(outfile)
+        if '/sample' in store.keys(): 
+            store.remove('sample', where='index>=%i & index<%i' % (start, end))
+        store.close()
+        
+        
+    def getStringLengths(self): 
+        """
+        gets the string lengths for the columns written in part 1
+        """
+        stringLengths= {}
+        for col in self.COLUMNS: 
+            if (col[2]=='object' and col[3]>0 and 
+                (col[0] in self.REORDERED_COLUMNS)): 
+                stringLengths[col[0]] = col[3]
+        stringLengths['AGENCY_ID']        = 10
+        stringLengths['ROUTE_SHORT_NAME'] = 10
+        stringLengths['ROUTE_LONG_NAME']  = 32
+        
+        return stringLengths
 
       
-    def cleanPart2(self, infile, outfile):
+    def cleanPart2Files(self, infiles, outfile, manifest=None): 
+        """
+        Runs cleanPart2 on each of the infiles.  
+        
+        With a manifest, only months whose inputs are new or have changed
+        since the last run are processed.  The table for each of those
+        months is removed and re-written from all the infiles, so reruns 
+        replace the month rather than appending to it.  
+        
+        infiles  - list of files in cleaned step 1 format
+        outfile  - output file name in h5 format, with YYYY for years
+        manifest - Manifest recording what was done in previous runs, 
+                   or None to process all dates. 
+        """
+        
+        infiles = [infile for infile in infiles if storeExists(infile)]
+        
+        if manifest==None: 
+            for infile in infiles: 
+                self.cleanPart2(infile, outfile)
+            return
+        
+        # the hash of the inputs for each month, by infile
+        routeEquivHash = manifest.getFileHash(self.routeEquivFile)
+        monthHashes = {}
+        for infile in infiles: 
+            for date, inputHash in self.getDateHashes(infile, manifest): 
+                month = str(date.to_period('M').to_timestamp().date())
+                monthHashes.setdefault(month, {}).setdefault(infile, set()).add(inputHash)
+        
+        # months that are no longer in the inputs
+        for month in list(manifest.getEntries('clean2').keys()): 
+            if not month in monthHashes: 
+                self.removeMonth(outfile, pd.Timestamp(month))
+                manifest.removeEntry('clean2', month)
+                manifest.save()
+        
+        # months that are new or have changed
+        changedMonths = {}
+        for month in sorted(monthHashes.keys()): 
+            signature = {'routeEquiv' : routeEquivHash, 
+                         'encodeStrings' : self.encodeStrings, 
+                         'inputs'     : dict((infile, sorted(monthHashes[month][infile])) 
+                                             for infile in monthHashes[month])}
+            monthHash = hashlib.md5(json.dumps(signature, sort_keys=True).encode('utf-8')).hexdigest()
+            
+            if manifest.isCurrent('clean2', month, monthHash): 
+                print (datetime.datetime.now().ctime(), 'Skipping unchanged month: ', month)
+            else: 
+                changedMonths[month] = monthHash
+        
+        if len(changedMonths)==0: 
+            return
+        
+        # replace those months, reading each infile once
+        for month in sorted(changedMonths.keys()): 
+            manifest.removeEntry('clean2', month)
+            manifest.save()
+            self.removeMonth(outfile, pd.Timestamp(month))
+        
+        for infile in infiles: 
+            months = [pd.Timestamp(month) for month in sorted(changedMonths.keys()) 
+                      if infile in monthHashes[month]]
+            if len(months) > 0: 
+                self.cleanPart2(infile, outfile, months=months)
+        
+        for month in sorted(changedMonths.keys()): 
+            manifest.setEntry('clean2', month, 
+                {'hash'    : changedMonths[month], 
+                 'outfile' : getOutfile(outfile, pd.Timestamp(month)), 
+                 'outkey'  : getOutkey(month=pd.Timestamp(month), prefix='m')})
+        manifest.save()
+        
+        
+    def getDateHashes(self, infile, manifest): 
+        """
+        Gets the dates in a cleaned step 1 file, along with the hash of
+        the input that each date came from.  Uses the raw files recorded
+        in the manifest by processRawFiles, or if there are none, the 
+        hash of the step 1 file itself. 
+        
+        returns a list of (date, hash) tuples
+        """
+        dateHashes = []
+        for entry in manifest.getEntries('clean1').values(): 
+            if entry['outfile']==infile: 
+                for date in entry['dates']: 
+                    dateHashes.append((pd.Timestamp(date), entry['hash']))
+        if len(dateHashes) > 0: 
+            return dateHashes
+        
+        inputHash = manifest.getFileHash(infile)
+        store = openStore(infile, mode='r')
+        dates = store.select_column('sample', 'DATE').unique()
+        store.close()
+        return [(pd.Timestamp(date), inputHash) for date in dates]
+        
+        
+    def removeMonth(self, outfile, month): 
+        """
+        removes the table for this month from the output of cleanPart2
+        """
+        monthfile = getOutfile(outfile, month)
+        if not storeExists(monthfile): 
+            return
+        outkey = getOutkey(month=month, prefix='m')
+        outstore = openStore(monthfile)
+        if '/' + outkey in outstore.keys(): 
+            print (datetime.datetime.now().ctime(), 'Removing ', outkey, ' from ', monthfile)
+            outstore.remove(outkey)
+        outstore.close()
+        
+        
+    def cleanPart2(self, infile, outfile, months=None):
         """
         updates route equiv based on date, and writes to year-specific files.
         
+        Reads the step 1 table sequentially in large chunks, rather than 
+        querying it once per date, and appends each chunk to the tables
+        for the months it covers.  Each output file is opened once and 
+        kept open until the whole infile is written. 
+        
         infile  - in cleaned step 1 format
         outfile - output file name in h5 format, with YYYY for years
+        months  - list of months to process, as timestamps for the first
+                  of the month, or None for all months in infile
         """
         
         print (datetime.datetime.now().ctime(), 'Converting data in file: ', infile)        
         
         # for tracking undefined route equivalencies
         missingRouteIds = set()
-
-        # loop through these dates
-        store = pd.HDFStore(infile) 
-        dates = store.select_column('sample', 'DATE').unique()
-        dates = sorted(dates)
-        print(datetime.datetime.now().ctime(), 'Writing data for periods from ', dates[0], ' to ', dates[-1]) 
         
-        # one for each date
-        for date in dates:
+        if months!=None: 
+            months = pd.DatetimeIndex(months).values.astype('datetime64[M]')
         
-            print(datetime.datetime.now().ctime(), 'Processing ', date) 
-            
-            # use a separate output file for each year
-            # and write a separate table for each month and DOW
-            # format of the table name is mYYYYMMDDdX, where X is the day of week
-            month = ((pd.to_datetime(date)).to_period('M')).to_timestamp()    
-            outstore = pd.HDFStore(getOutfile(outfile, month))                          
-            outkey = getOutkey(month=month, prefix='m')        
-                        
-            # select the appropriate equiv records
-            equiv = self.routeEquiv[(self.routeEquiv['START_DATE'] < date) & (date < self.routeEquiv['END_DATE'])]
-            
-            # get the data            
-            df = store.select('sample', where='DATE==Timestamp(date)')
-            
-            # check for missing route IDs
-            for r in df['ROUTE_AVL'].unique(): 
-                if not r in equiv.index: 
-                    missingRouteIds.add(r)
-                    print ('ROUTE_AVL id ', r, ' not found in route equivalency file')
-                    
-            # update the route names based on the equiv file
-            df.drop('AGENCY_ID', axis=1, inplace=True)
-            df.drop('ROUTE_SHORT_NAME', axis=1, inplace=True)
-            df.drop('ROUTE_LONG_NAME', axis=1, inplace=True)
-            
-            df['AGENCY_ID']        = df['ROUTE_AVL'].map(equiv['AGENCY_ID'])
-            df['ROUTE_SHORT_NAME'] = df['ROUTE_AVL'].map(equiv['ROUTE_SHORT_NAME'])
-            df['ROUTE_LONG_NAME']  = df['ROUTE_AVL'].map(equiv['ROUTE_LONG_NAME'])
-            
-            # convert unicode fields from python3  
-            types = df.apply(lambda x: pd.api.types.infer_dtype(x.values))
-            for col in types[types=='unicode'].index:
-                df[col] = df[col].astype(str)
-            
-            if len(missingRouteIds) > 0: 
-                print ('The following AVL route IDs are missing from the routeEquiv file:')
-                for missing in missingRouteIds: 
-                    print('  ', missing)
+        # one writer for each output file
+        outstores = {}
+        
+        # encoded columns are written as integers
+        stringLengths = self.STRING_LENGTHS
+        if self.encodeStrings: 
+            stringLengths = dict((col, stringLengths[col]) for col in stringLengths 
+                                 if not col in self.ENCODED_COLUMNS)
+        
+        store = openStore(infile, mode='r') 
+        rowsRead = 0
+        rowsWritten = 0
+        try: 
+            for df in store.select('sample', chunksize=self.PART2_CHUNKSIZE): 
+                rowsRead += len(df)
                 
-            # write the data
-            outstore.append(outkey, df, data_columns=True, min_itemsize=self.STRING_LENGTHS)
-            outstore.close()
+                # use a separate output file for each year
+                # and write a separate table for each month
+                # format of the table name is mYYYYMM01
+                df = df[pd.notnull(df['DATE'])]
+                dfMonths = df['DATE'].values.astype('datetime64[M]')
+                if months is not None: 
+                    keep = np.isin(dfMonths, months)
+                    df = df[keep]
+                    dfMonths = dfMonths[keep]
+                if len(df)==0: 
+                    continue
+                
+                # update the route names based on the equiv file
+                equiv = self.getRouteEquivFields(df)
+                for col in ['AGENCY_ID', 'ROUTE_SHORT_NAME', 'ROUTE_LONG_NAME']: 
+                    df.drop(col, axis=1, inplace=True)
+                    df[col] = equiv[col]
+                
+                # check for missing route IDs
+                for r in df.loc[pd.isnull(df['AGENCY_ID']), 'ROUTE_AVL'].unique(): 
+                    if not r in missingRouteIds: 
+                        missingRouteIds.add(r)
+                        print ('ROUTE_AVL id ', r, ' not found in route equivalency file')
+                
+                # convert unicode fields from python3  
+                types = df.apply(lambda x: pd.api.types.infer_dtype(x.values))
+                for col in types[types=='unicode'].index:
+                    df[col] = df[col].astype(str)
+                
+                # write the data
+                for monthValue, monthDf in df.groupby(dfMonths, sort=True): 
+                    month = pd.Timestamp(monthValue)
+                    monthfile = getOutfile(outfile, month)
+                    if not monthfile in outstores: 
+                        outstores[monthfile] = openStore(monthfile)
+                    outkey = getOutkey(month=month, prefix='m')        
+                    if self.encodeStrings: 
+                        monthDf = encodeStrings(outstores[monthfile], monthDf, 
+                                                self.ENCODED_COLUMNS)
+                    outstores[monthfile].append(outkey, monthDf, data_columns=True, 
+                                                min_itemsize=stringLengths)
+                    rowsWritten += len(monthDf)
+                
+                print(datetime.datetime.now().ctime(), ' Read %i rows and wrote %i rows.' 
+                        % (rowsRead, rowsWritten))
+        finally: 
+            store.close()
+            for outstore in outstores.values(): 
+                outstore.close()
+            
+        if len(missingRouteIds) > 0: 
+            print ('The following AVL route IDs are missing from the routeEquiv file:')
+            for missing in sorted(missingRouteIds): 
+                print('  ', missing)
+        
+        
+    def getRouteEquivFields(self, df): 
+        """
+        Looks up the GTFS route names for each record, using the route
+        equivalency that applies on the date of the record.  Uses the
+        index built in readRouteEquiv, so it is a single searchsorted 
+        over all records.  
+        
+        df - dataframe with ROUTE_AVL and DATE
+        
+        returns a dataframe with AGENCY_ID, ROUTE_SHORT_NAME and 
+                ROUTE_LONG_NAME, indexed like df, with NaN where there is
+                no equivalent route
+        """
+        keys, null = getIntervalKeys(df['ROUTE_AVL'], df['DATE'])
+        positions, found = findIntervals(self.routeEquivStarts, self.routeEquivEnds, 
+                                         keys, null=null)
+        
+        fields = pd.DataFrame(index=df.index)
+        for col in self.routeEquivFields.columns: 
+            values = self.routeEquivFields[col].values
+            if len(values)==0: 
+                fields[col] = np.nan
+            else: 
+                fields[col] = np.where(found, values[positions], np.nan)
+        return fields
         
         
     def getWrapAroundTimes(self, df, dateint_field, timeint_field):
         """
-        Converts a string in the format '%H%M%S' to a datetime object.
+        Converts integer dates in the format MMDDYY and times in the format 
+        HHMMSS to datetime objects, working on the whole column at once.
         Accounts for the convention where service after midnight is counted
         with the previous day, so input times can be >24 hours. 
-        """        
-            
-        df['nextDay'] = df[timeint_field] >= 240000
-        df[timeint_field] = np.where(df['nextDay'], df[timeint_field] - 240000, df[timeint_field])
         
-        df['dateString']    = df[dateint_field].map("{0:0>6}".format)  
-        df['timeString']    = df[timeint_field].map("{0:0>6}".format)      
-        df['datetimeString'] = df['dateString'] + ' ' + df['timeString']    
+        Values that won't convert are set to NaT and reported in a summary. 
+        """        
+        times, bad = getWrapAroundTimesFromInts(df[dateint_field], df[timeint_field])
         
         # once in a while we get a number that won't convert
-        try: 
-            df['time'] = pd.to_datetime(df['datetimeString'], format="%m%d%y %H%M%S")
-        except ValueError:
-            df['time'] = pd.NaT
-            for i, dt in df['datetimeString'].iteritems(): 
-                try: 
-                    df.at[i,'time'] = pd.to_datetime(dt, format="%m%d%y %H%M%S")
-                except ValueError: 
-                    print ('Could not convert date time', dt)
-        
-        df['time'] = np.where(df['nextDay'], df['time'] + pd.DateOffset(days=1), df['time'])
-        
-        return df['time']
+        if bad.any(): 
+            badValues = (df.loc[bad, dateint_field].astype(str) + ' ' 
+                       + df.loc[bad, timeint_field].astype(str))
+            self.reportBadValues(timeint_field, badValues)
+        
+        return pd.Series(times, index=df.index)
     
     
     def getDates(self, dateIntSeries): 
         """
         Converts an integer in the format "%m%d%y" into a datetime object.
         """
-        dateString = dateIntSeries.map("{0:0>6}".format)   
-        date =  pd.to_datetime(dateString, format="%m%d%y")
-        return date
+        dates, bad = getDatesFromInts(dateIntSeries)
+        
+        if bad.any(): 
+            self.reportBadValues(dateIntSeries.name, dateIntSeries[bad])
+        
+        return pd.Series(dates, index=dateIntSeries.index)
+    
     
-        dateSeries = [self.getDate(d) for d in dateIntSeries]
-        return dateSeries
-    
\ No newline at end of file
+    def reportBadValues(self, name, badValues):
+        """
+        Prints a summary of the values that could not be converted, 
+        which are set to NaT. 
+        """
+        examples = [str(v) for v in badValues.unique()[:5]]
+        print ('Could not convert %i values of %s, for example: ' % (len(badValues), name), 
+               ', '.join(examples))
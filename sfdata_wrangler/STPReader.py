@@ -0,0 +1,351 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import os
+import mmap
+from collections import OrderedDict
+
+
+# byte values used when parsing
+SPACE   = 32
+NEWLINE = 10
+RETURN  = 13
+MINUS   = 45
+PLUS    = 43
+POINT   = 46
+ZERO    = 48
+NINE    = 57
+
+
+def parseNumbers(block, isFloat):
+    """
+    Parses a block of fixed-width text into numbers, one row at a time
+    but vectorized across all rows.
+
+    block   - 2-d array of uint8, with one row per record and one column
+              per character in the field
+    isFloat - True to allow a decimal point
+
+    returns (values, empty, bad), where values is a float64 array, empty
+            flags blank fields and bad flags fields that are not numbers.
+            Both empty and bad fields are NaN in values.
+    """
+
+    nrows, width = block.shape
+    acc      = np.zeros(nrows, dtype='float64')
+    scale    = np.ones(nrows, dtype='float64')
+    negative = np.zeros(nrows, dtype='bool')
+    seenDigit= np.zeros(nrows, dtype='bool')
+    seenPoint= np.zeros(nrows, dtype='bool')
+    bad      = np.zeros(nrows, dtype='bool')
+
+    for j in range(width):
+        c = block[:, j]
+        isDigit = (c >= ZERO) & (c <= NINE)
+        isSign  = (c == MINUS) | (c == PLUS)
+        isPoint = (c == POINT)
+
+        # signs must come before any digits, and only one decimal point
+        bad |= isSign & (seenDigit | seenPoint)
+        bad |= isPoint & (seenPoint | (not isFloat))
+        bad |= ~(isDigit | isSign | isPoint | (c == SPACE))
+
+        acc = np.where(isDigit, acc * 10 + (c - ZERO), acc)
+        scale = np.where(isDigit & seenPoint, scale * 10, scale)
+        negative |= (c == MINUS)
+        seenDigit |= isDigit
+        seenPoint |= isPoint
+
+    values = acc / scale
+    values = np.where(negative, -values, values)
+
+    empty = ~seenDigit & ~bad
+    bad |= ~seenDigit & seenPoint
+    values[empty | bad] = np.nan
+
+    return values, empty, bad
+
+
+def parseStrings(block):
+    """
+    Converts a block of fixed-width text into an array of stripped
+    strings, with NaN for blank fields, consistent with read_fwf.
+    """
+    nrows, width = block.shape
+    if width == 0: 
+        return np.full(nrows, np.nan, dtype='object')
+    
+    raw = np.ascontiguousarray(block).view('S' + str(width)).ravel()
+    stripped = np.char.strip(raw)
+
+    values = np.empty(nrows, dtype='object')
+    values[:] = [s.decode('latin-1') for s in stripped]
+    values[stripped == b''] = np.nan
+
+    return values
+
+
+class STPReader():
+    """
+    Reads raw STP files, which are in a fixed-width format, directly into
+    typed numpy columns.  The file is memory-mapped and each chunk of
+    lines is laid out as a 2-d array of bytes, so each column can be
+    sliced at its fixed byte offsets and converted for all rows at once.
+
+    Header lines that appear in the middle of the file and rows where
+    the rear-door boardings are mis-aligned are dropped before the type
+    conversion.
+
+    Can read the whole file or a range of bytes, so that different
+    processes can work on different parts of the same file.
+    """
+
+    # number of bytes to read at a time.  The actual chunk will end
+    # at the last complete line.
+    CHUNKBYTES = 64 * 1024 * 1024
+
+    # number of lines to lay out at once when the lines are different lengths
+    BATCHLINES = 20000
+
+    def __init__(self, colnames, colspecs, coltypes,
+                 headerRows=0, keyColumn=None, maxValues=None,
+                 chunkBytes=None):
+        """
+        Constructor.
+
+        colnames   - list of column names to read
+        colspecs   - list of (start, end) byte offsets for each column,
+                     as used by read_fwf
+        coltypes   - list of 'int64', 'float64' or 'object' for each column
+        headerRows - number of lines to skip at the top of the file
+        keyColumn  - lines are dropped if this column is not a valid number,
+                     which catches header lines in the middle of the file
+        maxValues  - dictionary of column name: value, where lines are dropped
+                     if the column is not less than the value, or None
+        chunkBytes - number of bytes to read at a time
+        """
+        self.colnames = colnames
+        self.colspecs = colspecs
+        self.coltypes = coltypes
+        self.headerRows = headerRows
+        self.keyColumn = keyColumn
+
+        if maxValues==None:
+            self.maxValues = {}
+        else:
+            self.maxValues = maxValues
+
+        if chunkBytes==None:
+            self.chunkBytes = self.CHUNKBYTES
+        else:
+            self.chunkBytes = chunkBytes
+
+        # the width needed to hold all columns being read
+        self.width = max([spec[1] for spec in colspecs])
+
+        # keep track of what we read and what we drop
+        self.linesRead = 0
+        self.linesSkipped = 0
+
+
+    def getByteRanges(self, infile, numRanges):
+        """
+        Splits the file into byte ranges of about equal size.  Each
+        range is adjusted to start at the beginning of a line when read.
+
+        returns a list of (start, end) tuples
+        """
+        size = os.path.getsize(infile)
+        bounds = [int(i * size / numRanges) for i in range(numRanges + 1)]
+        return [(bounds[i], bounds[i+1]) for i in range(numRanges)]
+
+
+    def readChunks(self, infile, byteRange=None):
+        """
+        Generator that reads the file chunk by chunk.
+
+        infile    - file in "raw STP" format
+        byteRange - (start, end) tuple of bytes to read.  Lines are
+                    included if they start in this range.  None reads
+                    the whole file.
+
+        yields an OrderedDict of column name: numpy array
+        """
+
+        size = os.path.getsize(infile)
+        if byteRange==None:
+            byteRange = (0, size)
+        (start, end) = byteRange
+        end = min(end, size)
+        if size==0 or start>=end:
+            return
+
+        f = open(infile, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            # begin at the start of a line
+            pos = start
+            if start > 0:
+                pos = mm.find(b'\n', start - 1) + 1
+                if pos == 0:
+                    pos = size
+
+            # skip the headers at the top of the file
+            if start == 0:
+                for i in range(self.headerRows):
+                    pos = mm.find(b'\n', pos) + 1
+                    if pos == 0:
+                        pos = size
+
+            while pos < end:
+
+                # end each chunk at the end of a line, finishing the
+                # last line in the range even if it runs past the end
+                stop = min(pos + self.chunkBytes, end)
+                if stop < size:
+                    newline = mm.rfind(b'\n', pos, stop)
+                    if newline < 0:
+                        newline = mm.find(b'\n', stop)
+                    stop = size if newline < 0 else newline + 1
+
+                buf = np.frombuffer(mm[pos:stop], dtype='uint8')
+                pos = stop
+
+                chunk = self.parseBuffer(buf)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            mm.close()
+            f.close()
+
+
+    def parseBuffer(self, buf):
+        """
+        Converts a buffer of complete lines into typed columns.
+
+        returns an OrderedDict of column name: numpy array, or None if
+                there are no valid lines
+        """
+
+        # find the lines
+        newlines = np.flatnonzero(buf == NEWLINE)
+        starts = np.concatenate(([0], newlines + 1))
+        ends = np.concatenate((newlines, [len(buf)]))
+        if starts[-1] == len(buf):
+            starts = starts[:-1]
+            ends = ends[:-1]
+
+        # windows line endings
+        hasReturn = (ends > starts) & (buf[np.maximum(ends - 1, 0)] == RETURN)
+        ends = np.where(hasReturn, ends - 1, ends)
+
+        lines = self.layoutLines(buf, starts, ends)
+        self.linesRead += len(lines)
+
+        # skip blank lines
+        keep = ~(lines == SPACE).all(axis=1)
+
+        # skip header lines in the middle of the file
+        if self.keyColumn != None:
+            i = self.colnames.index(self.keyColumn)
+            (a, b) = self.colspecs[i]
+            values, empty, bad = parseNumbers(lines[:, a:b], self.coltypes[i]=='float64')
+            keep &= ~(empty | bad)
+
+        # skip mis-aligned rows
+        for name in self.maxValues:
+            i = self.colnames.index(name)
+            (a, b) = self.colspecs[i]
+            values, empty, bad = parseNumbers(lines[:, a:b], self.coltypes[i]=='float64')
+            with np.errstate(invalid='ignore'):
+                keep &= (values < self.maxValues[name])
+
+        self.linesSkipped += len(lines) - keep.sum()
+        if not keep.any():
+            return None
+        lines = lines[keep]
+
+        # now convert each column
+        chunk = OrderedDict()
+        for name, (a, b), dtype in zip(self.colnames, self.colspecs, self.coltypes):
+            block = lines[:, a:b]
+            if dtype == 'object':
+                chunk[name] = parseStrings(block)
+            else:
+                values, empty, bad = parseNumbers(block, dtype=='float64')
+                if dtype == 'int64' and not (empty | bad).any():
+                    values = values.astype('int64')
+                chunk[name] = values
+
+        return chunk
+
+
+    def layoutLines(self, buf, starts, ends):
+        """
+        Lays out the lines as a 2-d array of bytes, padding short lines
+        with spaces so every column is at a fixed offset.
+        """
+
+        numLines = len(starts)
+        width = self.width
+        lengths = ends - starts
+
+        # fast path if all the lines are the same length and evenly 
+        # spaced, in which case the buffer can be reshaped directly
+        if numLines > 0 and (lengths == lengths[0]).all(): 
+            length = lengths[0]
+            if numLines > 1: 
+                stride = starts[1] - starts[0]
+            else: 
+                stride = len(buf) - starts[0]
+            if (stride >= length and 
+                (starts == starts[0] + stride * np.arange(numLines)).all()): 
+                
+                # the last line may not have a line ending
+                needed = starts[0] + numLines * stride
+                if needed > len(buf): 
+                    buf = np.concatenate((buf, np.full(needed - len(buf), NEWLINE, dtype='uint8')))
+                lines = buf[starts[0]:needed].reshape(numLines, stride)
+                
+                if length >= width: 
+                    return lines[:, :width]
+                out = np.full((numLines, width), SPACE, dtype='uint8')
+                out[:, :length] = lines[:, :length]
+                return out
+
+        # otherwise, copy in batches to limit memory
+        out = np.full((numLines, width), SPACE, dtype='uint8')
+        offsets = np.arange(width, dtype='int64')
+        for i in range(0, numLines, self.BATCHLINES):
+            s = starts[i:i + self.BATCHLINES]
+            n = np.minimum(lengths[i:i + self.BATCHLINES], width)
+            index = s[:, None] + offsets[None, :]
+            inLine = offsets[None, :] < n[:, None]
+            out[i:i + self.BATCHLINES] = np.where(inLine, buf[np.where(inLine, index, 0)], SPACE)
+
+        return out
+
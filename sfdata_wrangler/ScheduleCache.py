@@ -0,0 +1,168 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+
+
+class ScheduleCache():
+    """
+    Keeps the GTFS schedule for recently used service periods in memory, 
+    so it is read from the store once rather than for each GTFS file and
+    date.  Each schedule is keyed by (SCHED_DATES, SERVICE_ID, ROUTE_TYPE), 
+    and the least recently used are dropped when the total memory goes 
+    over the limit. 
+    
+    The cached frames are not changed.  The times are kept as offsets from
+    the start of the service day, and each date gets a new frame with its
+    own date and time columns, sharing the other columns with the cache. 
+    
+    Anything else that depends only on the service period, such as the 
+    encoded join keys, can also be built once and kept with the schedule. 
+    """
+    
+    # default limit on the memory used by the cached schedules
+    MAX_BYTES = 1024 * 1024 * 1024
+    
+    # columns that depend on the date
+    DATE_COLUMNS = ['MONTH', 'DATE']
+    TIME_COLUMNS = ['ARRIVAL_TIME_S', 'DEPARTURE_TIME_S']
+    
+    def __init__(self, store, key='sfmuni', maxBytes=None, prepare=None, 
+                 makeKeys=None):
+        """
+        Constructor. 
+        
+        store    - open GTFS store, as written by GTFSHelper.processFiles()
+        key      - name of the schedule table in the store
+        maxBytes - limit on the memory used by the cached schedules
+        prepare  - optional function applied to each schedule when it is
+                   read, before it is cached
+        makeKeys - optional function applied to each prepared schedule, 
+                   returning an object with the join keys, which is 
+                   cached with it and returned by getKeys()
+        """
+        self.store = store
+        self.key = key
+        self.prepare = prepare
+        self.makeKeys = makeKeys
+        
+        if maxBytes==None: 
+            self.maxBytes = self.MAX_BYTES
+        else: 
+            self.maxBytes = maxBytes
+        
+        # (base, offsets, keys, bytes) for each key, most recently used last
+        self.schedules = OrderedDict()
+        self.totalBytes = 0
+        
+        
+    def getSchedule(self, schedDates, serviceId, routeType, date, month): 
+        """
+        Gets the schedule for a service period on a date. 
+        
+        schedDates - SCHED_DATES of the GTFS feed
+        serviceId  - SERVICE_ID of the service period
+        routeType  - ROUTE_TYPE to keep
+        date       - date to set the times for
+        month      - month of the date
+        
+        returns a dataframe, which can be changed without affecting the cache
+        """
+        (base, offsets, keys, nbytes) = self.getEntry(schedDates, serviceId, routeType)
+        
+        date = pd.Timestamp(date)
+        dateColumns = pd.DataFrame(index=base.index)
+        dateColumns['MONTH'] = pd.Timestamp(month)
+        dateColumns['DATE'] = date
+        for col in self.TIME_COLUMNS: 
+            dateColumns[col] = np.datetime64(date, 'ns') + offsets[col]
+        
+        return pd.concat([base, dateColumns], axis=1)
+        
+        
+    def getKeys(self, schedDates, serviceId, routeType): 
+        """
+        Gets the join keys built by makeKeys for a service period, which 
+        are in the same row order as the schedule returned by getSchedule(). 
+        None if there is no makeKeys function. 
+        """
+        (base, offsets, keys, nbytes) = self.getEntry(schedDates, serviceId, routeType)
+        return keys
+        
+        
+    def getEntry(self, schedDates, serviceId, routeType): 
+        """
+        Gets the cached entry for a service period, reading it if needed, 
+        and marks it as the most recently used. 
+        """
+        key = (schedDates, serviceId, routeType)
+        if key in self.schedules: 
+            self.schedules[key] = self.schedules.pop(key)
+        else: 
+            self.addSchedule(key)
+        return self.schedules[key]
+        
+        
+    def addSchedule(self, key): 
+        """
+        Reads the schedule from the store and adds it to the cache, 
+        dropping the least recently used schedules to stay under the limit. 
+        """
+        (schedDates, serviceId, routeType) = key
+        print('Reading service_id ', serviceId, ' for ', schedDates)
+        df = self.store.select(self.key, 
+                where="SCHED_DATES=schedDates & SERVICE_ID=serviceId & ROUTE_TYPE=routeType")
+        
+        if self.prepare != None: 
+            df = self.prepare(df)
+        
+        keys = None
+        nbytes = 0
+        if self.makeKeys != None: 
+            keys = self.makeKeys(df)
+            nbytes += keys.nbytes
+        
+        # keep the times as offsets from the start of the service day
+        offsets = {}
+        for col in self.TIME_COLUMNS: 
+            offsets[col] = (df[col] - df['DATE']).values
+        base = df.drop(columns=self.DATE_COLUMNS + self.TIME_COLUMNS)
+        
+        nbytes += (base.memory_usage(index=True, deep=True).sum() 
+                + sum([offsets[col].nbytes for col in offsets]))
+        
+        self.schedules[key] = (base, offsets, keys, nbytes)
+        self.totalBytes += nbytes
+        
+        # always keep the one just added
+        while self.totalBytes > self.maxBytes and len(self.schedules) > 1: 
+            oldKey, (oldBase, oldOffsets, oldKeys, oldBytes) = self.schedules.popitem(last=False)
+            self.totalBytes -= oldBytes
+            print('Dropping schedule for service_id ', oldKey[1], ' for ', oldKey[0], 
+                  ' from the cache')
+        
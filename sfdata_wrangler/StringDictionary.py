@@ -0,0 +1,143 @@
+
+# allows python3 style print function
+from __future__ import print_function
+
+
+# -*- coding: utf-8 -*-
+__author__      = "Gregory D. Erhardt"
+__copyright__   = "Copyright 2013 SFCTA"
+__license__     = """
+    This file is part of sfdata_wrangler.
+
+    sfdata_wrangler is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sfdata_wrangler is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with sfdata_wrangler.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pandas as pd
+import numpy as np
+
+"""
+Methods for storing string columns that have few distinct values as
+integer codes, with a dictionary table in the same HDF store to
+translate them back.  Readers get the columns back as pandas Categoricals.
+
+The dictionary table has one row for each value, with the columns:
+    FIELD - the name of the column
+    CODE  - the integer code written in the column
+    VALUE - the string value
+Each encoded column also has a row with a CODE of -1, so it is decoded 
+even if all its values are missing. 
+"""
+
+# name of the dictionary table in each store
+DICTIONARY_KEY = 'dictionary'
+
+# width of the columns in the dictionary table
+FIELD_LENGTH = 20
+VALUE_LENGTH = 32
+
+
+def readDictionary(store):
+    """
+    Reads the dictionary from the store.
+
+    returns a dictionary of field: list of values, where the position
+            in the list is the code.  Empty if the store has no dictionary.
+    """
+    dictionary = {}
+    if not '/' + DICTIONARY_KEY in store.keys():
+        return dictionary
+
+    df = store.select(DICTIONARY_KEY)
+    df = df.sort_values(['FIELD', 'CODE'])
+    for field, group in df.groupby('FIELD'):
+        dictionary[field] = list(group.loc[group['CODE']>=0, 'VALUE'])
+    return dictionary
+
+
+def encodeStrings(store, df, columns):
+    """
+    Replaces string columns with integer codes, and adds any new values
+    to the dictionary in the store.  Missing values get a code of -1.
+
+    store   - the HDFStore the df will be written to
+    df      - dataframe to encode
+    columns - list of columns to encode.  Those not in df are skipped.
+
+    returns a copy of df with the encoded columns
+    """
+    dictionary = readDictionary(store)
+    df = df.copy()
+
+    newValues = []
+    for col in columns:
+        if not col in df.columns:
+            continue
+
+        if not col in dictionary:
+            newValues.append([col, -1, ''])
+        values = dictionary.get(col, [])
+        known = set(values)
+        for value in pd.unique(df[col].dropna()):
+            if not value in known:
+                newValues.append([col, len(values), value])
+                values.append(value)
+                known.add(value)
+        dictionary[col] = values
+
+        codes = pd.Categorical(df[col], categories=values).codes
+        df[col] = codes.astype('int32')
+
+    if len(newValues) > 0:
+        newValues = pd.DataFrame(newValues, columns=['FIELD', 'CODE', 'VALUE'])
+        newValues['CODE'] = newValues['CODE'].astype('int32')
+        newValues['VALUE'] = newValues['VALUE'].astype(str)
+        store.append(DICTIONARY_KEY, newValues, data_columns=['FIELD'],
+                     min_itemsize={'FIELD' : FIELD_LENGTH, 'VALUE' : VALUE_LENGTH})
+
+    return df
+
+
+def decodeStrings(store, df):
+    """
+    Converts any columns with integer codes in the store's dictionary
+    to pandas Categoricals.  Does nothing if the store has no dictionary.
+
+    store - the HDFStore the df was read from
+    df    - dataframe to decode
+
+    returns df with the decoded columns
+    """
+    dictionary = readDictionary(store)
+    for col in dictionary:
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.Categorical.from_codes(df[col].values,
+                                                categories=dictionary[col])
+    return df
+
+
+def toStrings(df):
+    """
+    Converts any Categorical columns back to plain strings, for writing
+    to tables that are not encoded.
+
+    returns df, or a copy if anything was converted
+    """
+    categoricals = [col for col in df.columns if df[col].dtype.name=='category']
+    if len(categoricals)==0:
+        return df
+
+    df = df.copy()
+    for col in categoricals:
+        df[col] = np.asarray(df[col].astype('object'))
+    return df
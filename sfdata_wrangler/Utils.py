@@ -44,4 +44,233 @@ def cleanCrosstab(rows, cols, values, aggfunc=sum, weight=None):
     t = t.append(pd.Series(t.sum(axis=0), name='Total'))
     
     return t
-        
\ No newline at end of file
+        
+
+def roundDecimals(values, decimals=2): 
+    """
+    Rounds to the given number of decimals the same way as the built-in 
+    round() does for each value:  to the decimal nearest the exact binary
+    value, with exact ties going to even.  np.round() multiplies by 
+    10**decimals first, which can move values just below a tie onto it, 
+    so this also keeps the rounding error of the multiplication and uses
+    it to break near ties. 
+    
+    values   - array-like of floats
+    decimals - number of decimals to keep
+    
+    returns a float64 array
+    """
+    values = np.asarray(values, dtype='float64')
+    scale = 10.0 ** decimals
+    
+    with np.errstate(invalid='ignore', over='ignore'): 
+        # scaled + error is exactly values * scale (Dekker's product)
+        scaled = values * scale
+        split = 134217729.0 * values
+        hi = split - (split - values)
+        lo = values - hi
+        splitScale = 134217729.0 * scale
+        scaleHi = splitScale - (splitScale - scale)
+        scaleLo = scale - scaleHi
+        error = (((hi * scaleHi - scaled) + hi * scaleLo + lo * scaleHi) 
+                 + lo * scaleLo)
+        
+        # compare to the half-way point between the integers either side
+        lower = np.floor(scaled)
+        fromHalf = (scaled - (lower + 0.5)) + error
+        isEven = np.fmod(lower, 2) == 0
+        rounded = np.where(fromHalf > 0, lower + 1, 
+                  np.where(fromHalf < 0, lower, 
+                  np.where(isEven, lower, lower + 1)))
+        rounded = np.where(np.isfinite(scaled), rounded, scaled)
+    
+    return rounded / scale
+    
+    
+def getSpeeds(distance, minutes): 
+    """
+    Calculates speeds in miles per hour from distances in miles and times
+    in minutes, for whole columns at once.  Speeds are rounded to two 
+    decimals.  Where the time is zero, the speed is zero, and where it is
+    negative or missing, the speed is missing. 
+    
+    distance - array-like of distances, such as SERVMILES
+    minutes  - array-like of times, such as RUNTIME
+    
+    returns a float64 array of speeds
+    """
+    distance = np.asarray(distance, dtype='float64')
+    minutes = np.asarray(minutes, dtype='float64')
+    
+    positive = minutes > 0
+    with np.errstate(divide='ignore', invalid='ignore'): 
+        speeds = roundDecimals(distance / np.where(positive, minutes / 60.0, 1.0), 2)
+        
+    speeds = np.where(positive, speeds, np.where(minutes == 0, 0.0, np.nan))
+    
+    return speeds
+    
+    
+def getDatesFromInts(dateInts): 
+    """
+    Converts integers in the format MMDDYY into datetime64 values, working 
+    on the whole column at once.  Two-digit years follow the strptime 
+    convention: 69-99 are 1900s, 00-68 are 2000s. 
+    
+    dateInts - array-like of integer dates.  Missing values are allowed. 
+    
+    returns (dates, bad), where dates is a datetime64[ns] array with NaT 
+    for any values that are not valid dates, and bad is a boolean mask
+    of those values. 
+    """
+    values = np.asarray(dateInts, dtype='float64')
+    bad = ~np.isfinite(values) | (values < 0) | (values != np.floor(values))
+    ints = np.where(bad, 0, values).astype('int64')
+    
+    month = ints // 10000
+    day   = (ints // 100) % 100
+    yy    = ints % 100
+    year  = np.where(yy < 69, 2000 + yy, 1900 + yy)
+    
+    bad |= (month < 1) | (month > 12) | (day < 1)
+    month = np.where(bad, 1, month)
+    
+    monthStart = ((year - 1970) * 12 + (month - 1)).astype('datetime64[M]')
+    daysInMonth = ((monthStart + 1).astype('datetime64[D]') 
+                 - monthStart.astype('datetime64[D]')).astype('int64')
+    bad |= (day > daysInMonth)
+    
+    dates = (monthStart.astype('datetime64[D]') 
+           + np.where(bad, 0, day - 1).astype('timedelta64[D]'))
+    dates = dates.astype('datetime64[ns]')
+    dates[bad] = np.datetime64('NaT')
+    
+    return dates, bad
+    
+    
+def getSecondsFromInts(timeInts): 
+    """
+    Converts integers in the format HHMMSS into seconds past midnight.  
+    Hours can be >24 for service that runs after midnight, and is counted
+    with the previous day, but must be less than 48. 
+    
+    timeInts - array-like of integer times.  Missing values are allowed. 
+    
+    returns (seconds, bad), where seconds is an int64 array and bad is a 
+    boolean mask of the values that are not valid times. 
+    """
+    values = np.asarray(timeInts, dtype='float64')
+    bad = ~np.isfinite(values) | (values < 0) | (values != np.floor(values))
+    ints = np.where(bad, 0, values).astype('int64')
+    
+    hr  = ints // 10000
+    mn  = (ints // 100) % 100
+    sec = ints % 100
+    bad |= (hr >= 48) | (mn > 59) | (sec > 59)
+    
+    seconds = np.where(bad, 0, 3600 * hr + 60 * mn + sec)
+    
+    return seconds, bad
+    
+    
+def getWrapAroundTimes(dates, seconds, bad=None): 
+    """
+    Adds seconds past midnight to dates to get datetime64 values, where 
+    seconds can be more than 24 hours, wrapping around to the next day.  
+    This is the shared engine for AVL times in MMDDYY/HHMMSS integers and 
+    for GTFS stop times. 
+    
+    dates   - array-like of datetime64 values, or a single date
+    seconds - array-like of integer seconds past midnight of that date
+    bad     - optional boolean mask of values to set to NaT
+    
+    returns a datetime64[ns] array
+    """
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    seconds = np.asarray(seconds, dtype='int64')
+    
+    times = dates + seconds.astype('timedelta64[s]')
+    if bad is not None: 
+        times[bad] = np.datetime64('NaT')
+        
+    return times
+    
+    
+def getWrapAroundTimesFromInts(dateInts, timeInts): 
+    """
+    Converts integer dates in the format MMDDYY and integer times in the
+    format HHMMSS into datetime64 values in a single pass over the columns.  
+    Times >24 hours are counted as the next day. 
+    
+    returns (times, bad), where times is a datetime64[ns] array with NaT 
+    for values that cannot be converted, and bad is a boolean mask of those
+    """
+    dates, badDates = getDatesFromInts(dateInts)
+    seconds, badTimes = getSecondsFromInts(timeInts)
+    bad = badDates | badTimes
+    
+    times = getWrapAroundTimes(dates, seconds, bad=bad)
+    
+    return times, bad
+    
+    
+# seconds of time that can be held in an interval key for each id, 
+# about 540 years centered on 1970
+INTERVAL_SPAN = 2 ** 34
+    
+def getIntervalKeys(ids, times): 
+    """
+    Combines integer ids and datetimes into a single int64 key, which 
+    sorts by id and then by time, at a resolution of one second.  Used 
+    to look up which interval an (id, time) pair falls into with a single
+    searchsorted over all the pairs. 
+    
+    ids   - array-like of integers
+    times - array-like of datetime64 values
+    
+    returns (keys, null), where null flags missing ids or times
+    """
+    ids = np.asarray(ids, dtype='float64')
+    times = np.asarray(times, dtype='datetime64[ns]')
+    null = np.isnan(ids) | np.isnat(times)
+    
+    seconds = np.where(null, 0, times.astype('datetime64[s]').astype('int64'))
+    ids = np.where(null, 0, ids).astype('int64')
+    
+    keys = ids * INTERVAL_SPAN + seconds + INTERVAL_SPAN // 2
+    
+    return keys, null
+    
+    
+def findIntervals(startKeys, endKeys, keys, null=None): 
+    """
+    Finds the interval that each key falls into, where an interval
+    includes keys strictly after its start and strictly before its end.  
+    Intervals are defined with getIntervalKeys, sorted by startKeys, and
+    should not overlap for the same id. 
+    
+    startKeys - sorted int64 array with the start of each interval
+    endKeys   - int64 array with the end of each interval
+    keys      - int64 array of keys to look up
+    null      - optional boolean mask of keys that are never found
+    
+    returns (positions, found), where positions are the index of the 
+            interval in startKeys, and found flags the keys that fall 
+            into an interval.  Positions are 0 where not found. 
+    """
+    keys = np.asarray(keys, dtype='int64')
+    if len(startKeys)==0: 
+        return np.zeros(len(keys), dtype='int64'), np.zeros(len(keys), dtype='bool')
+    
+    # the last interval starting before each key.  If it belongs to 
+    # a lower id, its end is also before the key. 
+    positions = np.searchsorted(startKeys, keys, side='left') - 1
+    found = positions >= 0
+    positions = np.maximum(positions, 0)
+    found &= keys < endKeys[positions]
+    if null is not None: 
+        found &= ~null
+    
+    positions = np.where(found, positions, 0)
+    
+    return positions, found